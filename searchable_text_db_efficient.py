@@ -7,42 +7,2648 @@ Uses on-demand content loading to minimize memory usage.
 """
 
 import os
+import io
+import re
 import sqlite3
-import glob
+import time
+import itertools
+import functools
+import hashlib
+import random
+import struct
+import zlib
+import zipfile
+import heapq
+import datetime
+import calendar
+import mmap
+import argparse
+import multiprocessing
+import array
+import shutil
+import json
+import tempfile
+import threading
+from collections import Counter, namedtuple
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import sys
 from typing import List, Tuple
 
+try:
+    from PIL import Image  # Optional: only needed for scaled copies of the page scans
+except ImportError:
+    Image = None
+
+try:
+    import numpy as np  # Optional: only needed for document similarity
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
+
+DEFAULT_TEXT_DIR = "/home/jon/Documents/Epstein dump nov 12/TEXT"
+# The page scans are unzipped into numbered volume directories next to TEXT
+DEFAULT_IMAGE_DIR = os.path.dirname(DEFAULT_TEXT_DIR)
+
+_WHITESPACE = re.compile(r'\s+')
+
+# FTS5 tables maintained by this script
+FTS_TABLES = ('text_files_fts', 'passages_fts', 'passages_trigram')
+
+# Prefix lengths FTS5 keeps separate indexes for, so prefix queries such as epst* are lookups
+FTS_PREFIX = '2 3'
+
+# Completions precomputed per prefix up to this length; longer prefixes scan the vocabulary
+SUGGEST_PREFIX_LENGTH = 3
+SUGGEST_LIMIT = 10
+
+# Symmetric-delete spelling correction: edits considered, length of the term
+# prefix the deletes are generated from, and the least frequent term kept
+SPELL_MAX_DISTANCE = 2
+SPELL_PREFIX_LENGTH = 7
+SPELL_MIN_DOCUMENTS = 2
+# Searches with fewer results than this come back with spelling suggestions
+SPELL_SUGGEST_BELOW = 3
+
+# Documents whose NEAR phrases sit in different passages are checked against
+# their decompressed full text; this many at most per NEAR term and query
+NEAR_MAX_FULL_TEXT_CHECKS = 1000
+
+# Entity kinds extracted at index time, each also a search type
+ENTITY_KINDS = ('email', 'phone', 'amount', 'person')
+# The lookbehind starts local parts only at the start of a run, so a long run
+# without an @ is scanned once instead of once per character
+_EMAIL = re.compile(r'(?<![\w.+-])[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+_PHONE = re.compile(r'(?<![\w$.,])(?:\+?1[\s.-]?)?\(?([2-9]\d{2})\)?[\s.-]?(\d{3})[\s.-](\d{4})(?![\w.,]\d)')
+_AMOUNT = re.compile(r'\$\s?(\d{1,3}(?:,\d{3})+|\d+)(?:\.(\d{1,2}))?(?:\s?(thousand|million|billion)\b)?', re.IGNORECASE)
+_PERSON = re.compile(r'\b([A-Z][a-z]+(?:\s[A-Z]\.)?\s[A-Z][a-z]+(?:-[A-Z][a-z]+)?)\b')
+_AMOUNT_SCALE = {'thousand': 1000, 'million': 1000000, 'billion': 1000000000}
+# Capitalized words that start or end a sentence, header or place rather than a name
+_NOT_NAME_WORDS = frozenset('''
+    The This That These Those There Then When Where What Which While With Without From Sent Subject
+    Dear Re Fwd Attachment Regards Thanks Thank Please Yes No Mr Mrs Ms Dr Sir Madam Hon Judge
+    January February March April May June July August September October November December
+    Monday Tuesday Wednesday Thursday Friday Saturday Sunday
+    New York Palm Beach West East North South Street Avenue Road United States America Island Islands
+    House Senate Court Committee Oversight Federal District County City State Department Bureau
+    Inc Corp Company Bank Trust Foundation University Hotel
+'''.split())
+
+# Dates recognized at index time: ISO, US numeric and written-out month names
+_MONTHS = {name: number for number, names in enumerate((
+    ('jan', 'january'), ('feb', 'february'), ('mar', 'march'), ('apr', 'april'), ('may',), ('jun', 'june'),
+    ('jul', 'july'), ('aug', 'august'), ('sep', 'sept', 'september'), ('oct', 'october'), ('nov', 'november'),
+    ('dec', 'december')), 1) for name in names}
+_MONTH_NAME = r'(' + '|'.join(sorted(_MONTHS, key=len, reverse=True)) + r')\.?'
+_ISO_DATE = re.compile(r'\b(\d{4})-(\d{1,2})-(\d{1,2})\b')
+_US_DATE = re.compile(r'\b(\d{1,2})/(\d{1,2})/(\d{4}|\d{2})\b')
+_MONTH_DAY_YEAR = re.compile(r'\b' + _MONTH_NAME + r'\s+(\d{1,2})(?:st|nd|rd|th)?,?\s+(\d{4})\b', re.IGNORECASE)
+_DAY_MONTH_YEAR = re.compile(r'\b(\d{1,2})(?:st|nd|rd|th)?\s+' + _MONTH_NAME + r',?\s+(\d{4})\b', re.IGNORECASE)
+# Years outside this range are OCR noise or numbers that only look like dates
+DATE_YEARS = (1900, 2030)
+
+# Bates-style document numbers in filenames, e.g. HOUSE_OVERSIGHT_010477.txt
+_BATES_PREFIX = r'[A-Za-z][A-Za-z_\- ]*?[A-Za-z]'
+_BATES_FILENAME = re.compile(r'(' + _BATES_PREFIX + r')?[_\- ]*(\d+)(?:\.\w+)?')
+_BATES_QUERY = re.compile(
+    r'(?:(' + _BATES_PREFIX + r')[_\- ]*)?(\d+)(\*|\s*(?:-|\u2013|\.\.|to)\s*(?:' + _BATES_PREFIX + r'[_\- ]*)?(\d+))?',
+    re.IGNORECASE
+)
+
+# Page scan extensions and their image format; JPEG is preferred when a page has several scans
+IMAGE_FORMATS = {'.jpg': 'jpeg', '.jpeg': 'jpeg', '.png': 'png', '.gif': 'gif', '.tif': 'tiff', '.tiff': 'tiff'}
+_IMAGE_FORMAT_ORDER = ('jpeg', 'png', 'gif', 'tiff')
+
+# Where a page scan's data sits inside a release zip archive (a row of archive_members)
+ArchiveScan = namedtuple('ArchiveScan', 'archive member data_offset compressed_size compress_type crc format')
+
+# Scaled copies of the page scans for the browser: longest side in pixels per size name
+DERIVATIVE_SIZES = {'thumb': 240, 'web': 1600}
+DERIVATIVE_FORMATS = {'jpeg': '.jpg', 'webp': '.webp'}
+DERIVATIVE_QUALITY = 85
+DERIVATIVE_CACHE_BYTES = 2 * 1024 ** 3
+
+# TF-IDF "more like this": terms must occur in at least SIMILARITY_MIN_DF documents
+# and in at most SIMILARITY_MAX_DF of all documents
+SIMILARITY_MIN_DF = 2
+SIMILARITY_MAX_DF = 0.5
+SIMILARITY_TOP_K = 10
+
+# zlib level for the document content store; decompression speed does not depend on it
+CONTENT_COMPRESSION_LEVEL = 6
+
+# Near-duplicate detection: 64 MinHash slots split into 16 LSH bands of 4
+_WORD = re.compile(r'\w+')
+MINHASH_SHINGLE_SIZE = 5
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_random = random.Random(20251112)  # Fixed seed so signatures are comparable between runs
+_MINHASH_COEFFICIENTS = (_minhash_random.randrange(1, _MINHASH_PRIME), _minhash_random.randrange(0, _MINHASH_PRIME))
+
+
+def split_passages(text: str, passage_size: int = 2000, overlap: int = 200) -> List[Tuple[int, int, str]]:
+    """
+    Split a document into overlapping passages.
+    Returns (start_offset, end_offset, passage) tuples with character offsets
+    into the full document. Boundaries are moved to whitespace where possible
+    so words aren't cut in half.
+    """
+    passages = []
+    length = len(text)
+    start = 0
+    while start < length:
+        end = min(start + passage_size, length)
+        if end < length:
+            # Break after the last whitespace in the overlap region
+            match = None
+            for match in _WHITESPACE.finditer(text, end - overlap, end):
+                pass
+            if match is not None and match.end() > start:
+                end = match.end()
+        passages.append((start, end, text[start:end]))
+        if end >= length:
+            break
+        next_start = max(end - overlap, start + 1)
+        # Start the next passage at the beginning of a word
+        match = _WHITESPACE.search(text, next_start, end)
+        start = match.end() if match is not None else next_start
+    return passages
+
+
+def iter_text_files(root: str, extension: str = ".txt", start_after: str = None):
+    """
+    Walk root depth-first with os.scandir and yield (path, size, mtime_ns) for
+    every matching file as soon as it is found.
+    Stat data comes from the scandir entry, so no extra lookup per file is
+    needed. Entries are visited in sorted order within each directory (files
+    first, then subdirectories), which keeps the walk order stable between
+    runs while memory stays bounded by the largest single directory rather
+    than the whole tree.
+
+    With start_after, everything up to and including that path in walk order
+    is skipped without being stat'ed, and directories that lie entirely
+    before it are not scanned at all.
+    """
+    after = None
+    if start_after:
+        after = os.path.relpath(start_after, root).split(os.sep)
+    pending = [(root, after)]
+    while pending:
+        # after holds the remaining path components of start_after when this
+        # directory is on its path, otherwise None
+        directory, after = pending.pop()
+        try:
+            with os.scandir(directory) as it:
+                # Skip hidden entries, like glob does
+                entries = sorted((entry for entry in it if not entry.name.startswith('.')),
+                                 key=lambda entry: entry.name)
+        except OSError as e:
+            print(f"Error scanning directory {directory}: {str(e)}")
+            continue
+
+        subdirectories = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if after is None or len(after) == 1:
+                        subdirectories.append((entry.path, None))
+                    elif entry.name == after[0]:
+                        subdirectories.append((entry.path, after[1:]))
+                    elif entry.name > after[0]:
+                        subdirectories.append((entry.path, None))
+                elif entry.name.endswith(extension) and entry.is_file():
+                    # Files in directories above start_after, and files sorting
+                    # before it in its own directory, were already visited
+                    if after is not None and (len(after) > 1 or entry.name <= after[0]):
+                        continue
+                    stat = entry.stat()
+                    yield entry.path, stat.st_size, stat.st_mtime_ns
+            except OSError as e:
+                print(f"Error reading directory entry {entry.path}: {str(e)}")
+        # Reversed so the stack pops subdirectories in sorted order
+        pending.extend(reversed(subdirectories))
+
+
+# Search query language: AND, OR, NOT (or -term), "quoted phrases", NEAR(a b, n),
+# column:term qualifiers and prefix* terms, compiled to FTS5 MATCH syntax
+QUERY_COLUMNS = ('content', 'filename', 'filepath')
+_DEFAULT_QUERY_COLUMNS = {'content': ('content',), 'filename': ('filename',), 'all': ('content', 'filename')}
+NEAR_DISTANCE = 10
+_QUERY_TOKEN = re.compile(r'\s*(?:([(),])|"((?:[^"]|"")*)"(\*)?|([^\s(),"]+))')
+_TOKEN_CHARACTERS = re.compile(r'[^\W_]+')
+
+# A compiled search query: the FTS5 MATCH expression, a key that is the same for
+# equivalent queries, the columns named in it and a regex that highlights its terms
+CompiledQuery = namedtuple('CompiledQuery', 'expression cache_key columns highlight')
+
+
+class QuerySyntaxError(ValueError):
+    """A search query the query language can't parse, raised before it reaches SQLite."""
+
+    def __init__(self, message: str, position: int = None):
+        if position is not None:
+            message += f" (at character {position + 1})"
+        super().__init__(message)
+        self.position = position
+
+
+class _QueryParser:
+    """
+    Recursive descent parser for the search query language. Precedence is
+    FTS5's: NOT binds tightest, then AND (also implied between terms), then OR.
+    Leaves are ('phrase', text, prefix, column) and ('near', phrases, distance,
+    column); inner nodes are ('and', children), ('or', children) and
+    ('not', included, excluded), all tuples so they can be deduplicated.
+    """
+
+    def __init__(self, query: str):
+        self.query = query
+        self.tokens = self._tokenize(query)
+        self.index = 0
+
+    @staticmethod
+    def _tokenize(query: str) -> List[Tuple[str, object, int]]:
+        """Split a query into (kind, value, position) tokens."""
+        tokens = []
+        position = 0
+        while position < len(query):
+            match = _QUERY_TOKEN.match(query, position)
+            if match is None:
+                if query[position:].strip():
+                    raise QuerySyntaxError("Unterminated quoted phrase", query.index('"', position))
+                break
+            punctuation, phrase, phrase_prefix, word = match.groups()
+            start = match.end() - len(match.group().lstrip())
+            position = match.end()
+            if punctuation:
+                tokens.append((punctuation, None, start))
+            elif phrase is not None:
+                tokens.append(('phrase', (phrase.replace('""', '"'), bool(phrase_prefix)), start))
+            else:
+                tokens.extend(_QueryParser._word_tokens(word, start, query[position:].lstrip().startswith('(')))
+        return tokens
+
+    @staticmethod
+    def _word_tokens(word: str, start: int, before_parenthesis: bool = False):
+        """
+        Tokens of one unquoted word: an operator, a column qualifier, a
+        negation or a term. NEAR right before a parenthesis starts a NEAR group.
+        """
+        if word in ('AND', 'OR', 'NOT'):
+            return [(word, None, start)]
+        tokens = []
+        if word[0] in '-+' and (len(word) == 1 or word[1] != word[0]):
+            if word[0] == '-':
+                tokens.append(('-', None, start))
+            word, start = word[1:], start + 1
+            if not word:
+                return tokens
+        column, colon, rest = word.partition(':')
+        if colon and column.lower() in QUERY_COLUMNS:
+            tokens.append(('column', column.lower(), start))
+            word, start = rest, start + len(column) + 1
+            if not word:
+                return tokens
+        if word == 'NEAR' and before_parenthesis:
+            return tokens + [('NEAR', None, start)]
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if not word:
+            raise QuerySyntaxError("'*' needs a word before it", start)
+        tokens.append(('phrase', (word, prefix), start))
+        return tokens
+
+    def peek(self):
+        return self.tokens[self.index] if self.index < len(self.tokens) else None
+
+    def advance(self):
+        token = self.peek()
+        self.index += 1
+        return token
+
+    def end_position(self) -> int:
+        """Position reported for errors at the end of the query: the start of its last token."""
+        return self.tokens[-1][2] if self.tokens else 0
+
+    def expect(self, kind: str, message: str):
+        token = self.peek()
+        if token is None or token[0] != kind:
+            raise QuerySyntaxError(message, token[2] if token else self.end_position())
+        return self.advance()
+
+    def expect_operand(self, operator):
+        """Raise unless a term follows the operator token that was just read."""
+        token = self.peek()
+        if token is None or token[0] in ('AND', 'OR', 'NOT', ')', ','):
+            name = "'-'" if operator[0] == '-' else operator[0]
+            raise QuerySyntaxError(f"{name} needs a term after it", operator[2])
+
+    def parse(self):
+        node = self.parse_or()
+        token = self.peek()
+        if token is not None:
+            raise QuerySyntaxError(f"Unexpected '{self.query[token[2]:token[2] + 1]}'", token[2])
+        if node is None:
+            raise QuerySyntaxError("The query has nothing to search for")
+        return node
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        while self.peek() is not None and self.peek()[0] == 'OR':
+            self.expect_operand(self.advance())
+            children.append(self.parse_and())
+        children = [child for child in children if child is not None]
+        return _combine('or', children)
+
+    def parse_and(self):
+        included, excluded = [], []
+        start = self.peek()
+        while True:
+            token = self.peek()
+            if token is None or token[0] in ('OR', ')', ','):
+                break
+            if token[0] == 'AND':
+                self.advance()
+                if not included and not excluded:
+                    raise QuerySyntaxError("AND needs a term before it", token[2])
+                self.expect_operand(token)
+                continue
+            if token[0] == 'NOT' and not included and not excluded:
+                raise QuerySyntaxError("NOT needs a term before it, e.g. epstein NOT island", token[2])
+            if token[0] == '-':
+                self.expect_operand(self.advance())
+                excluded.append(self.parse_unary())
+            else:
+                included.append(self.parse_not())
+        if start is None or (not included and not excluded):
+            position = start[2] if start else self.end_position()
+            raise QuerySyntaxError("Expected a search term", position)
+        included = [node for node in included if node is not None]
+        excluded = [node for node in excluded if node is not None]
+        if excluded and not included:
+            raise QuerySyntaxError("A query needs a term that is not excluded", start[2])
+        node = _combine('and', included)
+        return ('not', node, _combine('or', excluded)) if excluded else node
+
+    def parse_not(self):
+        node = self.parse_unary()
+        while self.peek() is not None and self.peek()[0] == 'NOT':
+            token = self.advance()
+            self.expect_operand(token)
+            excluded = self.parse_unary()
+            if node is None:
+                raise QuerySyntaxError("NOT needs a term before it, e.g. epstein NOT island", token[2])
+            if excluded is not None:
+                node = ('not', node, excluded)
+        return node
+
+    def parse_unary(self):
+        token = self.advance()
+        if token is None:
+            raise QuerySyntaxError("Expected a search term", self.end_position())
+        kind, value, position = token
+        if kind == 'column':
+            node = self.parse_unary()
+            return _with_column(node, value, position) if node is not None else None
+        if kind == '(':
+            node = self.parse_or()
+            self.expect(')', "Missing ')'")
+            return node
+        if kind == 'phrase':
+            return self.phrase(value, position)
+        if kind == 'NEAR':
+            return self.parse_near(position)
+        raise QuerySyntaxError(f"Unexpected '{self.query[position:position + 1]}'", position)
+
+    def phrase(self, value, position):
+        """A phrase leaf; unquoted words without any letters or digits, like '&', are dropped."""
+        text, prefix = value
+        if not _TOKEN_CHARACTERS.search(text):
+            if self.query[position] == '"':
+                raise QuerySyntaxError("Empty phrase", position)
+            return None
+        return ('phrase', text, prefix, None)
+
+    def parse_near(self, position):
+        self.expect('(', "NEAR needs a list of terms, e.g. NEAR(epstein island, 10)")
+        phrases = []
+        distance = NEAR_DISTANCE
+        while self.peek() is not None and self.peek()[0] == 'phrase':
+            token = self.advance()
+            phrase = self.phrase(token[1], token[2])
+            if phrase is not None:
+                phrases.append(phrase)
+        if self.peek() is not None and self.peek()[0] == ',':
+            self.advance()
+            token = self.expect('phrase', "NEAR needs a distance after the comma")
+            if not token[1][0].isdigit() or token[1][1]:
+                raise QuerySyntaxError("The NEAR distance must be a whole number", token[2])
+            distance = int(token[1][0])
+        self.expect(')', "Missing ')' after NEAR")
+        if len(phrases) < 2:
+            raise QuerySyntaxError("NEAR needs at least two terms", position)
+        return ('near', tuple(phrases), distance, None)
+
+
+def _combine(operator: str, children: list):
+    """An AND or OR node over children, or the only child, or None for none."""
+    if not children:
+        return None
+    return children[0] if len(children) == 1 else (operator, tuple(children))
+
+
+def _with_column(node, column: str, position: int):
+    """Apply a column qualifier to every leaf under node."""
+    kind = node[0]
+    if kind in ('phrase', 'near'):
+        if node[3] is not None and node[3] != column:
+            raise QuerySyntaxError(f"Conflicting column filters {column}: and {node[3]}:", position)
+        return node[:3] + (column,)
+    if kind == 'not':
+        return ('not', _with_column(node[1], column, position), _with_column(node[2], column, position))
+    return (kind, tuple(_with_column(child, column, position) for child in node[1]))
+
+
+def _normalize_query(node):
+    """
+    The same query with terms reduced to their lowercased tokens and the
+    operands of AND and OR sorted and deduplicated, for cache keys.
+    """
+    kind = node[0]
+    if kind == 'phrase':
+        return ('phrase', ' '.join(_TOKEN_CHARACTERS.findall(node[1].casefold())), node[2], node[3])
+    if kind == 'near':
+        return ('near', tuple(map(_normalize_query, node[1])), node[2], node[3])
+    if kind == 'not':
+        return ('not', _normalize_query(node[1]), _normalize_query(node[2]))
+    children = []
+    for child in map(_normalize_query, node[1]):
+        # Flatten nested operators of the same kind: a AND (b AND c)
+        children.extend(child[1] if child[0] == kind else [child])
+    return (kind, tuple(sorted(set(children), key=repr)))
+
+
+def _compile_query_node(node, columns: Tuple[str, ...]) -> str:
+    """FTS5 MATCH syntax for a parsed query; leaves without a qualifier search the given columns."""
+    kind = node[0]
+    if kind in ('phrase', 'near'):
+        qualifier = (node[3],) if node[3] else columns
+        column_filter = f"{qualifier[0]} : " if len(qualifier) == 1 else "{" + " ".join(qualifier) + "} : "
+        if kind == 'phrase':
+            return column_filter + _fts_string(node[1], node[2])
+        return column_filter + f"NEAR({' '.join(_fts_string(phrase[1], phrase[2]) for phrase in node[1])}, {node[2]})"
+    group = lambda child: (f"({_compile_query_node(child, columns)})" if child[0] in ('and', 'or', 'not')
+                           else _compile_query_node(child, columns))
+    if kind == 'not':
+        return f"{group(node[1])} NOT {group(node[2])}"
+    return f" {kind.upper()} ".join(group(child) for child in node[1])
+
+
+def _fts_string(text: str, prefix: bool) -> str:
+    """An FTS5 string (a phrase to the tokenizer), optionally a prefix query."""
+    return '"' + text.replace('"', '""') + '"' + ('*' if prefix else '')
+
+
+def _query_highlight(node) -> List[str]:
+    """Regular expressions matching the included terms of a parsed query."""
+    kind = node[0]
+    if kind == 'phrase':
+        tokens = _TOKEN_CHARACTERS.findall(node[1])
+        return [r'\W+'.join(map(re.escape, tokens)) + (r'\w*' if node[2] else '')]
+    if kind == 'near':
+        return [pattern for phrase in node[1] for pattern in _query_highlight(phrase)]
+    if kind == 'not':
+        return _query_highlight(node[1])
+    return [pattern for child in node[1] for pattern in _query_highlight(child)]
+
+
+def _query_columns(node) -> set:
+    """Columns named by qualifiers in a parsed query."""
+    if node[0] in ('phrase', 'near'):
+        return {node[3]} if node[3] else set()
+    children = node[1:] if node[0] == 'not' else node[1]
+    return set().union(*map(_query_columns, children))
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_query(query: str, search_type: str = "content") -> CompiledQuery:
+    """
+    Parse a search query and compile it to FTS5 MATCH syntax.
+
+    Words are ANDed, "quoted text" is a phrase, AND, OR and NOT (uppercase)
+    combine terms with FTS5 precedence, -word excludes a word, word* is a
+    prefix search, NEAR(a b, n) finds terms within n tokens of each other
+    and content:, filename: or filepath: limits a term, phrase or group to a
+    column. Every term is passed to SQLite as a quoted string, so input such
+    as AT&T, O'Brien or e-mail is searched as the phrase of its tokens
+    instead of raising an FTS5 syntax error. Terms without a qualifier
+    search the columns of the search type: content, filename or both for
+    'all'.
+
+    Raises QuerySyntaxError for queries that can't be parsed.
+    """
+    tree = _QueryParser(query).parse()
+    columns = _DEFAULT_QUERY_COLUMNS.get(search_type, ('content',))
+    return CompiledQuery(
+        expression=_compile_query_node(tree, columns),
+        cache_key=_compile_query_node(_normalize_query(tree), columns),
+        columns=frozenset(_query_columns(tree)),
+        highlight='|'.join(dict.fromkeys(_query_highlight(tree)))
+    )
+
+
+def _leaf_columns(node, columns: Tuple[str, ...]) -> set:
+    """Columns the leaves under node search, with unqualified leaves searching columns."""
+    if node[0] in ('phrase', 'near'):
+        return {node[3]} if node[3] else set(columns)
+    children = node[1:] if node[0] == 'not' else node[1]
+    return set().union(*(_leaf_columns(child, columns) for child in children))
+
+
+def _included_leaves(node) -> list:
+    """Phrase and NEAR leaves of a parsed query that are not on the excluded side of a NOT."""
+    if node[0] in ('phrase', 'near'):
+        return [node]
+    if node[0] == 'not':
+        return _included_leaves(node[1])
+    return [leaf for child in node[1] for leaf in _included_leaves(child)]
+
+
+def _phrase_positions(tokens: List[str], phrase) -> List[int]:
+    """Token positions where a phrase leaf starts in a tokenized document."""
+    *head, last = _TOKEN_CHARACTERS.findall(phrase[1].casefold())
+    positions = []
+    for position in range(len(tokens) - len(head)):
+        if tokens[position:position + len(head)] == head:
+            token = tokens[position + len(head)]
+            if token == last or (phrase[2] and token.startswith(last)):
+                positions.append(position)
+    return positions
+
+
+def near_in_text(text: str, near) -> bool:
+    """
+    Check a NEAR leaf of a parsed query against a whole document with FTS5's
+    rule: an instance of every phrase, with at most the NEAR distance in
+    tokens between the end of the first and the start of the last. Tokens
+    are runs of letters and digits, as for the unicode61 tokenizer.
+    """
+    tokens = _TOKEN_CHARACTERS.findall(text.casefold())
+    occurrences = sorted((start, start + len(_TOKEN_CHARACTERS.findall(phrase[1])), index)
+                         for index, phrase in enumerate(near[1])
+                         for start in _phrase_positions(tokens, phrase))
+    # Slide a window over the occurrences in document order; once it holds
+    # every phrase, drop occurrences from its start until it is close enough
+    counts = Counter()
+    first = 0
+    for start, _, index in occurrences:
+        counts[index] += 1
+        while len(counts) == len(near[1]):
+            _, first_end, first_index = occurrences[first]
+            if start - first_end <= near[2]:
+                return True
+            counts[first_index] -= 1
+            if not counts[first_index]:
+                del counts[first_index]
+            first += 1
+    return False
+
+
+# file_ids of the documents with a passage, or a sample index entry, matching an FTS5 expression
+_PASSAGE_DOCUMENTS_SQL = (
+    "SELECT p.file_id FROM passages_fts JOIN passages AS p ON passages_fts.rowid = p.id "
+    "WHERE passages_fts MATCH ?"
+)
+_SAMPLE_DOCUMENTS_SQL = "SELECT rowid FROM text_files_fts WHERE text_files_fts MATCH ?"
+
+
+def _compound(operator: str, queries: list) -> Tuple[str, tuple]:
+    """Combine (sql, params) queries for file_ids with UNION, INTERSECT or EXCEPT."""
+    sql = f" {operator} ".join(f"SELECT * FROM ({query})" for query, _ in queries)
+    return sql, tuple(param for _, params in queries for param in params)
+
+
+def _near_across_passages(conn: sqlite3.Connection, near, within_passages: Tuple[str, tuple]) -> Tuple[str, tuple]:
+    """
+    Query for the documents a NEAR leaf matches across passages: those with
+    every phrase but no single passage matching the NEAR, checked against
+    their full text. Only the first NEAR_MAX_FULL_TEXT_CHECKS of them are
+    checked, so a NEAR that rarely holds over many large documents can miss
+    some of those that span passages.
+    """
+    candidates, params = _compound('INTERSECT', [(_PASSAGE_DOCUMENTS_SQL, (_compile_query_node(phrase, ('content',)),))
+                                                 for phrase in near[1]])
+    sql = f"{candidates} EXCEPT SELECT * FROM ({within_passages[0]}) LIMIT ?"
+    file_ids = [file_id for file_id, in conn.execute(sql, params + within_passages[1] + (NEAR_MAX_FULL_TEXT_CHECKS,))
+                if near_in_text(read_document_window(conn, file_id, 0, document_length(conn, file_id)), near)]
+    return "SELECT value FROM json_each(?)", (json.dumps(file_ids),)
+
+
+def _leaf_documents(conn: sqlite3.Connection, leaf, columns: Tuple[str, ...]) -> Tuple[str, tuple]:
+    """
+    Query for the file_ids of the documents a phrase or NEAR leaf matches.
+    Content is matched on the passage index and the filename and filepath
+    columns on the sample index. The phrases of a NEAR can be in different
+    passages, see _near_across_passages.
+    """
+    searched = (leaf[3],) if leaf[3] else columns
+    queries = []
+    if 'content' in searched:
+        queries.append((_PASSAGE_DOCUMENTS_SQL, (_compile_query_node(leaf[:3] + ('content',), ()),)))
+        if leaf[0] == 'near':
+            queries.append(_near_across_passages(conn, leaf, queries[0]))
+    other = tuple(column for column in searched if column != 'content')
+    if other:
+        queries.append((_SAMPLE_DOCUMENTS_SQL, (_compile_query_node(leaf[:3] + (None,), other),)))
+    return _compound('UNION', queries)
+
+
+def _documents_query(conn: sqlite3.Connection, node, columns: Tuple[str, ...]) -> Tuple[str, tuple]:
+    """
+    Query for the file_ids of the documents a parsed query matches. Each
+    term's documents are looked up separately and combined with compound
+    selects, so AND, NOT and NEAR apply to whole documents, not to single
+    passages, and the sets stay inside SQLite.
+    """
+    kind = node[0]
+    if kind in ('phrase', 'near'):
+        return _leaf_documents(conn, node, columns)
+    if kind == 'not':
+        return _compound('EXCEPT', [_documents_query(conn, node[1], columns),
+                                    _documents_query(conn, node[2], columns)])
+    return _compound('INTERSECT' if kind == 'and' else 'UNION',
+                     [_documents_query(conn, child, columns) for child in node[1]])
+
+
+def _needs_documents(node) -> bool:
+    """
+    Whether a parsed query has to be matched per document before its hits
+    are ranked: it has an AND, NOT or NEAR. The hits of a term, or of terms
+    ORed together, are just the passages and sample entries that match.
+    """
+    if node[0] == 'phrase':
+        return False
+    return node[0] != 'or' or any(map(_needs_documents, node[1]))
+
+
+def query_documents(conn: sqlite3.Connection, query: str, search_type: str = "content") -> set:
+    """
+    file_ids of the documents matching a query (see compile_query), with
+    AND, NOT and NEAR applied to whole documents (see _documents_query).
+    Raises QuerySyntaxError for queries that can't be parsed.
+    """
+    columns = _DEFAULT_QUERY_COLUMNS.get(search_type, ('content',))
+    sql, params = _documents_query(conn, _QueryParser(query).parse(), columns)
+    return {file_id for file_id, in conn.execute(sql, params)}
+
+
+def has_passage_index(conn: sqlite3.Connection) -> bool:
+    """Check whether a database has a populated full-document passage index."""
+    cursor = conn.execute(
+        "SELECT EXISTS(SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'passages')"
+    )
+    if not cursor.fetchone()[0]:
+        return False
+    return conn.execute("SELECT EXISTS(SELECT 1 FROM passages)").fetchone()[0] == 1
+
+
+# Best matching passage of each document, with {documents} an optional
+# condition on p.file_id; bare columns in an aggregate query take their
+# values from the MIN(rank) row
+_PASSAGE_SEARCH_SQL = '''
+    SELECT
+        p.file_id AS file_id,
+        tf.filename AS filename,
+        tf.filepath AS filepath,
+        p.content AS text,
+        p.start_offset AS offset,
+        MIN(passages_fts.rank) AS rank
+    FROM passages_fts
+    JOIN passages AS p ON passages_fts.rowid = p.id
+    JOIN text_files AS tf ON p.file_id = tf.id
+    WHERE passages_fts MATCH ?{documents}
+    GROUP BY p.file_id
+'''
+
+_SAMPLE_SEARCH_SQL = '''
+    SELECT
+        tf.id AS file_id,
+        tf.filename AS filename,
+        tf.filepath AS filepath,
+        tf.content AS text,
+        NULL AS offset,
+        text_files_fts.rank AS rank
+    FROM text_files_fts
+    JOIN text_files AS tf ON text_files_fts.rowid = tf.id
+    WHERE text_files_fts MATCH ?
+'''
+
+# Documents with a passage hit or a sample index hit, keeping the better ranked of the two
+_UNION_SEARCH_SQL = '''
+    SELECT file_id, filename, filepath, text, offset, MIN(rank) AS rank
+    FROM ({passages} UNION ALL {sample})
+    GROUP BY file_id
+'''
+
+# Keeps the best hit of each near-duplicate group and counts the rest of the group
+_COLLAPSE_DUPLICATES_SQL = '''
+    SELECT
+        h.file_id,
+        h.filename,
+        h.filepath,
+        h.text,
+        h.offset,
+        MIN(h.rank) AS rank,
+        CASE WHEN dg.group_id IS NULL THEN 0
+             ELSE (SELECT COUNT(*) - 1 FROM duplicate_group AS g WHERE g.group_id = dg.group_id) END
+    FROM ({hits}) AS h
+    LEFT JOIN duplicate_group AS dg ON dg.file_id = h.file_id
+    GROUP BY COALESCE(dg.group_id, h.file_id)
+'''
+
+
+# Substring hits from the trigram index: the first matching passage of each
+# file, ranked by how many passages match (negative, like bm25, so lower is better)
+_SUBSTRING_SEARCH_SQL = '''
+    SELECT
+        p.file_id AS file_id,
+        tf.filename AS filename,
+        tf.filepath AS filepath,
+        p.content AS text,
+        MIN(p.start_offset) AS offset,
+        -COUNT(*) AS rank
+    FROM passages_trigram
+    JOIN passages AS p ON passages_trigram.rowid = p.id
+    JOIN text_files AS tf ON p.file_id = tf.id
+    WHERE {condition}
+    GROUP BY p.file_id
+'''
+
+
+def substring_condition(query: str) -> Tuple[str, tuple]:
+    """
+    WHERE condition and parameters for a substring search on the trigram index.
+    A query containing * or ? is a case-sensitive GLOB pattern; anything else
+    is matched literally and case-insensitively. LIKE narrows the candidates
+    through the index and instr() drops rows where % or _ in the query matched
+    as LIKE wildcards.
+    """
+    if '*' in query or '?' in query:
+        return "passages_trigram.content GLOB ?", (f"*{query}*",)
+    return ("passages_trigram.content LIKE ? AND instr(lower(passages_trigram.content), lower(?)) > 0",
+            (f"%{query}%", query))
+
+
+def substring_regex(query: str) -> str:
+    """Regular expression that finds a substring query inside a text, for highlighting."""
+    if '*' in query or '?' in query:
+        return "".join('.*?' if c == '*' else '.' if c == '?' else re.escape(c) for c in query)
+    return re.escape(query)
+
+
+def has_trigram_index(conn: sqlite3.Connection) -> bool:
+    """Check whether the trigram companion index exists."""
+    return _has_table(conn, 'passages_trigram')
+
+
+def suggest_terms(conn: sqlite3.Connection, prefix: str, limit: int = SUGGEST_LIMIT) -> List[Tuple[str, int]]:
+    """
+    Indexed terms starting with prefix, most frequent first, as (term, documents).
+    Short prefixes are answered from suggest_prefix, longer ones by a range
+    scan over the vocabulary, so both stay within a few milliseconds.
+    """
+    prefix = prefix.strip().lower()
+    if not prefix or not _has_table(conn, 'vocabulary'):
+        return []
+    if len(prefix) <= SUGGEST_PREFIX_LENGTH and limit <= SUGGEST_LIMIT:
+        cursor = conn.execute(
+            "SELECT term, documents FROM suggest_prefix WHERE prefix = ? ORDER BY position LIMIT ?",
+            (prefix, limit)
+        )
+    else:
+        cursor = conn.execute(
+            "SELECT term, documents FROM vocabulary WHERE term >= ? AND term < ? ORDER BY documents DESC, term LIMIT ?",
+            (prefix, prefix + "\U0010ffff", limit)
+        )
+    return cursor.fetchall()
+
+
+def _deletes(word: str, max_distance: int = SPELL_MAX_DISTANCE) -> set:
+    """The word and every string obtained from it by deleting up to max_distance characters."""
+    deletes = {word}
+    frontier = {word}
+    for _ in range(max_distance):
+        frontier = {candidate[:i] + candidate[i + 1:] for candidate in frontier for i in range(len(candidate))}
+        deletes |= frontier
+    return deletes
+
+
+def edit_distance(first: str, second: str) -> int:
+    """Damerau-Levenshtein distance (optimal string alignment): insertions, deletions, substitutions and transpositions."""
+    previous_row = None
+    row = list(range(len(second) + 1))
+    for i in range(1, len(first) + 1):
+        before, previous_row, row = previous_row, row, [i] + [0] * len(second)
+        for j in range(1, len(second) + 1):
+            cost = first[i - 1] != second[j - 1]
+            row[j] = min(previous_row[j] + 1, row[j - 1] + 1, previous_row[j - 1] + cost)
+            if i > 1 and j > 1 and first[i - 1] == second[j - 2] and first[i - 2] == second[j - 1]:
+                row[j] = min(row[j], before[j - 2] + 1)
+    return row[-1]
+
+
+def spelling_candidates(conn: sqlite3.Connection, word: str,
+                        max_distance: int = SPELL_MAX_DISTANCE) -> List[Tuple[str, int, int]]:
+    """
+    Indexed terms within max_distance edits of word, as (term, distance,
+    documents), closest and most frequent first. The deletes of the word's
+    prefix are looked up in spell_deletes; the hits are then checked with
+    the real edit distance.
+    """
+    deletes = list(_deletes(word[:SPELL_PREFIX_LENGTH], max_distance))
+    placeholders = ",".join("?" * len(deletes))
+    cursor = conn.execute(
+        f'''
+        SELECT DISTINCT d.term, v.documents FROM spell_deletes AS d
+        JOIN vocabulary AS v ON v.term = d.term
+        WHERE d.deletion IN ({placeholders})
+        ''',
+        deletes
+    )
+    candidates = []
+    for term, documents in cursor:
+        if abs(len(term) - len(word)) > max_distance:
+            continue
+        distance = edit_distance(word, term)
+        if distance <= max_distance:
+            candidates.append((term, distance, documents))
+    candidates.sort(key=lambda candidate: (candidate[1], -candidate[2], candidate[0]))
+    return candidates
+
+
+def _query_words(query: str) -> List[Tuple[int, int, bool]]:
+    """
+    Spans of the words in the terms of a query, as (start, end, correctable)
+    in query order. Prefix terms and filename or filepath terms are not
+    correctable, and NEAR distances are not words. Raises QuerySyntaxError
+    for queries compile_query rejects.
+    """
+    parser = _QueryParser(query)
+    parser.parse()
+    words = []
+    for previous, (kind, value, position) in zip([(None, None, None)] + parser.tokens, parser.tokens):
+        if kind != 'phrase' or previous[0] == ',':
+            continue
+        text, prefix = value
+        correctable = not prefix and not (previous[0] == 'column' and previous[1] != 'content')
+        if query[position] == '"':
+            end = _QUERY_TOKEN.match(query, position).end(2)
+            start = position + 1
+        else:
+            start, end = position, position + len(text)
+        words.extend((match.start(), match.end(), correctable)
+                     for match in _TOKEN_CHARACTERS.finditer(query, start, end))
+    return words
+
+
+def spelling_corrections(conn: sqlite3.Connection, query: str, limit: int = 5) -> List[Tuple[str, int, int]]:
+    """
+    Corrected versions of a query, as (query, total edits, documents of the
+    rarest corrected word), best first. Only words of query terms that are
+    not in the vocabulary are corrected, in place, so operators, quotes,
+    column qualifiers and prefix terms come back unchanged. An empty list
+    means there is nothing to suggest, including for queries compile_query
+    rejects.
+    """
+    if not _has_table(conn, 'spell_deletes'):
+        return []
+    try:
+        words = _query_words(query)
+    except QuerySyntaxError:
+        return []
+    options = []
+    for start, end, correctable in words:
+        word = query[start:end].lower()
+        known = not correctable or \
+            conn.execute("SELECT 1 FROM vocabulary WHERE term = ?", (word,)).fetchone() is not None
+        if known:
+            options.append([(query[start:end], 0, None)])
+            continue
+        # Two edits turn most short words into other short words, so allow fewer
+        candidates = spelling_candidates(conn, word, min(SPELL_MAX_DISTANCE, len(word) // 3))[:3]
+        if not candidates:
+            return []
+        options.append(candidates)
+    if all(len(candidates) == 1 and candidates[0][1] == 0 for candidates in options):
+        return []
+
+    corrections = []
+    for combination in itertools.product(*options):
+        distance = sum(candidate[1] for candidate in combination)
+        documents = min((candidate[2] for candidate in combination if candidate[2] is not None), default=0)
+        # Put the corrected words back into the query text, last word first so earlier spans stay valid
+        corrected = query
+        for (start, end, _), candidate in reversed(list(zip(words, combination))):
+            corrected = corrected[:start] + candidate[0] + corrected[end:]
+        corrections.append((corrected, distance, documents))
+    corrections.sort(key=lambda correction: (correction[1], -correction[2], correction[0]))
+    return corrections[:limit]
+
+
+# Documents mentioning one entity, most mentions first; the text is filled in
+# from the first mention by _fill_entity_text
+_ENTITY_SEARCH_SQL = '''
+    SELECT
+        tf.id AS file_id,
+        tf.filename AS filename,
+        tf.filepath AS filepath,
+        NULL AS text,
+        de.offset AS offset,
+        -de.mentions AS rank
+    FROM entities AS e
+    JOIN document_entities AS de ON de.entity_id = e.id
+    JOIN text_files AS tf ON tf.id = de.file_id
+    WHERE e.kind = ? AND e.value = ?
+'''
+
+
+# Keeps only hits from documents that mention a date in the range, through document_dates_date
+_DATE_FILTER_SQL = '''
+    SELECT * FROM ({hits}) AS dated
+    WHERE dated.file_id IN (SELECT file_id FROM document_dates WHERE date BETWEEN ? AND ?)
+'''
+
+
+def _fill_entity_text(conn: sqlite3.Connection, rows):
+    """Fill in the text of entity hits with the document from the first mention on."""
+    return [tuple(row[:3]) + (read_document_window(conn, row[0], row[4], row[4] + 2000),) + tuple(row[4:])
+            for row in rows]
+
+
+def _fill_passage_text(conn: sqlite3.Connection, rows):
+    """
+    Fill in the passage text of hits from the content store. With a
+    contentless passage index the passages table keeps only offsets, so
+    the text column comes back NULL.
+    """
+    if all(row[3] is not None or row[4] is None for row in rows):
+        return rows
+    filled = []
+    for row in rows:
+        if row[3] is None and row[4] is not None:
+            end = conn.execute("SELECT end_offset FROM passages WHERE file_id = ? AND start_offset = ?",
+                               (row[0], row[4])).fetchone()[0]
+            row = tuple(row[:3]) + (read_document_window(conn, row[0], row[4], end),) + tuple(row[4:])
+        filled.append(row)
+    return filled
+
+
+def _has_table(conn: sqlite3.Connection, name: str) -> bool:
+    """Check whether a table exists; databases built by older versions may lack newer tables."""
+    cursor = conn.execute("SELECT EXISTS(SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?)", (name,))
+    return cursor.fetchone()[0] == 1
+
+
+def connect_read_only(db_path: str, immutable: bool = False) -> sqlite3.Connection:
+    """
+    Open a database read-only. With immutable=True SQLite takes no locks and
+    never checks the file for changes, which is only safe for a database
+    that nothing writes to while it is open. The connection may be handed
+    between threads, but used by one at a time.
+    """
+    mode = "ro&immutable=1" if immutable else "ro"
+    return sqlite3.connect(f"file:{db_path}?mode={mode}", uri=True, check_same_thread=False)
+
+
+def query_index(conn: sqlite3.Connection, query: str, search_type: str = "content", limit: int = 10000,
+                collapse_duplicates: bool = False, date_from: str = None, date_to: str = None,
+                immutable: bool = False):
+    """
+    Run one search against a single database.
+    Returns (file_id, filename, filepath, text, offset, rank) rows ordered by
+    rank. Content searches use the passage index when it has been built, in
+    which case text is the best passage and offset its start; otherwise text
+    is the 10 KB sample and offset is None. The boolean operators apply to
+    whole documents (see query_documents): filename and filepath terms are
+    matched on the sample index, and 'all' searches match each term in the
+    content or the filename. Content, filename and all searches take the
+    query language of compile_query and raise QuerySyntaxError for queries
+    it rejects.
+
+    Substring searches match the query (or a GLOB pattern when it contains *
+    or ?) anywhere inside words, through the trigram index. Regex searches
+    treat the query as a Python regular expression; see iter_regex_search.
+    The entity search types (email, phone, amount, person) normalize the
+    query and look it up in the entity tables built with entities=True.
+
+    Filename searches for a Bates number, prefix or range (see
+    parse_bates_query) are answered from the Bates number indexes instead.
+
+    date_from and date_to (YYYY-MM-DD, see date_bound) keep only documents
+    that mention a date in that range, from the dates extracted with
+    dates=True; either may be None for an open range.
+
+    With collapse_duplicates, each near-duplicate group is reduced to its
+    best-ranked hit and rows get a seventh column: the number of other
+    documents in that group.
+
+    Regex searches open their own connections to the database file, in
+    immutable mode when immutable is set (see connect_read_only); pass the
+    mode conn was opened in.
+    """
+    if search_type == "regex":
+        db_path = conn.execute("PRAGMA database_list").fetchone()[2]
+        # Runs in-process: callers that search several databases already parallelize across them
+        rows = sorted(iter_regex_search(db_path, query, workers=1, date_from=date_from, date_to=date_to,
+                                        immutable=immutable),
+                      key=lambda row: row[5])
+        if collapse_duplicates:
+            rows = collapse_duplicate_rows(conn, rows)
+        return rows[:limit]
+
+    if search_type in ENTITY_KINDS:
+        value = normalize_entity(search_type, query)
+        if value is None:
+            return []
+        return _query_hits(conn, _ENTITY_SEARCH_SQL, (search_type, value), limit, collapse_duplicates,
+                           _fill_entity_text, date_from, date_to)
+
+    bates = parse_bates_query(query) if search_type == "filename" else None
+    if bates is not None and _has_bates_columns(conn):
+        condition, params = _bates_condition(bates)
+        return _query_hits(conn, _BATES_SEARCH_SQL.format(condition=condition), params, limit,
+                           collapse_duplicates, _fill_passage_text, date_from, date_to)
+
+    if search_type == "substring":
+        if not has_trigram_index(conn):
+            raise ValueError("Substring search needs the trigram index (index --trigram)")
+        condition, params = substring_condition(query)
+        sql = _SUBSTRING_SEARCH_SQL.format(condition=condition)
+    else:
+        columns = _DEFAULT_QUERY_COLUMNS.get(search_type, ('content',))
+        tree = _QueryParser(query).parse()
+        if 'content' not in _leaf_columns(tree, columns) or not has_passage_index(conn):
+            # The sample index has whole filenames and filepaths, and is all
+            # there is for content without the passage index
+            sql = _SAMPLE_SEARCH_SQL
+            params = (compile_query(query, search_type).expression,)
+        else:
+            # Terms combined with AND, NOT or NEAR match whole documents: find
+            # those first and keep the hits to them
+            passage_filter = sample_filter = ""
+            documents = ()
+            if _needs_documents(tree):
+                documents_sql, documents = _documents_query(conn, tree, columns)
+                passage_filter = f" AND p.file_id IN ({documents_sql})"
+                sample_filter = f" AND tf.id IN ({documents_sql})"
+            # Rank each matching document by its best passage for the included
+            # terms, or by its sample index hit when only its filename matched
+            content_terms, other_terms = [], []
+            for leaf in _included_leaves(tree):
+                searched = (leaf[3],) if leaf[3] else columns
+                if 'content' in searched:
+                    content_terms.extend(_compile_query_node(phrase[:3] + ('content',), ())
+                                         for phrase in (leaf[1] if leaf[0] == 'near' else [leaf]))
+                other = tuple(column for column in searched if column != 'content')
+                if other:
+                    other_terms.append(_compile_query_node(leaf[:3] + (None,), other))
+            passages = _PASSAGE_SEARCH_SQL.format(documents=passage_filter)
+            sample = _SAMPLE_SEARCH_SQL + sample_filter
+            if not other_terms:
+                sql = passages
+                params = (" OR ".join(dict.fromkeys(content_terms)),) + documents
+            elif not content_terms:
+                sql = sample
+                params = (" OR ".join(dict.fromkeys(other_terms)),) + documents
+            else:
+                sql = _UNION_SEARCH_SQL.format(passages=passages, sample=sample)
+                params = ((" OR ".join(dict.fromkeys(content_terms)),) + documents
+                          + (" OR ".join(dict.fromkeys(other_terms)),) + documents)
+
+    return _query_hits(conn, sql, params, limit, collapse_duplicates, _fill_passage_text, date_from, date_to)
+
+
+def _query_hits(conn: sqlite3.Connection, sql: str, params: tuple, limit: int, collapse_duplicates: bool, fill,
+                date_from: str = None, date_to: str = None):
+    """
+    Run a hits query ordered by rank, optionally restricted to a date range
+    and collapsing near-duplicates, and fill in the text column.
+    """
+    if date_from is not None or date_to is not None:
+        sql = _DATE_FILTER_SQL.format(hits=sql)
+        params += (date_from or "0000-00-00", date_to or "9999-99-99")
+    if collapse_duplicates:
+        if not _has_table(conn, 'duplicate_group'):
+            rows = conn.execute(sql + " ORDER BY rank LIMIT ?", params + (limit,)).fetchall()
+            return [tuple(row) + (0,) for row in fill(conn, rows)]
+        sql = _COLLAPSE_DUPLICATES_SQL.format(hits=sql)
+    return fill(conn, conn.execute(sql + " ORDER BY rank LIMIT ?", params + (limit,)).fetchall())
+
+
+def shard_path(db_path: str, volume: str) -> str:
+    """Path of the shard database for a release volume, e.g. text_search.003.db."""
+    root, ext = os.path.splitext(db_path)
+    return f"{root}.{volume}{ext or '.db'}"
+
+
+def find_shards(db_path: str) -> List[str]:
+    """Find the per-volume shard databases that sit next to db_path."""
+    root, ext = os.path.splitext(db_path)
+    directory = os.path.dirname(root) or "."
+    pattern = re.compile(re.escape(os.path.basename(root)) + r"\.\d{3}" + re.escape(ext or ".db") + "$")
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(os.path.dirname(root), name)
+                  for name in os.listdir(directory) if pattern.match(name))
+
+
+def list_volumes(text_directory: str) -> List[str]:
+    """Return the numbered release volume directories (001, 002, ...) inside text_directory."""
+    with os.scandir(text_directory) as it:
+        return sorted(entry.name for entry in it
+                      if entry.is_dir() and re.fullmatch(r"\d{3}", entry.name))
+
+
+# Read-only shard connections kept open by each search worker process, per
+# thread because in-process searches (one worker, spelling corrections) may
+# run in several threads of a web server at once
+_shard_connections = threading.local()
+
+
+def _shard_connection(shard: str, immutable: bool = False) -> sqlite3.Connection:
+    """Read-only connection to a shard, opened once per process and thread."""
+    connections = getattr(_shard_connections, 'connections', None)
+    if connections is None:
+        connections = _shard_connections.connections = {}
+    conn = connections.get(shard)
+    if conn is None:
+        conn = connect_read_only(shard, immutable)
+        connections[shard] = conn
+    return conn
+
+
+def _search_shard(task):
+    """Search one shard database in a worker process; rows are prefixed with the shard path."""
+    shard, immutable, query, search_type, limit, collapse_duplicates, date_from, date_to = task
+    conn = _shard_connection(shard, immutable)
+    rows = query_index(conn, query, search_type, limit, collapse_duplicates, date_from, date_to, immutable)
+    return [(shard,) + tuple(row) for row in rows]
+
+
+class ShardedTextSearch:
+    """
+    Scatter-gather search over per-volume shard databases.
+    Each shard is queried in a process pool and the per-shard hits, already
+    sorted by bm25 rank, are merged and cut to the global limit.
+    """
+
+    def __init__(self, shard_paths: List[str], workers: int = None, immutable: bool = False):
+        self.shard_paths = list(shard_paths)
+        self.workers = workers or min(len(self.shard_paths), os.cpu_count() or 1)
+        self.immutable = immutable  # open the shards immutable, see connect_read_only
+        self.executor = None
+        self.executor_lock = threading.Lock()  # searches may come from several threads
+
+    def search(self, query: str, search_type: str = "content", limit: int = 10000,
+               collapse_duplicates: bool = False, date_from: str = None, date_to: str = None):
+        """
+        Search all shards. Returns (shard, file_id, filename, filepath, text,
+        offset, rank) rows with the same meaning as query_index. Near-duplicate
+        groups are per shard, so collapsing never merges hits across volumes.
+        """
+        if search_type in ("content", "filename", "all"):
+            # Reject bad queries here rather than once per shard in the workers
+            compile_query(query, search_type)
+        tasks = [(shard, self.immutable, query, search_type, limit, collapse_duplicates, date_from, date_to)
+                 for shard in self.shard_paths]
+        if self.workers > 1:
+            with self.executor_lock:
+                if self.executor is None:
+                    self.executor = ProcessPoolExecutor(self.workers)
+                executor = self.executor
+            per_shard = list(executor.map(_search_shard, tasks))
+        else:
+            per_shard = [_search_shard(task) for task in tasks]
+        merged = heapq.merge(*per_shard, key=lambda row: row[6])
+        return list(itertools.islice(merged, limit))
+
+    def spelling_corrections(self, query: str, limit: int = 5, connection=None) -> List[Tuple[str, int, int]]:
+        """
+        Spelling corrections over all shards, like spelling_corrections for a
+        single database. Document counts of the same correction are added up.
+        Dictionary lookups take milliseconds, so this runs in this process,
+        on connections opened once per thread, or borrowed from connection:
+        a function of the shard path returning a context manager for a
+        connection to it, such as a connection pool's.
+        """
+        merged = {}
+        for shard in self.shard_paths:
+            with (connection(shard) if connection else nullcontext(_shard_connection(shard, self.immutable))) as conn:
+                corrections = spelling_corrections(conn, query, limit)
+            for corrected, distance, documents in corrections:
+                best_distance, total = merged.get(corrected, (distance, 0))
+                merged[corrected] = (min(best_distance, distance), total + documents)
+        ranked = sorted(merged.items(), key=lambda item: (item[1][0], -item[1][1], item[0]))
+        return [(corrected, distance, documents) for corrected, (distance, documents) in ranked[:limit]]
+
+    def close(self):
+        """Shut down the worker pool."""
+        with self.executor_lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown()
+
+
+def build_shards(text_directory: str, db_path: str, volumes: List[str] = None, contentless: bool = False,
+                 **index_options):
+    """
+    Build one shard database per release volume directory.
+    Only the listed volumes are touched; without incremental or resume, a
+    volume's shard is rebuilt from scratch, keeping the extraction options
+    and trigram index of the shard it replaces (see _shard_build_options).
+    """
+    available = list_volumes(text_directory)
+    volumes = volumes or available
+    missing = [volume for volume in volumes if volume not in available]
+    if missing:
+        raise ValueError(f"Volume directories not found in {text_directory}: {', '.join(missing)}")
+
+    for volume in volumes:
+        path = shard_path(db_path, volume)
+        print(f"Building shard {path} for volume {volume}")
+        shard_options = dict(index_options)
+        if not index_options.get('incremental') and not index_options.get('resume'):
+            for name, value in _shard_build_options(path).items():
+                if value and not shard_options.get(name):
+                    print(f"Keeping --{name} from the shard being rebuilt")
+                    shard_options[name] = True
+            for suffix in ("", "-wal", "-shm", "-journal"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        shard = TextSearchDatabase(path, contentless=contentless)
+        try:
+            shard.index_text_files(os.path.join(text_directory, volume), **shard_options)
+        finally:
+            shard.close()
+
+
+def _shard_build_options(path: str) -> dict:
+    """
+    The options an existing shard was built with that a rebuild has to keep:
+    the extraction options remembered in index_options and whether it has
+    the trigram index. Empty when there is no shard yet.
+    """
+    if not os.path.exists(path):
+        return {}
+    conn = connect_read_only(path)
+    try:
+        options = dict(conn.execute("SELECT name, value FROM index_options")) \
+            if _has_table(conn, 'index_options') else {}
+        options['trigram'] = has_trigram_index(conn)
+    finally:
+        conn.close()
+    return {name: bool(value) for name, value in options.items()}
+
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    """Decode an SQLite varint at pos, returning (value, position after it)."""
+    value = 0
+    for i in range(8):
+        byte = data[pos + i]
+        value = (value << 7) | (byte & 0x7f)
+        if byte < 0x80:
+            return value, pos + i + 1
+    return (value << 8) | data[pos + 8], pos + 9
+
+
+def fts_segment_levels(conn: sqlite3.Connection, fts_table: str) -> List[Tuple[int, int]]:
+    """
+    Read the FTS5 structure record of fts_table.
+    Returns one (segment count, page count) tuple per b-tree level.
+    """
+    row = conn.execute(f"SELECT block FROM {fts_table}_data WHERE id = 10").fetchone()
+    if row is None:
+        return []
+    data = row[0]
+    pos = 4  # Skip the configuration cookie
+    if data[pos:pos + 4] == b"\xff\x00\x00\x01":
+        structure_v2 = True  # Newer SQLite stores extra per-segment fields
+        pos += 4
+    else:
+        structure_v2 = False
+    level_count, pos = _read_varint(data, pos)
+    _, pos = _read_varint(data, pos)  # Total number of segments
+    _, pos = _read_varint(data, pos)  # Write counter
+
+    levels = []
+    for _ in range(level_count):
+        _, pos = _read_varint(data, pos)  # Segments currently being merged
+        segment_count, pos = _read_varint(data, pos)
+        pages = 0
+        for _ in range(segment_count):
+            _, pos = _read_varint(data, pos)  # Segment id
+            first_page, pos = _read_varint(data, pos)
+            last_page, pos = _read_varint(data, pos)
+            pages += last_page - first_page + 1
+            if structure_v2:
+                for _ in range(5):  # Origin range, tombstone pages and entry counts
+                    _, pos = _read_varint(data, pos)
+        levels.append((segment_count, pages))
+    return levels
+
+
+def minhash_signature(text: str) -> bytes:
+    """
+    MinHash signature of a document over its word shingles, packed as
+    MINHASH_PERMUTATIONS unsigned 32-bit values. Returns None for documents
+    without any words.
+
+    Uses one-permutation hashing: each shingle is hashed once and lands in
+    one of the slots, which keeps the minimum per slot. That costs one hash
+    per shingle instead of one per shingle and permutation. Empty slots are
+    filled from the next non-empty slot so short documents still compare.
+    """
+    words = _WORD.findall(text.lower())
+    if not words:
+        return None
+    slots = MINHASH_PERMUTATIONS
+    minimums = [None] * slots
+    multiplier, increment = _MINHASH_COEFFICIENTS
+    for i in range(max(1, len(words) - MINHASH_SHINGLE_SIZE + 1)):
+        shingle = zlib.crc32(" ".join(words[i:i + MINHASH_SHINGLE_SIZE]).encode('utf-8'))
+        hashed = (multiplier * shingle + increment) % _MINHASH_PRIME
+        slot = hashed % slots
+        value = (hashed // slots) & 0xffffffff
+        if minimums[slot] is None or value < minimums[slot]:
+            minimums[slot] = value
+
+    signature = list(minimums)
+    for slot in range(slots):
+        if minimums[slot] is None:
+            distance = 1
+            while minimums[(slot + distance) % slots] is None:
+                distance += 1
+            # Offset by the distance so borrowed values don't collide by accident
+            signature[slot] = (minimums[(slot + distance) % slots] + distance * 0x9E3779B9) & 0xffffffff
+    return struct.pack(f"<{slots}I", *signature)
+
+
+def minhash_bands(signature: bytes) -> List[Tuple[int, int]]:
+    """Split a signature into LSH bands, returning (band, bucket) pairs."""
+    band_bytes = len(signature) // MINHASH_BANDS
+    return [(band, zlib.crc32(signature[band * band_bytes:(band + 1) * band_bytes]))
+            for band in range(MINHASH_BANDS)]
+
+
+def minhash_similarity(first: bytes, second: bytes) -> float:
+    """Estimate the Jaccard similarity of two documents from their signatures."""
+    first_values = struct.unpack(f"<{MINHASH_PERMUTATIONS}I", first)
+    second_values = struct.unpack(f"<{MINHASH_PERMUTATIONS}I", second)
+    return sum(1 for x, y in zip(first_values, second_values) if x == y) / MINHASH_PERMUTATIONS
+
+
+def normalize_entity(kind: str, text: str) -> str:
+    """
+    Canonical form of an entity, used both for storing extracted mentions and
+    for looking up a query: lowercase emails, phone numbers as NNN-NNN-NNNN,
+    dollar amounts as a plain decimal with cents, capitalized names without
+    initial periods.
+    Returns None when the text is not a valid entity of that kind.
+    """
+    text = text.strip()
+    if kind == 'email':
+        match = _EMAIL.fullmatch(text)
+        return match.group(0).lower() if match else None
+    if kind == 'phone':
+        digits = re.sub(r'\D', '', text)
+        if len(digits) == 11 and digits.startswith('1'):
+            digits = digits[1:]
+        return f"{digits[:3]}-{digits[3:6]}-{digits[6:]}" if len(digits) == 10 else None
+    if kind == 'amount':
+        match = _AMOUNT.fullmatch(text if text.startswith('$') else '$' + text)
+        if not match:
+            return None
+        dollars, cents, scale = match.groups()
+        cents = int((cents or '0').ljust(2, '0'))
+        total = (int(dollars.replace(',', '')) * 100 + cents) * _AMOUNT_SCALE.get((scale or '').lower(), 1)
+        return f"{total // 100}.{total % 100:02d}"
+    if kind == 'person':
+        words = text.replace('.', ' ').split()
+        return " ".join(word[:1].upper() + word[1:].lower() for word in words) if len(words) >= 2 else None
+    raise ValueError(f"Unknown entity kind: {kind}")
+
+
+def extract_entities(text: str) -> List[Tuple[str, str, int, int]]:
+    """
+    Emails, phone numbers, dollar amounts and candidate person names in a
+    document, as (kind, normalized value, offset of the first mention,
+    number of mentions). Person names are any two or three capitalized
+    words that aren't obviously something else, so expect some noise.
+    """
+    found = {}
+
+    def add(kind, value, offset):
+        if value is None:
+            return
+        first, mentions = found.get((kind, value), (offset, 0))
+        found[(kind, value)] = (first, mentions + 1)
+
+    for match in _EMAIL.finditer(text):
+        add('email', match.group(0).lower(), match.start())
+    for match in _PHONE.finditer(text):
+        add('phone', "-".join(match.groups()), match.start())
+    for match in _AMOUNT.finditer(text):
+        add('amount', normalize_entity('amount', match.group(0)), match.start())
+    for match in _PERSON.finditer(text):
+        words = match.group(1).replace('.', '').split()
+        if not any(word in _NOT_NAME_WORDS for word in words):
+            add('person', normalize_entity('person', match.group(1)), match.start())
+    return [(kind, value, offset, mentions) for (kind, value), (offset, mentions) in found.items()]
+
+
+def _iso_date(year: int, month: int, day: int) -> str:
+    """YYYY-MM-DD for a valid date within DATE_YEARS, otherwise None. Two-digit years are 1931-2030."""
+    if year < 100:
+        year += 1900 if year > DATE_YEARS[1] % 100 else 2000
+    if not DATE_YEARS[0] <= year <= DATE_YEARS[1]:
+        return None
+    try:
+        return datetime.date(year, month, day).isoformat()
+    except ValueError:
+        return None
+
+
+def extract_dates(text: str) -> List[str]:
+    """
+    Distinct dates mentioned in a document as sorted YYYY-MM-DD strings.
+    Recognizes 2004-08-17, 8/17/2004 and 8/17/04 (month first), August 17,
+    2004 and 17 August 2004, with abbreviated month names too.
+    """
+    dates = set()
+    for year, month, day in _ISO_DATE.findall(text):
+        dates.add(_iso_date(int(year), int(month), int(day)))
+    for month, day, year in _US_DATE.findall(text):
+        dates.add(_iso_date(int(year), int(month), int(day)))
+    for month, day, year in _MONTH_DAY_YEAR.findall(text):
+        dates.add(_iso_date(int(year), _MONTHS[month.lower()], int(day)))
+    for day, month, year in _DAY_MONTH_YEAR.findall(text):
+        dates.add(_iso_date(int(year), _MONTHS[month.lower()], int(day)))
+    dates.discard(None)
+    return sorted(dates)
+
+
+def date_bound(text: str, end: bool = False) -> str:
+    """
+    Normalize a from/to filter value (YYYY, YYYY-MM or YYYY-MM-DD) to a date
+    string; with end=True a year or month stands for its last day. Raises
+    ValueError for anything else.
+    """
+    message = f"Invalid date: {text!r} (use YYYY, YYYY-MM or YYYY-MM-DD)"
+    match = re.fullmatch(r'(\d{4})(?:-(\d{1,2})(?:-(\d{1,2}))?)?', text.strip())
+    if not match:
+        raise ValueError(message)
+    year, month, day = match.groups()
+    try:
+        if day is None:
+            month_number = int(month) if month else (12 if end else 1)
+            first = datetime.date(int(year), month_number, 1)  # Checks the month for end=True as well
+            if end:
+                return first.replace(day=calendar.monthrange(first.year, month_number)[1]).isoformat()
+            return first.isoformat()
+        return datetime.date(int(year), int(month), int(day)).isoformat()
+    except ValueError as e:
+        # Out-of-range parts, e.g. month 13 or February 30
+        raise ValueError(f"{message}: {e}") from None
+
+
+def entity_regex(kind: str, value: str) -> str:
+    """Regular expression that finds the mentions of a normalized entity in a text, for highlighting."""
+    if kind == 'phone':
+        area, exchange, line = value.split('-')
+        return rf'\(?{area}\)?[\s.-]?{exchange}[\s.-]{line}'
+    if kind == 'amount':
+        return _AMOUNT.pattern
+    return r'\.?\s+'.join(re.escape(word) for word in value.split())
+
+
+def parse_bates(filename: str) -> Tuple[str, int, str]:
+    """
+    Split a Bates-numbered filename into (prefix, number, digits):
+    HOUSE_OVERSIGHT_010477.txt gives ('HOUSE_OVERSIGHT', 10477, '010477').
+    Returns (None, None, None) for filenames that don't end in a number.
+    """
+    match = _BATES_FILENAME.fullmatch(filename)
+    if not match:
+        return None, None, None
+    prefix, digits = match.groups()
+    return _bates_prefix(prefix), int(digits), digits
+
+
+def _bates_prefix(prefix: str) -> str:
+    """Normalize a Bates prefix: uppercase with underscores, so 'House Oversight' matches HOUSE_OVERSIGHT."""
+    return re.sub(r'[\s\-]+', '_', prefix).upper() if prefix else None
+
+
+def parse_bates_query(query: str):
+    """
+    Parse a Bates number lookup, with or without its prefix:
+    010477 (exact), 0104* (digit prefix) or 010400-010500 (inclusive range,
+    also with an en dash, '..' or 'to'). Returns (kind, prefix, first, last)
+    where kind is 'exact', 'prefix' or 'range', first and last are numbers
+    (digit strings for 'prefix'), or None when the query isn't a Bates lookup.
+    """
+    match = _BATES_QUERY.fullmatch(query.strip())
+    if not match:
+        return None
+    prefix, first, suffix, last = match.groups()
+    prefix = _bates_prefix(prefix)
+    if suffix == '*':
+        return 'prefix', prefix, first, first
+    if last is not None:
+        return 'range', prefix, int(first), int(last)
+    return 'exact', prefix, int(first), int(first)
+
+
+# Documents by Bates number, in number order (the number doubles as the rank)
+_BATES_SEARCH_SQL = '''
+    SELECT
+        tf.id AS file_id,
+        tf.filename AS filename,
+        tf.filepath AS filepath,
+        tf.content AS text,
+        NULL AS offset,
+        tf.bates_number AS rank
+    FROM text_files AS tf
+    WHERE {condition}
+'''
+
+
+def _bates_condition(parsed) -> Tuple[str, tuple]:
+    """WHERE condition and parameters on the text_files Bates indexes for a parse_bates_query result."""
+    kind, prefix, first, last = parsed
+    if kind == 'prefix':
+        condition, params = "tf.bates_digits >= ? AND tf.bates_digits < ?", (first, first + ":")  # ':' sorts after '9'
+    else:
+        condition, params = "tf.bates_number BETWEEN ? AND ?", (min(first, last), max(first, last))
+    if prefix is not None:
+        condition += " AND tf.bates_prefix = ?"
+        params += (prefix,)
+    return condition, params
+
+
+def _has_bates_columns(conn: sqlite3.Connection) -> bool:
+    """Check whether text_files has the Bates number columns (added by TextSearchDatabase.create_tables)."""
+    return any(column[1] == 'bates_number' for column in conn.execute("PRAGMA table_info(text_files)"))
+
+
+def has_image_manifest(conn: sqlite3.Connection) -> bool:
+    """Check whether the page image manifest has been built, from image directories or release archives."""
+    return any(_has_table(conn, table) and conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is not None
+               for table in ('image_manifest', 'archive_members'))
+
+
+def lookup_image(conn: sqlite3.Connection, txt_path: str) -> Tuple[str, str, str, str]:
+    """
+    Find the page scan for a text file in the image manifest.
+    Returns (image_path, volume, filename, format) or None; image_path is
+    None for a scan that is only inside a release archive. As with the old
+    directory probing, a scan in the text file's own volume wins, then the
+    lowest volume, then an unzipped scan, then JPEG over PNG, GIF and TIFF.
+    """
+    base_name = os.path.splitext(os.path.basename(txt_path))[0]
+    match = re.search(r'/TEXT/(\d{3})/', txt_path)
+    volume = match.group(1) if match else None
+    rows = []
+    if _has_table(conn, 'image_manifest'):
+        rows += conn.execute(
+            "SELECT image_path, volume, filename, format FROM image_manifest WHERE base_name = ?", (base_name,)
+        ).fetchall()
+    if _has_table(conn, 'archive_members'):
+        rows += conn.execute(
+            "SELECT NULL, volume, filename, format FROM archive_members WHERE base_name = ?", (base_name,)
+        ).fetchall()
+    if not rows:
+        return None
+    return min(rows, key=lambda row: (row[1] != volume, row[1], row[0] is None,
+                                      _IMAGE_FORMAT_ORDER.index(row[3]), row[2]))
+
+
+def lookup_image_file(conn: sqlite3.Connection, volume: str, filename: str) -> str:
+    """Path of a page scan by volume and filename from the image manifest, or None."""
+    if not _has_table(conn, 'image_manifest'):
+        return None
+    row = conn.execute(
+        "SELECT image_path FROM image_manifest WHERE volume = ? AND filename = ? ORDER BY image_path LIMIT 1",
+        (volume, filename)
+    ).fetchone()
+    return row[0] if row else None
+
+
+_ARCHIVE_SCAN_COLUMNS = 'archive, member, data_offset, compressed_size, compress_type, crc, format'
+
+
+def lookup_archive_member(conn: sqlite3.Connection, volume: str, filename: str) -> ArchiveScan:
+    """Location of a page scan inside a release archive by volume and filename, or None."""
+    if not _has_table(conn, 'archive_members'):
+        return None
+    row = conn.execute(
+        f"SELECT {_ARCHIVE_SCAN_COLUMNS} FROM archive_members WHERE volume = ? AND filename = ? "
+        "ORDER BY archive, member LIMIT 1", (volume, filename)
+    ).fetchone()
+    return ArchiveScan(*row) if row else None
+
+
+def read_archive_member(scan: ArchiveScan) -> bytes:
+    """
+    Read a page scan out of its zip archive with one seek and one read, using
+    the offsets recorded in archive_members instead of parsing the central
+    directory. Raises ValueError when the data no longer matches its CRC
+    (the archive was replaced since the manifest was refreshed).
+    """
+    with open(scan.archive, 'rb') as f:
+        f.seek(scan.data_offset)
+        data = f.read(scan.compressed_size)
+    if scan.compress_type == zipfile.ZIP_DEFLATED:
+        data = zlib.decompress(data, -15)
+    if zlib.crc32(data) != scan.crc:
+        raise ValueError(f"{scan.archive} changed since the image manifest was refreshed")
+    return data
+
+
+def _archive_members(archive: str, default_volume: str):
+    """
+    Yield (member, volume, filename, base_name, format, data_offset, compressed_size,
+    file_size, compress_type, crc) for every page scan in a zip archive.
+    The volume is the first three-digit directory in the member's path, or
+    default_volume for members outside one. Members that are encrypted or
+    compressed with anything but deflate are skipped, since they can't be
+    read with a single seek.
+    """
+    with open(archive, 'rb') as f, zipfile.ZipFile(f) as zf:
+        for info in zf.infolist():
+            if info.is_dir() or info.flag_bits & 0x1 or \
+                    info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                continue
+            directory, filename = os.path.split(info.filename)
+            base_name, ext = os.path.splitext(filename)
+            image_format = IMAGE_FORMATS.get(ext.lower())
+            if image_format is None:
+                continue
+            volume = next((part for part in directory.split('/') if re.fullmatch(r'\d{3}', part)), default_volume)
+            # The data starts after the local header, whose extra field can differ from the central directory's
+            f.seek(info.header_offset)
+            header = f.read(30)
+            if header[:4] != b'PK\x03\x04':
+                continue
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            yield (info.filename, volume, filename, base_name, image_format,
+                   info.header_offset + 30 + name_length + extra_length,
+                   info.compress_size, info.file_size, info.compress_type, info.CRC)
+
+
+def render_derivative(image_path: str, target_path: str, max_side: int, image_format: str = 'jpeg',
+                      quality: int = DERIVATIVE_QUALITY) -> int:
+    """
+    Write a copy of a page scan scaled down to fit max_side pixels, as JPEG
+    or WebP. image_path is a file or an ArchiveScan. Multi-page TIFFs use
+    their first page. The copy is written to a unique temporary file next to
+    target_path and renamed, so readers never see a partial file and threads
+    or processes rendering the same copy don't write over each other.
+    Returns the size of the copy in bytes.
+    """
+    if Image is None:
+        raise RuntimeError("Image derivatives need Pillow (pip install Pillow)")
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    if isinstance(image_path, ArchiveScan):
+        image_path = io.BytesIO(read_archive_member(image_path))
+    with Image.open(image_path) as image:
+        image.draft('RGB', (max_side, max_side))  # JPEG sources decode at a reduced scale
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.thumbnail((max_side, max_side))
+        descriptor, temporary = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(target_path))
+        try:
+            with os.fdopen(descriptor, 'wb') as f:
+                image.save(f, format=image_format.upper(), quality=quality)
+            os.replace(temporary, target_path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+    return os.path.getsize(target_path)
+
+
+def _render_derivative_task(task):
+    """Render one derivative in a worker process; returns (bytes written, error message or None)."""
+    image_path, target_path, max_side, image_format, quality = task
+    try:
+        return render_derivative(image_path, target_path, max_side, image_format, quality), None
+    except Exception as e:
+        return 0, f"{_scan_name(image_path)}: {e}"
+
+
+def _scan_name(image_path) -> str:
+    """Path of a scan for messages and cache keys; archive members are named inside their archive."""
+    if isinstance(image_path, ArchiveScan):
+        return f"{os.path.abspath(image_path.archive)}/{image_path.member}"
+    return os.path.abspath(image_path)
+
+
+def scan_identity(image_path) -> Tuple[str, int]:
+    """
+    Identity of a page scan (a file or an ArchiveScan) for cache keys and
+    HTTP validators, with one stat: (path and version, mtime in ns). Files
+    are versioned by size and mtime, archive members by size and CRC, with
+    the archive's mtime.
+    """
+    if isinstance(image_path, ArchiveScan):
+        return (f"{_scan_name(image_path)}\0{image_path.compressed_size}\0{image_path.crc}",
+                os.stat(image_path.archive).st_mtime_ns)
+    stat = os.stat(image_path)
+    return f"{_scan_name(image_path)}\0{stat.st_size}\0{stat.st_mtime_ns}", stat.st_mtime_ns
+
+
+class DerivativeCache:
+    """
+    Size-bounded directory of scaled JPEG/WebP copies of the page scans.
+
+    Cached files are named after the scan's path, size and mtime (CRC for a
+    scan inside a release archive) and the rendition settings, so a replaced
+    scan or a changed setting never gets a stale copy. Every hit bumps the
+    file's mtime; once the cache grows past max_bytes the least recently
+    used files are deleted until it is under 90% of the limit.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = DERIVATIVE_CACHE_BYTES, image_format: str = 'jpeg',
+                 quality: int = DERIVATIVE_QUALITY, sizes: dict = None):
+        if image_format not in DERIVATIVE_FORMATS:
+            raise ValueError(f"Unsupported derivative format: {image_format}")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.image_format = image_format
+        self.quality = quality
+        self.sizes = dict(sizes or DERIVATIVE_SIZES)
+        self.total_bytes = None  # Counted from disk the first time a file is added
+        self.lock = threading.RLock()  # The web UI renders from several threads
+
+    def path_for(self, image_path, size_name: str, identity: str = None) -> str:
+        """
+        Cache path of the size_name rendition of a scan (a file or an
+        ArchiveScan); identity is its scan_identity, when already known.
+        """
+        if identity is None:
+            identity = scan_identity(image_path)[0]
+        key = hashlib.sha1(
+            f"{identity}\0{self.sizes[size_name]}\0{self.quality}".encode('utf-8')
+        ).hexdigest()
+        return os.path.join(self.directory, size_name, key[:2], key + DERIVATIVE_FORMATS[self.image_format])
+
+    def get(self, image_path, size_name: str, identity: str = None) -> str:
+        """Path of the size_name rendition of a scan, rendering it on the first request."""
+        target_path = self.path_for(image_path, size_name, identity)
+        try:
+            os.utime(target_path)  # Mark as recently used
+            return target_path
+        except FileNotFoundError:
+            pass
+        self._added(render_derivative(image_path, target_path, self.sizes[size_name],
+                                      self.image_format, self.quality))
+        return target_path
+
+    def _added(self, size_bytes: int):
+        """Account for newly written files and evict when the cache is over its limit."""
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = self.usage()
+            else:
+                self.total_bytes += size_bytes
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def _files(self) -> List[Tuple[int, int, str]]:
+        """(mtime_ns, size, path) of every cached file, leaving out copies still being written."""
+        files = []
+        for directory, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:  # Evicted by another process
+                    continue
+                files.append((stat.st_mtime_ns, stat.st_size, path))
+        return files
+
+    def usage(self) -> int:
+        """Bytes currently used by the cache."""
+        return sum(size for _, size, _ in self._files())
+
+    def evict(self, limit: int = None) -> int:
+        """Delete least recently used files until the cache is under limit bytes; returns the number deleted."""
+        if limit is None:
+            limit = int(self.max_bytes * 0.9)
+        with self.lock:
+            files = sorted(self._files())
+            total = sum(size for _, size, _ in files)
+            removed = 0
+            for _, size, path in files:
+                if total <= limit:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+            self.total_bytes = total
+        return removed
+
+    def generate(self, image_paths, size_names: List[str] = None, workers: int = None) -> dict:
+        """
+        Render the missing renditions of many scans in a process pool.
+        Returns counts of the renditions rendered, already cached and failed.
+        """
+        start_time = time.perf_counter()
+        size_names = size_names or list(self.sizes)
+        stats = dict(rendered=0, cached=0, failed=0)
+        tasks = []
+        for image_path in image_paths:
+            for size_name in size_names:
+                try:
+                    target_path = self.path_for(image_path, size_name)
+                except OSError as e:
+                    print(f"Error reading {_scan_name(image_path)}: {e}")
+                    stats['failed'] += 1
+                    continue
+                if os.path.exists(target_path):
+                    stats['cached'] += 1
+                else:
+                    tasks.append((image_path, target_path, self.sizes[size_name], self.image_format, self.quality))
+
+        written = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for done, (size_bytes, error) in enumerate(executor.map(_render_derivative_task, tasks, chunksize=8), 1):
+                if error:
+                    print(f"Error rendering {error}")
+                    stats['failed'] += 1
+                else:
+                    stats['rendered'] += 1
+                    written += size_bytes
+                if done % 500 == 0:
+                    print(f"Rendered {done}/{len(tasks)} derivatives...")
+        if tasks:
+            self._added(written)
+        stats['seconds'] = time.perf_counter() - start_time
+        return stats
+
+
+def _decode_text(data) -> str:
+    """Decode file bytes exactly like open(..., 'r', encoding='utf-8', errors='ignore') would."""
+    with io.TextIOWrapper(io.BytesIO(data), encoding='utf-8', errors='ignore') as text:
+        return text.read()
+
+
+def _extract_text_file(task):
+    """
+    Read, hash and decode a single text file for indexing.
+    Runs in a worker process when indexing in parallel, so it must stay a
+    module-level function and return plain picklable data.
+    """
+    file_path, options = task
+    doc = {
+        'filename': os.path.basename(file_path),
+        'filepath': file_path,
+        'content': "",
+        'size': -1,
+        'mtime_ns': -1,
+        'content_hash': "",
+        'passages': [],
+        'minhash': None,
+        'entities': [],
+        'dates': [],
+        'length': 0,
+        'stored_content': None,
+    }
+    try:
+        with open(file_path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            data = f.read()
+    except Exception as e:
+        print(f"Error reading file {file_path}: {str(e)}")
+        return doc
+
+    doc['size'] = stat.st_size
+    doc['mtime_ns'] = stat.st_mtime_ns
+    doc['content_hash'] = hashlib.blake2b(data, digest_size=16).hexdigest()
+    full_text = _decode_text(data)
+    # Keep only the first part of the file for the sample-based index
+    doc['content'] = full_text[:options['content_sample_size']]
+    if options['passages']:
+        doc['passages'] = split_passages(full_text, options['passage_size'], options['passage_overlap'])
+    if options['dedupe']:
+        doc['minhash'] = minhash_signature(full_text)
+    if options['entities']:
+        doc['entities'] = extract_entities(full_text)
+    if options['dates']:
+        doc['dates'] = extract_dates(full_text)
+    if options['store_content']:
+        # Compress in the worker so the writer only copies bytes
+        doc['length'] = len(full_text)
+        doc['stored_content'] = zlib.compress(full_text.encode('utf-8'), CONTENT_COMPRESSION_LEVEL)
+    return doc
+
+
+def has_content_store(conn: sqlite3.Connection) -> bool:
+    """Check whether full document text is stored in the database."""
+    return _has_table(conn, 'document_content') and \
+        conn.execute("SELECT 1 FROM document_content LIMIT 1").fetchone() is not None
+
+
+def load_document(conn: sqlite3.Connection, file_id: int) -> str:
+    """Full text of a document from the content store, or None if it is not stored."""
+    row = conn.execute("SELECT data FROM document_content WHERE file_id = ?", (file_id,)).fetchone() \
+        if _has_table(conn, 'document_content') else None
+    if row is None:
+        return None
+    return zlib.decompress(row[0]).decode('utf-8')
+
+
+def load_document_by_path(conn: sqlite3.Connection, filepath: str) -> str:
+    """Full text of an indexed file from the content store, or None if it is not stored."""
+    row = conn.execute("SELECT file_id FROM file_manifest WHERE filepath = ?", (filepath,)).fetchone() \
+        if _has_table(conn, 'file_manifest') else None
+    if row is None:
+        return None
+    return load_document(conn, row[0])
+
+
+def document_version(conn: sqlite3.Connection, filepath: str) -> Tuple[str, int]:
+    """(content hash, mtime in ns) of an indexed file with stored content, or None."""
+    if not has_content_store(conn):
+        return None
+    return conn.execute("SELECT content_hash, mtime_ns FROM file_manifest WHERE filepath = ?", (filepath,)).fetchone()
+
+
+def read_document_window(conn: sqlite3.Connection, file_id: int, start: int, end: int) -> str:
+    """
+    Text of a document between two character offsets, from the content store
+    when the document is stored there and reassembled from its passages otherwise.
+    """
+    text = load_document(conn, file_id)
+    if text is not None:
+        return text[start:end]
+    cursor = conn.execute(
+        '''
+        SELECT start_offset, end_offset, content FROM passages
+        WHERE file_id = ? AND end_offset > ? AND start_offset < ?
+        ORDER BY start_offset
+        ''',
+        (file_id, start, end)
+    )
+    pieces = []
+    position = start
+    for passage_start, passage_end, content in cursor:
+        if passage_end <= position:
+            continue
+        piece_end = min(end, passage_end)
+        pieces.append(content[position - passage_start:piece_end - passage_start])
+        position = piece_end
+        if position >= end:
+            break
+    return "".join(pieces)
+
+
+def document_length(conn: sqlite3.Connection, file_id: int) -> int:
+    """Length in characters of a document in the content store or passage index."""
+    if _has_table(conn, 'document_content'):
+        row = conn.execute("SELECT length FROM document_content WHERE file_id = ?", (file_id,)).fetchone()
+        if row is not None:
+            return row[0]
+    return conn.execute("SELECT COALESCE(MAX(end_offset), 0) FROM passages WHERE file_id = ?",
+                        (file_id,)).fetchone()[0]
+
+
+def regex_literals(pattern: str) -> List[List[str]]:
+    """
+    Literal strings any match of a regular expression must contain, as a list
+    of alternatives per requirement: [["abc"], ["def", "ghi"]] means a match
+    contains "abc" and either "def" or "ghi". Only literals of at least three
+    characters are kept, since shorter ones give the trigram index nothing
+    to look up. An empty list means the pattern has no usable literal.
+    """
+    def analyze(items):
+        required = []
+        run = []
+
+        def flush():
+            if len(run) >= 3:
+                required.append(["".join(run)])
+            run.clear()
+
+        for op, av in items:
+            if op is sre_parse.LITERAL:
+                run.append(chr(av))
+                continue
+            flush()
+            if op is sre_parse.SUBPATTERN:
+                required.extend(analyze(av[-1]))
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+                required.extend(analyze(av[2]))
+            elif op is sre_parse.BRANCH:
+                # Each branch has to contribute one literal, otherwise the branch is unconstrained
+                alternatives = []
+                for branch in av[1]:
+                    branch_required = analyze(branch)
+                    if not branch_required:
+                        alternatives = None
+                        break
+                    alternatives.extend(max(branch_required, key=lambda options: min(map(len, options))))
+                if alternatives:
+                    required.append(alternatives)
+        flush()
+        return required
+
+    return analyze(sre_parse.parse(pattern))
+
+
+def regex_candidates(conn: sqlite3.Connection, pattern: str, date_from: str = None,
+                     date_to: str = None) -> List[Tuple[int, str, str]]:
+    """
+    Documents that can contain a match of the pattern, as (file_id, filename,
+    filepath). With the trigram index, each required literal is looked up
+    separately and the file sets intersected, so a match may span passages.
+    Without the index, or without a usable literal, every document is a candidate.
+    With date_from or date_to, only documents mentioning a date in the range are.
+    """
+    candidates = None
+    if has_trigram_index(conn):
+        for alternatives in regex_literals(pattern):
+            fts_query = " OR ".join('"' + literal.replace('"', '""') + '"' for literal in alternatives)
+            cursor = conn.execute(
+                '''
+                SELECT DISTINCT p.file_id FROM passages_trigram
+                JOIN passages AS p ON passages_trigram.rowid = p.id
+                WHERE passages_trigram MATCH ?
+                ''',
+                (fts_query,)
+            )
+            file_ids = {file_id for file_id, in cursor}
+            candidates = file_ids if candidates is None else candidates & file_ids
+    if date_from is not None or date_to is not None:
+        cursor = conn.execute("SELECT DISTINCT file_id FROM document_dates WHERE date BETWEEN ? AND ?",
+                              (date_from or "0000-00-00", date_to or "9999-99-99"))
+        file_ids = {file_id for file_id, in cursor}
+        candidates = file_ids if candidates is None else candidates & file_ids
+    rows = conn.execute("SELECT id, filename, filepath FROM text_files ORDER BY id").fetchall()
+    if candidates is None:
+        return rows
+    return [row for row in rows if row[0] in candidates]
+
+
+# Read-only connections of a regex verification pool worker process, by
+# (db_path, immutable), so one pool can serve searches of any database;
+# in-process searches pass their own to _verify_document, since several
+# threads may be searching at once
+_regex_worker = {}
+
+
+def _verify_regex(task):
+    """
+    Pool worker entry point: _verify_document for a chunk of candidates,
+    with this worker's connection to the task's database. Candidates still
+    queued when their search's deadline has passed are skipped.
+    """
+    db_path, immutable, pattern, deadline, chunk = task
+    if deadline is not None and time.time() > deadline:
+        return []
+    conn = _regex_worker.get((db_path, immutable))
+    if conn is None:
+        conn = _regex_worker[(db_path, immutable)] = connect_read_only(db_path, immutable)
+    regex = re.compile(pattern)
+    return [_verify_document(conn, regex, file_id, filepath) for file_id, filepath in chunk]
+
+
+def _verify_document(conn: sqlite3.Connection, regex, file_id: int, filepath: str):
+    """
+    Search one candidate document for the pattern. Returns (file_id, offset
+    of the first match, number of matches, text from the first match on),
+    or None when the document doesn't match.
+
+    The text comes from the content store when the database has one;
+    otherwise the file is memory-mapped instead of read into a buffer.
+    """
+    text = load_document(conn, file_id)
+    if text is None:
+        try:
+            with open(filepath, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    text = _decode_text(data)
+        except OSError as e:
+            print(f"Error reading file {filepath}: {str(e)}")
+            return None
+    matches = regex.finditer(text)
+    first = next(matches, None)
+    if first is None:
+        return None
+    count = 1 + sum(1 for _ in matches)
+    return file_id, first.start(), count, text[first.start():first.start() + 2000]
+
+
+def iter_regex_search(db_path: str, pattern: str, limit: int = None, workers: int = None,
+                      date_from: str = None, date_to: str = None, immutable: bool = False,
+                      pool=None, timeout: float = None, max_candidates: int = None):
+    """
+    Search documents for a regular expression, yielding
+    (file_id, filename, filepath, text, offset, rank) rows as soon as each
+    match is confirmed, in no particular order. Candidates come from the
+    trigram index; verification runs in a pool of worker processes.
+    text starts at the first match, offset is its character position and
+    rank is minus the number of matches, so rows sort like bm25 ranks.
+    immutable opens the database immutable, see connect_read_only.
+
+    pool is a multiprocessing.Pool to verify in instead of one started for
+    this search, e.g. one shared by the requests of a server. With timeout
+    (in seconds), TimeoutError is raised once the search has run that long;
+    a worker of a shared pool may still be busy with a slow document then,
+    so the caller should replace the pool. max_candidates verifies only the
+    first that many candidate files.
+    """
+    regex = re.compile(pattern)  # Fail here, not in the workers, on a bad pattern
+    deadline = time.time() + timeout if timeout is not None else None
+    conn = connect_read_only(db_path, immutable)
+    try:
+        candidates = regex_candidates(conn, regex.pattern, date_from, date_to)
+    finally:
+        conn.close()
+    if max_candidates is not None and len(candidates) > max_candidates:
+        print(f"Verifying the first {max_candidates} of {len(candidates)} candidate files for {pattern!r}")
+        candidates = candidates[:max_candidates]
+    names = {file_id: (filename, filepath) for file_id, filename, filepath in candidates}
+    tasks = [(file_id, filepath) for file_id, _, filepath in candidates]
+    workers = workers or os.cpu_count() or 1
+
+    own_pool = conn = None
+    if pool is None and workers > 1 and len(tasks) > 1:
+        pool = own_pool = multiprocessing.Pool(min(workers, len(tasks)))
+    if pool is not None:
+        # Chunked here rather than with imap's chunksize, whose iterator has no timeout
+        chunks = ((db_path, immutable, pattern, deadline, tasks[start:start + 16])
+                  for start in range(0, len(tasks), 16))
+        pending = pool.imap_unordered(_verify_regex, chunks)
+
+        def verified():
+            while True:
+                try:
+                    yield from pending.next(None if deadline is None else max(deadline - time.time(), 0))
+                except StopIteration:
+                    return
+                except multiprocessing.TimeoutError:
+                    raise TimeoutError(f"Regex search ran longer than {timeout} seconds") from None
+    else:
+        conn = connect_read_only(db_path, immutable)
+
+        def verified():
+            for file_id, filepath in tasks:
+                if deadline is not None and time.time() > deadline:
+                    raise TimeoutError(f"Regex search ran longer than {timeout} seconds")
+                yield _verify_document(conn, regex, file_id, filepath)
+    try:
+        found = 0
+        for result in verified():
+            if result is None:
+                continue
+            file_id, offset, count, text = result
+            filename, filepath = names[file_id]
+            yield file_id, filename, filepath, text, offset, -count
+            found += 1
+            if limit is not None and found >= limit:
+                break
+    finally:
+        if own_pool is not None:
+            own_pool.terminate()
+            own_pool.join()
+        elif conn is not None:
+            conn.close()
+
+
+def collapse_duplicate_rows(conn: sqlite3.Connection, rows):
+    """
+    Python counterpart of _COLLAPSE_DUPLICATES_SQL for hits that don't come
+    from SQL: keep the best-ranked row of each near-duplicate group and append
+    the number of other documents in the group.
+    """
+    groups = {}
+    if _has_table(conn, 'duplicate_group'):
+        groups = dict(conn.execute("SELECT file_id, group_id FROM duplicate_group"))
+    sizes = {}
+    for group_id in groups.values():
+        sizes[group_id] = sizes.get(group_id, 0) + 1
+    best = {}
+    for row in sorted(rows, key=lambda row: row[5]):
+        key = groups.get(row[0], ('file', row[0]))
+        if key not in best:
+            best[key] = tuple(row) + (sizes[key] - 1 if key in sizes else 0,)
+    return list(best.values())
+
+
+def similarity_path(db_path: str) -> str:
+    """Directory of the TF-IDF similarity matrix for a database, e.g. text_search.tfidf."""
+    return os.path.splitext(db_path)[0] + ".tfidf"
+
+
+def build_similarity_index(db_path: str, min_df: int = SIMILARITY_MIN_DF, max_df: float = SIMILARITY_MAX_DF) -> dict:
+    """
+    Build the TF-IDF matrix of every indexed document and save it next to the
+    database as .npy arrays that SimilarityIndex memory-maps.
+
+    Terms are lowercased words with at least one letter that occur in at
+    least min_df documents and in no more than max_df of them. Weights are
+    sublinear term frequency (1 + log tf) times smoothed inverse document
+    frequency, and each document's vector is scaled to unit length, so a
+    dot product is a cosine similarity. The matrix is stored twice:
+    row-major to read a document's vector and column-major (an inverted
+    index) to score all other documents against it.
+    """
+    if sparse is None:
+        raise RuntimeError("Document similarity needs NumPy and SciPy (pip install numpy scipy)")
+    start_time = time.perf_counter()
+    conn = connect_read_only(db_path)
+    try:
+        file_ids = [row[0] for row in conn.execute("SELECT id FROM text_files ORDER BY id")]
+        terms = {}
+        indptr, indices, counts = [0], array.array('i'), array.array('i')
+        for file_id in file_ids:
+            text = read_document_window(conn, file_id, 0, document_length(conn, file_id))
+            words = Counter(word for word in _WORD.findall(text.lower())
+                            if len(word) > 1 and not word.isdigit())
+            for term, count in words.items():
+                indices.append(terms.setdefault(term, len(terms)))
+                counts.append(count)
+            indptr.append(len(indices))
+    finally:
+        conn.close()
+
+    documents = len(file_ids)
+    matrix = sparse.csr_matrix((np.asarray(counts, dtype=np.float32), np.asarray(indices, dtype=np.int32),
+                                np.asarray(indptr, dtype=np.int64)), shape=(documents, len(terms)))
+    document_frequency = np.bincount(matrix.indices, minlength=len(terms))
+    keep = np.flatnonzero((document_frequency >= min_df) & (document_frequency <= max_df * documents))
+    matrix = matrix[:, keep].tocsr()
+    idf = np.log((1 + documents) / (1 + document_frequency[keep])) + 1
+    matrix.data = 1 + np.log(matrix.data)
+    matrix = (matrix @ sparse.diags(idf.astype(np.float32))).tocsr()
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    matrix = (sparse.diags((1 / norms).astype(np.float32)) @ matrix).tocsr()
+    matrix.sort_indices()
+    columns = matrix.tocsc()
+    columns.sort_indices()
+
+    # Write to a new directory and swap it in, so readers never see a half-written matrix
+    directory = similarity_path(db_path)
+    temporary = f"{directory}.{os.getpid()}.tmp"
+    os.makedirs(temporary, exist_ok=True)
+    for name, values in (('file_ids', np.asarray(file_ids, dtype=np.int64)),
+                         ('shape', np.asarray(matrix.shape, dtype=np.int64)),
+                         ('rows_data', matrix.data), ('rows_indices', matrix.indices), ('rows_indptr', matrix.indptr),
+                         ('columns_data', columns.data), ('columns_indices', columns.indices),
+                         ('columns_indptr', columns.indptr)):
+        np.save(os.path.join(temporary, name + '.npy'), values)
+    if os.path.isdir(directory):
+        previous = f"{directory}.{os.getpid()}.old"
+        os.replace(directory, previous)
+        os.replace(temporary, directory)
+        shutil.rmtree(previous)
+    else:
+        os.replace(temporary, directory)
+
+    stats = dict(documents=documents, terms=len(keep), nonzeros=matrix.nnz,
+                 bytes=sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)),
+                 seconds=time.perf_counter() - start_time)
+    print(f"Built the similarity matrix of {documents} documents and {len(keep)} terms "
+          f"({matrix.nnz} entries, {stats['bytes'] / 1048576:.1f} MB) in {stats['seconds']:.1f}s")
+    return stats
+
+
+class SimilarityIndex:
+    """
+    Memory-mapped TF-IDF matrix written by build_similarity_index. Pages are
+    read from the OS page cache on demand, so opening it is instant and
+    several processes share one copy.
+    """
+
+    def __init__(self, db_path: str):
+        if sparse is None:
+            raise RuntimeError("Document similarity needs NumPy and SciPy (pip install numpy scipy)")
+        directory = similarity_path(db_path)
+        if not os.path.isdir(directory):
+            raise FileNotFoundError(f"No similarity matrix at {directory}; build it with 'similar --build'")
+        load = lambda name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+        self.file_ids = load('file_ids')
+        shape = tuple(int(size) for size in load('shape'))
+        self.rows = sparse.csr_matrix((load('rows_data'), load('rows_indices'), load('rows_indptr')),
+                                      shape=shape, copy=False)
+        self.columns = sparse.csc_matrix((load('columns_data'), load('columns_indices'), load('columns_indptr')),
+                                         shape=shape, copy=False)
+
+    def similar(self, file_id: int, limit: int = SIMILARITY_TOP_K) -> List[Tuple[int, float]]:
+        """
+        The limit documents most similar to a document, as (file_id, cosine
+        similarity), best first. Only the postings of the document's own terms
+        are read. Raises KeyError for a document that isn't in the matrix.
+        """
+        position = int(np.searchsorted(self.file_ids, file_id))
+        if position >= len(self.file_ids) or self.file_ids[position] != file_id:
+            raise KeyError(file_id)
+        vector = self.rows[position]
+        scores = self.columns[:, vector.indices] @ vector.data
+        scores[position] = 0
+        limit = min(limit, len(scores) - 1)
+        if limit <= 0:
+            return []
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(int(self.file_ids[i]), float(scores[i])) for i in top if scores[i] > 0]
+
 
 class TextSearchDatabase:
-    def __init__(self, db_path: str = "text_search.db"):
+    def __init__(self, db_path: str = "text_search.db", contentless: bool = False):
         self.db_path = db_path
         self.conn = sqlite3.connect(db_path)
-        self.create_tables()
+        self.create_tables(contentless)
+
+    def create_tables(self, contentless: bool = False):
+        """
+        Create the database table with full-text search support.
+        With contentless=True a new database gets a contentless passages_fts
+        whose passage text lives only in the compressed content store; an
+        existing database keeps the layout it was created with.
+        """
+        # Enable FTS5 (full-text search) in SQLite
+        self.conn.execute('PRAGMA foreign_keys = ON')
+
+        # Create regular table for metadata
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS text_files (
+                id INTEGER PRIMARY KEY,
+                filename TEXT NOT NULL,
+                filepath TEXT NOT NULL,
+                content TEXT,  -- This will be NULL during indexing to save memory
+                bates_prefix TEXT,     -- parse_bates(filename)
+                bates_number INTEGER,
+                bates_digits TEXT      -- the number as written, for digit-prefix lookups
+            )
+        ''')
+
+        # Create FTS5 table for full-text search
+        # We'll store a portion of content for searching during indexing
+        self.conn.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS text_files_fts
+            USING fts5(id, content, filename, filepath, content='text_files', content_rowid='id', prefix='{FTS_PREFIX}')
+        ''')
+
+        # Full-document passages with character offsets, so matches anywhere in a
+        # file can be found and snippets built without rereading the file
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS passages (
+                id INTEGER PRIMARY KEY,
+                file_id INTEGER NOT NULL,  -- text_files.id
+                start_offset INTEGER NOT NULL,
+                end_offset INTEGER NOT NULL,
+                content TEXT  -- NULL when passages_fts is contentless
+            )
+        ''')
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS passages_file_offset ON passages(file_id, start_offset)'
+        )
+        if contentless and not _has_table(self.conn, 'passages_fts'):
+            self.conn.execute(f"CREATE VIRTUAL TABLE passages_fts USING fts5(content, content='', prefix='{FTS_PREFIX}')")
+        else:
+            self.conn.execute(f'''
+                CREATE VIRTUAL TABLE IF NOT EXISTS passages_fts
+                USING fts5(content, content='passages', content_rowid='id', prefix='{FTS_PREFIX}')
+            ''')
+        sql = self.conn.execute("SELECT sql FROM sqlite_master WHERE name = 'passages_fts'").fetchone()[0]
+        self.contentless = "content=''" in sql
+
+        # Full document text as zlib-compressed UTF-8, so search results,
+        # snippets and the file viewer never need the TEXT tree on disk
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS document_content (
+                file_id INTEGER PRIMARY KEY,  -- text_files.id
+                length INTEGER NOT NULL,      -- characters in the decompressed text
+                data BLOB NOT NULL
+            )
+        ''')
+
+        self._create_sync_triggers()
+
+        # Term statistics of the FTS tables, and the vocabulary materialized from
+        # them for autocomplete: the most frequent completions of every short
+        # prefix are stored outright, longer prefixes are a range scan
+        self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS text_files_fts_vocab USING fts5vocab(text_files_fts, 'col')")
+        self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS passages_fts_vocab USING fts5vocab(passages_fts, 'col')")
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS vocabulary (
+                term TEXT PRIMARY KEY,
+                documents INTEGER NOT NULL  -- passages (or sample documents) containing the term
+            ) WITHOUT ROWID
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS suggest_prefix (
+                prefix TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                term TEXT NOT NULL,
+                documents INTEGER NOT NULL,
+                PRIMARY KEY (prefix, position)
+            ) WITHOUT ROWID
+        ''')
+
+        # Symmetric-delete dictionary: every deletion of up to SPELL_MAX_DISTANCE
+        # characters from a term's prefix, pointing back at the term
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS spell_deletes (
+                deletion TEXT NOT NULL,
+                term TEXT NOT NULL,  -- vocabulary.term
+                PRIMARY KEY (deletion, term)
+            ) WITHOUT ROWID
+        ''')
+
+        # Entities extracted at index time: one row per distinct normalized
+        # value, linked to the documents that mention it
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS entities (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,   -- email, phone, amount or person
+                value TEXT NOT NULL,  -- normalize_entity(kind, mention)
+                UNIQUE (kind, value)
+            )
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS document_entities (
+                entity_id INTEGER NOT NULL,  -- entities.id
+                file_id INTEGER NOT NULL,    -- text_files.id
+                offset INTEGER NOT NULL,     -- first mention
+                mentions INTEGER NOT NULL,
+                PRIMARY KEY (entity_id, file_id)
+            ) WITHOUT ROWID
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS document_entities_file_id ON document_entities(file_id)')
 
-    def create_tables(self):
-        """Create the database table with full-text search support."""
-        # Enable FTS5 (full-text search) in SQLite
-        self.conn.execute('PRAGMA foreign_keys = ON')
+        self._add_bates_columns()
 
-        # Create regular table for metadata
+        # Dates mentioned in each document, for date-range filters
         self.conn.execute('''
-            CREATE TABLE IF NOT EXISTS text_files (
-                id INTEGER PRIMARY KEY,
+            CREATE TABLE IF NOT EXISTS document_dates (
+                file_id INTEGER NOT NULL,  -- text_files.id
+                date TEXT NOT NULL,        -- YYYY-MM-DD
+                PRIMARY KEY (file_id, date)
+            ) WITHOUT ROWID
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS document_dates_date ON document_dates(date, file_id)')
+
+        # Page scans in the image volume directories, and each directory's
+        # mtime at its last scan so a refresh only lists the ones that changed
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS image_manifest (
+                image_path TEXT PRIMARY KEY,
+                directory TEXT NOT NULL,
+                volume TEXT NOT NULL,     -- numbered volume directory (001-012)
                 filename TEXT NOT NULL,
-                filepath TEXT NOT NULL,
-                content TEXT  -- This will be NULL during indexing to save memory
+                base_name TEXT NOT NULL,  -- filename without extension, same as the text file's
+                format TEXT NOT NULL,     -- jpeg, png, gif or tiff
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS image_manifest_base_name ON image_manifest(base_name)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS image_manifest_volume_filename ON image_manifest(volume, filename)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS image_manifest_directory ON image_manifest(directory)')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS image_directories (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL
             )
         ''')
 
-        # Create FTS5 table for full-text search
-        # We'll store a portion of content for searching during indexing
+        # Page scans inside the release zip archives, with the offset of each
+        # member's data so it can be read without parsing the archive
         self.conn.execute('''
-            CREATE VIRTUAL TABLE IF NOT EXISTS text_files_fts
-            USING fts5(id, content, filename, filepath, content='text_files', content_rowid='id')
+            CREATE TABLE IF NOT EXISTS archive_members (
+                archive TEXT NOT NULL,
+                member TEXT NOT NULL,
+                volume TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                base_name TEXT NOT NULL,
+                format TEXT NOT NULL,
+                data_offset INTEGER NOT NULL,
+                compressed_size INTEGER NOT NULL,
+                file_size INTEGER NOT NULL,
+                compress_type INTEGER NOT NULL,  -- zipfile.ZIP_STORED or ZIP_DEFLATED
+                crc INTEGER NOT NULL,
+                PRIMARY KEY (archive, member)
+            ) WITHOUT ROWID
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS archive_members_base_name ON archive_members(base_name)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS archive_members_volume_filename ON archive_members(volume, filename)')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS image_archives (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL
+            )
+        ''')
+
+        # Manifest of indexed files, used to detect new, changed and deleted files
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS file_manifest (
+                filepath TEXT PRIMARY KEY,
+                file_id INTEGER NOT NULL,  -- text_files.id
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                content_hash TEXT NOT NULL
+            )
+        ''')
+
+        # MinHash signatures, LSH band buckets and the resulting near-duplicate groups
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS document_minhash (
+                file_id INTEGER PRIMARY KEY,  -- text_files.id
+                signature BLOB NOT NULL
+            )
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS minhash_bands (
+                band INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                file_id INTEGER NOT NULL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS minhash_bands_bucket ON minhash_bands(band, bucket)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS minhash_bands_file_id ON minhash_bands(file_id)')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS duplicate_group (
+                file_id INTEGER PRIMARY KEY,  -- text_files.id
+                group_id INTEGER NOT NULL     -- lowest file_id in the group
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS duplicate_group_group_id ON duplicate_group(group_id)')
+
+        # Extraction options used by earlier builds, which later builds keep using
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS index_options (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )
         ''')
 
-        # Create triggers to keep FTS table in sync with main table
+        # Progress of the current index build, committed together with each batch
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS index_checkpoint (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                text_directory TEXT NOT NULL,
+                last_path TEXT NOT NULL,
+                batch_ordinal INTEGER NOT NULL,
+                files_done INTEGER NOT NULL,
+                bulk INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+
+        self.conn.commit()
+
+    def _add_bates_columns(self):
+        """
+        Add the Bates number columns to databases created before they existed,
+        filling them from the filenames, and index them for exact, prefix and
+        range lookups. The FTS triggers are dropped meanwhile, because only
+        columns that aren't full-text indexed change.
+        """
+        if not _has_bates_columns(self.conn):
+            print("Adding Bates number columns...")
+            for column in ("bates_prefix TEXT", "bates_number INTEGER", "bates_digits TEXT"):
+                self.conn.execute(f"ALTER TABLE text_files ADD COLUMN {column}")
+            self._drop_sync_triggers()
+            rows = self.conn.execute("SELECT id, filename FROM text_files").fetchall()
+            self.conn.executemany(
+                "UPDATE text_files SET bates_prefix = ?, bates_number = ?, bates_digits = ? WHERE id = ?",
+                (parse_bates(filename) + (file_id,) for file_id, filename in rows)
+            )
+            self._create_sync_triggers()
+        self.conn.execute('CREATE INDEX IF NOT EXISTS text_files_bates_number ON text_files(bates_number)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS text_files_bates_digits ON text_files(bates_digits)')
+
+    def _create_sync_triggers(self):
+        """Create triggers to keep FTS table in sync with main table."""
         self.conn.executescript('''
             CREATE TRIGGER IF NOT EXISTS text_files_ai AFTER INSERT ON text_files
             BEGIN
@@ -64,186 +2670,951 @@ class TextSearchDatabase:
                 VALUES (new.id, new.id, new.content, new.filename, new.filepath);
             END;
         ''')
+        if self.contentless:
+            # passages_fts is written directly by _write_batch
+            return
+        self.conn.executescript('''
+            CREATE TRIGGER IF NOT EXISTS passages_ai AFTER INSERT ON passages
+            BEGIN
+                INSERT INTO passages_fts(rowid, content) VALUES (new.id, new.content);
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS passages_ad AFTER DELETE ON passages
+            BEGIN
+                INSERT INTO passages_fts(passages_fts, rowid, content) VALUES('delete', old.id, old.content);
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS passages_au AFTER UPDATE ON passages
+            BEGIN
+                INSERT INTO passages_fts(passages_fts, rowid, content) VALUES('delete', old.id, old.content);
+                INSERT INTO passages_fts(rowid, content) VALUES (new.id, new.content);
+            END;
+        ''')
+        if has_trigram_index(self.conn):
+            self.conn.executescript('''
+                CREATE TRIGGER IF NOT EXISTS passages_trigram_ai AFTER INSERT ON passages
+                BEGIN
+                    INSERT INTO passages_trigram(rowid, content) VALUES (new.id, new.content);
+                END;
+
+                CREATE TRIGGER IF NOT EXISTS passages_trigram_ad AFTER DELETE ON passages
+                BEGIN
+                    INSERT INTO passages_trigram(passages_trigram, rowid, content) VALUES('delete', old.id, old.content);
+                END;
+
+                CREATE TRIGGER IF NOT EXISTS passages_trigram_au AFTER UPDATE ON passages
+                BEGIN
+                    INSERT INTO passages_trigram(passages_trigram, rowid, content) VALUES('delete', old.id, old.content);
+                    INSERT INTO passages_trigram(rowid, content) VALUES (new.id, new.content);
+                END;
+            ''')
+
+    def _drop_sync_triggers(self):
+        """Drop the FTS sync triggers so bulk inserts skip per-row FTS maintenance."""
+        self.conn.executescript('''
+            DROP TRIGGER IF EXISTS text_files_ai;
+            DROP TRIGGER IF EXISTS text_files_ad;
+            DROP TRIGGER IF EXISTS text_files_au;
+            DROP TRIGGER IF EXISTS passages_ai;
+            DROP TRIGGER IF EXISTS passages_ad;
+            DROP TRIGGER IF EXISTS passages_au;
+            DROP TRIGGER IF EXISTS passages_trigram_ai;
+            DROP TRIGGER IF EXISTS passages_trigram_ad;
+            DROP TRIGGER IF EXISTS passages_trigram_au;
+        ''')
+
+    def fts_tables(self) -> List[str]:
+        """The FTS tables that exist in this database, in FTS_TABLES order."""
+        return [fts_table for fts_table in FTS_TABLES if _has_table(self.conn, fts_table)]
+
+    def create_trigram_index(self):
+        """
+        Add the trigram-tokenized companion index over the passages, built from
+        the passages already indexed and kept in sync by triggers from then on.
+        It answers substring and GLOB searches, including fragments inside
+        words that the unicode61 tokenizer never splits out.
+        """
+        if has_trigram_index(self.conn):
+            return
+        if self.contentless:
+            # A contentless table can't evaluate LIKE or GLOB on its column
+            raise ValueError("The trigram index needs passage text and is not available "
+                             "with a contentless passage index")
+        print("Building trigram index...")
+        start_time = time.perf_counter()
+        self.conn.execute('''
+            CREATE VIRTUAL TABLE passages_trigram
+            USING fts5(content, content='passages', content_rowid='id', tokenize='trigram')
+        ''')
+        self.conn.execute("INSERT INTO passages_trigram(passages_trigram) VALUES('rebuild')")
+        self._create_sync_triggers()
+        self.conn.commit()
+        print(f"Trigram index built in {time.perf_counter() - start_time:.1f}s")
 
+    def _apply_bulk_load_pragmas(self) -> dict:
+        """
+        Switch the connection to bulk-load settings.
+        Returns the previous settings so they can be restored afterwards.
+        """
+        saved = {
+            'journal_mode': self.conn.execute('PRAGMA journal_mode').fetchone()[0],
+            'synchronous': self.conn.execute('PRAGMA synchronous').fetchone()[0],
+            'cache_size': self.conn.execute('PRAGMA cache_size').fetchone()[0],
+            'temp_store': self.conn.execute('PRAGMA temp_store').fetchone()[0],
+        }
+        # WAL with synchronous=OFF keeps the database intact if the process dies,
+        # only an OS crash can lose the most recent commits
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = OFF')
+        self.conn.execute('PRAGMA cache_size = -262144')  # 256 MB
+        self.conn.execute('PRAGMA temp_store = MEMORY')
+        return saved
+
+    def _restore_pragmas(self, saved: dict):
+        """Put back the settings returned by _apply_bulk_load_pragmas."""
+        self.conn.execute(f"PRAGMA journal_mode = {saved['journal_mode']}")
+        self.conn.execute(f"PRAGMA synchronous = {int(saved['synchronous'])}")
+        self.conn.execute(f"PRAGMA cache_size = {int(saved['cache_size'])}")
+        self.conn.execute(f"PRAGMA temp_store = {int(saved['temp_store'])}")
+
+    def rebuild_fts_index(self):
+        """Rebuild the FTS tables from their content tables in one pass and merge each into a single segment."""
+        print("Rebuilding full-text index...")
+        start_time = time.perf_counter()
+        for fts_table in self.fts_tables():
+            if not (fts_table == 'passages_fts' and self.contentless):
+                # A contentless table has nothing to rebuild from and is kept up to date directly
+                self.conn.execute(f"INSERT INTO {fts_table}({fts_table}) VALUES('rebuild')")
+            self.conn.execute(f"INSERT INTO {fts_table}({fts_table}) VALUES('optimize')")
         self.conn.commit()
+        print(f"Full-text index rebuilt in {time.perf_counter() - start_time:.1f}s")
 
-    def index_text_files(self, text_directory: str, batch_size: int = 100, content_sample_size: int = 10240):
+    def index_text_files(self, text_directory: str, batch_size: int = 100, content_sample_size: int = 10240,
+                         workers: int = 1, bulk: bool = False, incremental: bool = False,
+                         passages: bool = True, passage_size: int = 2000, passage_overlap: int = 200,
+                         resume: bool = False, dedupe: bool = False, store_content: bool = True,
+                         trigram: bool = False, entities: bool = False, dates: bool = False):
         """
         Index all text files in the given directory and subdirectories.
-        Only store a small sample of content for search indexing to save memory.
+        A small sample of content goes into text_files for the sample-based
+        index; with passages=True the full text is also split into overlapping
+        passages for the full-document passage index.
+
+        With workers > 1, a pool of processes reads and decodes the files while
+        this process stays the single writer that owns the SQLite connection.
+
+        With bulk=True, the FTS sync triggers are dropped for the duration of
+        the build and text_files_fts is rebuilt once at the end, under
+        bulk-load PRAGMAs that are restored when indexing finishes.
+
+        With incremental=True, files whose size and mtime match file_manifest
+        are skipped without being read, changed files are updated in place and
+        files that disappeared from text_directory are deleted.
+
+        Every batch commit also records a checkpoint. With resume=True, an
+        interrupted build continues after the last committed file.
+
+        With dedupe=True, a MinHash signature is computed per document and
+        near-duplicates are grouped with LSH into duplicate_group at the end.
+        Once a build of the database used dedupe, entities or dates, later
+        builds keep using them (see _remembered_index_options).
+
+        With store_content=True, the full text of every file is stored
+        zlib-compressed in document_content and read from there instead of
+        from disk. A contentless passage index requires it.
+
+        With trigram=True, the trigram companion index for substring searches
+        is created if it doesn't exist yet and maintained along with the
+        passages.
+
+        With entities=True, emails, phone numbers, dollar amounts and
+        candidate person names are extracted from each document into the
+        entities and document_entities tables.
+
+        With dates=True, the dates mentioned in each document are normalized
+        into document_dates for date-range filters.
         """
+        if self.contentless and not store_content:
+            raise ValueError("A contentless passage index needs the content store")
+        if trigram:
+            self.create_trigram_index()
         print(f"Indexing text files from {text_directory}...")
+        remembered = self._remembered_index_options(dedupe=dedupe, entities=entities, dates=dates)
+        dedupe, entities, dates = remembered['dedupe'], remembered['entities'], remembered['dates']
 
-        # Find all .txt files in the directory and subdirectories
-        txt_files = glob.glob(os.path.join(text_directory, "**", "*.txt"), recursive=True)
-        total_files = len(txt_files)
+        checkpoint = self.get_checkpoint()
+        start_after = None
+        batch_number = 0
+        processed = 0
+        if resume:
+            if checkpoint is None:
+                print("No checkpoint found, starting from the beginning.")
+            elif checkpoint['text_directory'] != text_directory:
+                raise ValueError(f"Checkpoint belongs to {checkpoint['text_directory']}, not {text_directory}")
+            else:
+                start_after = checkpoint['last_path']
+                batch_number = checkpoint['batch_ordinal']
+                processed = checkpoint['files_done']
+                print(f"Resuming after batch {batch_number} ({processed} files), last committed file {start_after}")
+                if checkpoint['bulk'] and not bulk:
+                    # Rows from the interrupted run may be missing from the FTS tables
+                    print("Interrupted build used bulk-load mode, continuing in bulk-load mode.")
+                    bulk = True
 
-        print(f"Found {total_files} text files to index...")
+        # Stream .txt files from the directory and subdirectories as they are found
+        discovered = iter_text_files(text_directory, start_after=start_after)
 
-        # Process files in batches to reduce memory usage
-        for i in range(0, total_files, batch_size):
-            batch = txt_files[i:i + batch_size]
-            
-            # Process each file in the batch
-            for j, file_path in enumerate(batch, i + 1):
-                try:
-                    # Read only a small sample of the file content for indexing
-                    content_sample = self._read_file_content_sample(file_path, content_sample_size)
-                    filename = os.path.basename(file_path)
+        seeded = self._seed_manifest()
+        if seeded:
+            print(f"The database predates the file manifest; added {seeded} indexed files to it. "
+                  "They are read and re-checked once.")
+        elif not incremental and not start_after and self.count_files() > 0:
+            print("The database already contains indexed files; every file is read again to check it "
+                  "against the manifest. Use incremental mode to skip unchanged files without reading them.")
 
-                    # Insert into database with content sample for search, filepath for loading full content later
-                    self.conn.execute(
-                        "INSERT INTO text_files (filename, filepath, content) VALUES (?, ?, ?)",
-                        (filename, file_path, content_sample)  # Store only the sample for search indexing
-                    )
+        pool = None
+        if workers > 1:
+            print(f"Using {workers} worker processes for file extraction")
+            pool = multiprocessing.Pool(workers)
 
-                    if j % 100 == 0 or j == total_files:
-                        print(f"Indexed {j}/{total_files} files ({j/total_files*100:.1f}%)")
+        saved_pragmas = None
+        if bulk:
+            print("Bulk-load mode: deferring full-text index maintenance until the end")
+            saved_pragmas = self._apply_bulk_load_pragmas()
+            self._drop_sync_triggers()
 
-                except Exception as e:
-                    print(f"Error processing {file_path}: {str(e)}")
-                    continue
+        if incremental:
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS seen_files (filepath TEXT PRIMARY KEY)")
+            self.conn.execute("DELETE FROM seen_files")
 
-            # Commit every batch to free up memory
-            self.conn.commit()
-            print(f"Committed batch {i//batch_size + 1}/{(total_files + batch_size - 1)//batch_size}")
+        options = {
+            'content_sample_size': content_sample_size,
+            'passages': passages,
+            'passage_size': passage_size,
+            'passage_overlap': passage_overlap,
+            'dedupe': dedupe,
+            'entities': entities,
+            'dates': dates,
+            'store_content': store_content,
+        }
+        self._last_file_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM text_files").fetchone()[0]
+        self._last_passage_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM passages").fetchone()[0]
+        stats = {'new': 0, 'changed': 0, 'unchanged': 0, 'deleted': 0,
+                 'sample_seconds': 0.0, 'passages_seconds': 0.0, 'content_seconds': 0.0}
+        start_time = time.perf_counter()
+        resumed_from = processed
+        pending = None
 
-        print(f"Indexing complete! Indexed {total_files} files.")
+        def report_progress(written):
+            # Extraction runs a batch ahead, so rates count written batches only
+            _, _, ordinal, done, _ = written
+            rate = (done - resumed_from) / max(time.perf_counter() - start_time, 1e-9)
+            print(f"Batch {ordinal}: {done} files - {rate:.1f} files/sec")
 
-    def _read_file_content_sample(self, file_path: str, sample_size: int = 10240) -> str:
-        """Read a sample of the file content for indexing purposes."""
         try:
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                # Read only the first part of the file for indexing
-                sample = f.read(sample_size)
-                return sample
-        except Exception as e:
-            print(f"Error reading file {file_path}: {str(e)}")
-            return ""
+            while True:
+                batch = list(itertools.islice(discovered, batch_size))
+                if not batch:
+                    break
+                paths = [path for path, _, _ in batch]
+                manifest = self._lookup_manifest(paths)
+                if incremental:
+                    self.conn.executemany("INSERT OR IGNORE INTO seen_files (filepath) VALUES (?)",
+                                          ((path,) for path in paths))
+                    to_extract = [path for path, size, mtime_ns in batch
+                                  if not self._is_unchanged(size, mtime_ns, manifest.get(path))]
+                    stats['unchanged'] += len(batch) - len(to_extract)
+                else:
+                    to_extract = paths
+
+                # Start extracting this batch before writing the previous one,
+                # so the workers are busy while the writer commits
+                tasks = [(path, options) for path in to_extract]
+                if pool is not None:
+                    extraction = pool.map_async(_extract_text_file, tasks)
+                else:
+                    extraction = list(map(_extract_text_file, tasks))
+
+                processed += len(batch)
+                batch_number += 1
+                checkpoint = (text_directory, paths[-1], batch_number, processed, int(bulk))
+
+                if pending is not None:
+                    self._write_batch(*pending, stats)
+                    report_progress(pending[2])
+                pending = (extraction, manifest, checkpoint)
+
+            if pending is not None:
+                self._write_batch(*pending, stats)
+                report_progress(pending[2])
+
+            if incremental:
+                stats['deleted'] = self._delete_vanished_files(text_directory)
+
+            if dedupe:
+                stats['duplicate_groups'] = self.group_near_duplicates()
+
+            # The build finished, so there is nothing left to resume
+            self.conn.execute("DELETE FROM index_checkpoint")
+            self.conn.commit()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if bulk:
+                # An interrupt inside _write_batch leaves its rows uncommitted;
+                # roll them back so the rebuild's commit doesn't keep them
+                # without their manifest rows and checkpoint
+                self.conn.rollback()
+                # Always rebuild before restoring the triggers, even when interrupted,
+                # so the FTS tables never disagree with their content tables
+                self.rebuild_fts_index()
+                self._create_sync_triggers()
+                self._restore_pragmas(saved_pragmas)
+
+        self.build_suggestions()
+        self.build_spelling_dictionary()
+
+        elapsed = time.perf_counter() - start_time
+        rate = (processed - resumed_from) / elapsed if elapsed > 0 else 0.0
+        print(f"Indexing complete! Processed {processed - resumed_from} files in {elapsed:.1f}s "
+              f"({rate:.1f} files/sec with {max(workers, 1)} worker{'s' if workers > 1 else ''}).")
+        print(f"New: {stats['new']}, changed: {stats['changed']}, "
+              f"unchanged: {stats['unchanged']}, deleted: {stats['deleted']}")
+        self.print_index_report(stats)
+        return stats
+
+    def _remembered_index_options(self, **requested) -> dict:
+        """
+        Merge the requested extraction options with the ones earlier builds
+        of this database used, and record the result in index_options.
+        _write_batch replaces the extracted rows of every changed file, so a
+        build without an option that an earlier build used would leave those
+        files without them.
+        """
+        stored = dict(self.conn.execute("SELECT name, value FROM index_options"))
+        options = {}
+        for name, value in requested.items():
+            if stored.get(name) and not value:
+                print(f"Keeping --{name} from an earlier build of this database")
+            options[name] = bool(value or stored.get(name))
+        self.conn.executemany("INSERT OR REPLACE INTO index_options (name, value) VALUES (?, ?)",
+                              ((name, int(value)) for name, value in options.items()))
+        self.conn.commit()
+        return options
+
+    def _seed_manifest(self) -> int:
+        """
+        Fill an empty file_manifest from the files already in text_files, for
+        databases built before the manifest existed. Seeded entries have no
+        stat data or content hash, so the next run reads every file and updates
+        it in place instead of inserting it a second time.
+        """
+        if self.conn.execute("SELECT 1 FROM file_manifest LIMIT 1").fetchone() is not None:
+            return 0
+        cursor = self.conn.execute(
+            "INSERT OR IGNORE INTO file_manifest (filepath, file_id, size, mtime_ns, content_hash) "
+            "SELECT filepath, id, -1, -1, '' FROM text_files ORDER BY id"
+        )
+        self.conn.commit()
+        return cursor.rowcount
+
+    def _lookup_manifest(self, paths: List[str]) -> dict:
+        """Return {filepath: (file_id, size, mtime_ns, content_hash)} for the given paths."""
+        manifest = {}
+        if not paths:
+            return manifest
+        placeholders = ",".join("?" * len(paths))
+        cursor = self.conn.execute(
+            f"SELECT filepath, file_id, size, mtime_ns, content_hash FROM file_manifest WHERE filepath IN ({placeholders})",
+            paths
+        )
+        for filepath, file_id, size, mtime_ns, content_hash in cursor:
+            manifest[filepath] = (file_id, size, mtime_ns, content_hash)
+        return manifest
+
+    @staticmethod
+    def _is_unchanged(size: int, mtime_ns: int, entry) -> bool:
+        """Check a file against its manifest entry using only the stat data from discovery."""
+        if entry is None:
+            return False
+        return size == entry[1] and mtime_ns == entry[2]
+
+    def get_checkpoint(self):
+        """Return the checkpoint of an unfinished index build as a dict, or None."""
+        row = self.conn.execute(
+            "SELECT text_directory, last_path, batch_ordinal, files_done, bulk FROM index_checkpoint"
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('text_directory', 'last_path', 'batch_ordinal', 'files_done', 'bulk'), row))
+
+    def _write_batch(self, extraction, manifest: dict, checkpoint: tuple, stats: dict):
+        """
+        Write one batch of extracted documents and commit it.
+        New files are inserted, files with a different content hash are updated
+        (through text_files_au), and the manifest is refreshed for all of them.
+        The checkpoint row is written in the same transaction, so it never
+        points past data that was not committed. A batch that fails to write
+        is rolled back and the error is raised.
+        """
+        docs = extraction.get() if hasattr(extraction, 'get') else extraction
+        inserts, updates, manifest_rows = [], [], []
+        passage_rows, replaced_ids = [], []
+        minhash_rows, band_rows, content_rows, entity_rows, date_rows = [], [], [], [], []
+        for doc in docs:
+            entry = manifest.get(doc['filepath'])
+            if entry is None:
+                self._last_file_id += 1
+                file_id = self._last_file_id
+                inserts.append((file_id, doc['filename'], doc['filepath'], doc['content']) + parse_bates(doc['filename']))
+            else:
+                file_id = entry[0]
+                if entry[3] == doc['content_hash']:
+                    manifest_rows.append((doc['filepath'], file_id, doc['size'], doc['mtime_ns'], doc['content_hash']))
+                    continue
+                updates.append((doc['filename'], doc['content'], file_id))
+                replaced_ids.append((file_id,))
+            for start, end, text in doc['passages']:
+                self._last_passage_id += 1
+                passage_rows.append((self._last_passage_id, file_id, start, end, text))
+            if doc['stored_content'] is not None:
+                content_rows.append((file_id, doc['length'], doc['stored_content']))
+            entity_rows.extend((kind, value, file_id, offset, mentions)
+                               for kind, value, offset, mentions in doc['entities'])
+            date_rows.extend((file_id, date) for date in doc['dates'])
+            if doc['minhash'] is not None:
+                minhash_rows.append((file_id, doc['minhash']))
+                band_rows.extend((band, bucket, file_id) for band, bucket in minhash_bands(doc['minhash']))
+            manifest_rows.append((doc['filepath'], file_id, doc['size'], doc['mtime_ns'], doc['content_hash']))
 
-    def load_full_content(self, filepath: str) -> str:
-        """Load the full content of a file on demand."""
         try:
-            with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
-                return f.read()
+            sample_start = time.perf_counter()
+            # Insert into database with content sample for search, filepath for loading full content later
+            self.conn.executemany(
+                "INSERT INTO text_files (id, filename, filepath, content, bates_prefix, bates_number, bates_digits) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                inserts  # Store only the sample for search indexing
+            )
+            self.conn.executemany("UPDATE text_files SET filename = ?, content = ? WHERE id = ?", updates)
+            passage_start = time.perf_counter()
+            if self.contentless:
+                self._delete_contentless_passages(file_id for file_id, in replaced_ids)
+                self.conn.executemany("INSERT INTO passages_fts (rowid, content) VALUES (?, ?)",
+                                      ((row[0], row[4]) for row in passage_rows))
+                passage_rows = [row[:4] + (None,) for row in passage_rows]
+            self.conn.executemany("DELETE FROM passages WHERE file_id = ?", replaced_ids)
+            self.conn.executemany(
+                "INSERT INTO passages (id, file_id, start_offset, end_offset, content) VALUES (?, ?, ?, ?, ?)",
+                passage_rows
+            )
+            passage_end = time.perf_counter()
+            self.conn.executemany("DELETE FROM document_content WHERE file_id = ?", replaced_ids)
+            self.conn.executemany("INSERT INTO document_content (file_id, length, data) VALUES (?, ?, ?)",
+                                  content_rows)
+            content_end = time.perf_counter()
+            self.conn.executemany("DELETE FROM document_minhash WHERE file_id = ?", replaced_ids)
+            self.conn.executemany("DELETE FROM minhash_bands WHERE file_id = ?", replaced_ids)
+            self.conn.executemany("INSERT INTO document_minhash (file_id, signature) VALUES (?, ?)", minhash_rows)
+            self.conn.executemany("INSERT INTO minhash_bands (band, bucket, file_id) VALUES (?, ?, ?)", band_rows)
+            self.conn.executemany("DELETE FROM document_dates WHERE file_id = ?", replaced_ids)
+            self.conn.executemany("INSERT INTO document_dates (file_id, date) VALUES (?, ?)", date_rows)
+            self.conn.executemany("DELETE FROM document_entities WHERE file_id = ?", replaced_ids)
+            self.conn.executemany("INSERT OR IGNORE INTO entities (kind, value) VALUES (?, ?)",
+                                  ((kind, value) for kind, value, _, _, _ in entity_rows))
+            self.conn.executemany(
+                "INSERT INTO document_entities (entity_id, file_id, offset, mentions) "
+                "SELECT id, ?, ?, ? FROM entities WHERE kind = ? AND value = ?",
+                ((file_id, offset, mentions, kind, value) for kind, value, file_id, offset, mentions in entity_rows)
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO file_manifest (filepath, file_id, size, mtime_ns, content_hash) "
+                "VALUES (?, ?, ?, ?, ?)",
+                manifest_rows
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO index_checkpoint "
+                "(id, text_directory, last_path, batch_ordinal, files_done, bulk, updated_at) "
+                "VALUES (1, ?, ?, ?, ?, ?, ?)",
+                checkpoint + (time.time(),)
+            )
+            self.conn.commit()
         except Exception as e:
-            print(f"Error loading file {filepath}: {str(e)}")
-            return ""
+            # Stop the build rather than skip the batch: later checkpoints would
+            # move past it and a resumed build would never retry its files
+            self.conn.rollback()
+            first = docs[0]['filepath'] if docs else "<empty batch>"
+            print(f"Error writing batch starting at {first}: {str(e)}")
+            raise
 
-    def search(self, query: str, limit: int = 10000) -> List[Tuple[str, str, str, float]]:
-        """Search the database for the given query."""
-        cursor = self.conn.cursor()
+        stats['new'] += len(inserts)
+        stats['changed'] += len(updates)
+        stats['unchanged'] += len(docs) - len(inserts) - len(updates)
+        stats['sample_seconds'] += passage_start - sample_start
+        stats['passages_seconds'] += passage_end - passage_start
+        stats['content_seconds'] += content_end - passage_end
 
-        # Use FTS to search for the query in the sample content
-        # For phrase search (multi-word queries), wrap in quotes
-        if ' ' in query:
-            escaped_query = query.replace('"', '""')  # Escape double quotes
-            quoted_query = f'"{escaped_query}"'
-            fts_query = f"content:{quoted_query} OR filename:{quoted_query}"
-        else:
-            fts_query = f"content:{query} OR filename:{query}"
-            
-        cursor.execute(
+    def _delete_contentless_passages(self, file_ids):
+        """
+        Remove the passages of the given files from a contentless passages_fts.
+        FTS5 needs the original text to delete it, which is taken from the
+        content store, so this must run before document_content is replaced.
+        """
+        for file_id in file_ids:
+            text = load_document(self.conn, file_id)
+            if text is None:
+                continue
+            passages = self.conn.execute(
+                "SELECT id, start_offset, end_offset FROM passages WHERE file_id = ?", (file_id,)
+            ).fetchall()
+            self.conn.executemany(
+                "INSERT INTO passages_fts (passages_fts, rowid, content) VALUES ('delete', ?, ?)",
+                ((passage_id, text[start:end]) for passage_id, start, end in passages)
+            )
+
+    def _delete_vanished_files(self, text_directory: str) -> int:
+        """
+        Delete files under text_directory that are in the manifest but were not
+        seen by the current incremental run. Deletes go through text_files_ad.
+        Unseen files are checked on disk before deletion, because a resumed
+        run does not see the files it skipped.
+        """
+        prefix = os.path.join(text_directory, "")
+        cursor = self.conn.execute(
             '''
-            SELECT
-                tf.filename,
-                tf.filepath,
-                tf.content,  -- This is the sample content
-                text_files_fts.rank
-            FROM text_files_fts
-            JOIN text_files AS tf ON text_files_fts.rowid = tf.id
-            WHERE text_files_fts MATCH ?
-            ORDER BY text_files_fts.rank
-            LIMIT ?
+            SELECT filepath, file_id FROM file_manifest
+            WHERE filepath >= ? AND filepath < ?
+              AND filepath NOT IN (SELECT filepath FROM temp.seen_files)
             ''',
-            (fts_query, limit)
+            (prefix, prefix + "\U0010ffff")
         )
+        vanished = [(path, file_id) for path, file_id in cursor if not os.path.lexists(path)]
+        self.conn.executemany("DELETE FROM text_files WHERE id = ?", ((file_id,) for _, file_id in vanished))
+        if self.contentless:
+            self._delete_contentless_passages(file_id for _, file_id in vanished)
+        for table in ('passages', 'document_content', 'document_minhash', 'minhash_bands', 'duplicate_group',
+                      'document_entities', 'document_dates'):
+            self.conn.executemany(f"DELETE FROM {table} WHERE file_id = ?", ((file_id,) for _, file_id in vanished))
+        self.conn.executemany("DELETE FROM file_manifest WHERE filepath = ?", ((path,) for path, _ in vanished))
+        self.conn.commit()
+        return len(vanished)
 
-        results = cursor.fetchall()
-        
-        # Replace the sample content with full content for display
-        full_results = []
-        for filename, filepath, sample_content, rank in results:
-            full_content = self.load_full_content(filepath)
-            full_results.append((filename, filepath, full_content, rank))
-        
-        return full_results
-
-    def search_content_only(self, query: str, limit: int = 10000) -> List[Tuple[str, str, str, float]]:
-        """Search only in the content of documents."""
-        cursor = self.conn.cursor()
+    def build_suggestions(self):
+        """
+        Rebuild the autocomplete vocabulary from the content column of the
+        passage index (or the sample index when there are no passages), with
+        the SUGGEST_LIMIT most frequent completions of every prefix of up to
+        SUGGEST_PREFIX_LENGTH characters.
+        """
+        start_time = time.perf_counter()
+        source = 'passages_fts_vocab' if self.has_passages() else 'text_files_fts_vocab'
+        self.conn.execute("DELETE FROM vocabulary")
+        self.conn.execute(f"INSERT INTO vocabulary (term, documents) SELECT term, doc FROM {source} WHERE col = 'content'")
+        self.conn.execute("DELETE FROM suggest_prefix")
+        for length in range(1, SUGGEST_PREFIX_LENGTH + 1):
+            self.conn.execute(
+                '''
+                INSERT INTO suggest_prefix (prefix, position, term, documents)
+                SELECT prefix, position, term, documents FROM (
+                    SELECT substr(term, 1, ?1) AS prefix, term, documents,
+                           ROW_NUMBER() OVER (PARTITION BY substr(term, 1, ?1) ORDER BY documents DESC, term) AS position
+                    FROM vocabulary
+                    WHERE length(term) >= ?1
+                )
+                WHERE position <= ?2
+                ''',
+                (length, SUGGEST_LIMIT)
+            )
+        self.conn.commit()
+        terms = self.conn.execute("SELECT COUNT(*) FROM vocabulary").fetchone()[0]
+        print(f"Autocomplete vocabulary of {terms} terms built in {time.perf_counter() - start_time:.1f}s")
+
+    def build_spelling_dictionary(self):
+        """
+        Rebuild spell_deletes from the vocabulary. Terms without a letter or
+        found in fewer than SPELL_MIN_DOCUMENTS passages are left out, so OCR
+        noise isn't offered as a correction.
+        """
+        start_time = time.perf_counter()
+        self.conn.execute("DELETE FROM spell_deletes")
+        terms = self.conn.execute("SELECT term FROM vocabulary WHERE documents >= ?", (SPELL_MIN_DOCUMENTS,))
+        rows = ((deletion, term) for term, in terms.fetchall() if any(c.isalpha() for c in term)
+                for deletion in _deletes(term[:SPELL_PREFIX_LENGTH]))
+        self.conn.executemany("INSERT OR IGNORE INTO spell_deletes (deletion, term) VALUES (?, ?)", rows)
+        self.conn.commit()
+        count = self.conn.execute("SELECT COUNT(*) FROM spell_deletes").fetchone()[0]
+        print(f"Spelling dictionary of {count} deletes built in {time.perf_counter() - start_time:.1f}s")
+
+    def group_near_duplicates(self, threshold: float = 0.8) -> int:
+        """
+        Rebuild duplicate_group from the LSH band buckets.
+        Documents sharing a bucket are candidates; a candidate joins the
+        group of the bucket's first document when their estimated Jaccard
+        similarity reaches threshold. Returns the number of groups.
+        """
+        start_time = time.perf_counter()
+        parent = {}
+
+        def find(file_id):
+            root = file_id
+            while parent.get(root, root) != root:
+                root = parent[root]
+            while parent.get(file_id, file_id) != root:  # Path compression
+                parent[file_id], file_id = root, parent[file_id]
+            return root
+
+        signatures = {}
+
+        def signature(file_id):
+            if file_id not in signatures:
+                signatures[file_id] = self.conn.execute(
+                    "SELECT signature FROM document_minhash WHERE file_id = ?", (file_id,)
+                ).fetchone()[0]
+            return signatures[file_id]
+
+        buckets = self.conn.execute('''
+            SELECT GROUP_CONCAT(file_id) FROM minhash_bands
+            GROUP BY band, bucket HAVING COUNT(*) > 1
+        ''').fetchall()
+        for (members,) in buckets:
+            first, *others = sorted(int(file_id) for file_id in members.split(","))
+            for other in others:
+                if find(first) != find(other) and minhash_similarity(signature(first), signature(other)) >= threshold:
+                    low, high = sorted((find(first), find(other)))
+                    parent[high] = low
+
+        groups = [(file_id, find(file_id)) for file_id in parent]
+        groups += [(root, root) for root in {root for _, root in groups}]
+        self.conn.execute("DELETE FROM duplicate_group")
+        self.conn.executemany("INSERT OR IGNORE INTO duplicate_group (file_id, group_id) VALUES (?, ?)", groups)
+        self.conn.commit()
+
+        group_count = len({root for _, root in groups})
+        print(f"Grouped {len(set(file_id for file_id, _ in groups))} near-duplicate documents "
+              f"into {group_count} groups in {time.perf_counter() - start_time:.1f}s")
+        return group_count
+
+    def refresh_image_manifest(self, image_directory: str, volumes: List[str] = None, full: bool = True) -> dict:
+        """
+        Bring image_manifest up to date with the page scans in the numbered
+        volume directories (001-012) of image_directory, and archive_members
+        with those in the zip archives directly inside it.
+
+        A full refresh lists every directory and compares each scan's size and
+        mtime. Otherwise only directories whose mtime changed since the last
+        scan are listed again (adding, removing or renaming a file changes
+        it), which costs one stat per known directory. Archives are read
+        again only when their size or mtime changed. Returns the number of
+        directories and archives listed and of scans added, updated and removed.
+        """
+        image_directory = os.path.abspath(image_directory)
+        known = dict(self.conn.execute("SELECT path, mtime_ns FROM image_directories"))
+        roots = [os.path.join(image_directory, volume) for volume in (volumes or list_volumes(image_directory))]
+        stats = dict(directories=0, archives=0, added=0, updated=0, removed=0)
+        self._refresh_image_archives(image_directory, volumes, stats)
 
-        # Use FTS to search in content only
-        # For phrase search (multi-word queries), wrap in quotes
-        if ' ' in query:
-            escaped_query = query.replace('"', '""')  # Escape double quotes
-            quoted_query = f'"{escaped_query}"'
+        if full or not known:
+            pending = list(roots)
         else:
-            quoted_query = query
-            
-        cursor.execute(
-            '''
-            SELECT
-                tf.filename,
-                tf.filepath,
-                tf.content,
-                text_files_fts.rank
-            FROM text_files_fts
-            JOIN text_files AS tf ON text_files_fts.rowid = tf.id
-            WHERE text_files_fts MATCH ?
-            ORDER BY text_files_fts.rank
-            LIMIT ?
-            ''',
-            (f"content:{quoted_query}", limit)
-        )
+            pending = [root for root in roots if root not in known]
+            for path, mtime_ns in known.items():
+                try:
+                    if os.stat(path).st_mtime_ns != mtime_ns:
+                        pending.append(path)
+                except OSError:
+                    stats['removed'] += self._remove_image_directory(path)
 
-        results = cursor.fetchall()
-        
-        # Replace the sample content with full content for display
-        full_results = []
-        for filename, filepath, sample_content, rank in results:
-            full_content = self.load_full_content(filepath)
-            full_results.append((filename, filepath, full_content, rank))
-        
-        return full_results
-
-    def search_filename_only(self, query: str, limit: int = 10000) -> List[Tuple[str, str, str, float]]:
-        """Search only in the filenames."""
-        cursor = self.conn.cursor()
+        visited = set()
+        while pending:
+            directory = pending.pop()
+            visited.add(directory)
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+                with os.scandir(directory) as it:
+                    entries = [entry for entry in it if not entry.name.startswith('.')]
+            except OSError:
+                stats['removed'] += self._remove_image_directory(directory)
+                continue
+            stats['directories'] += 1
+            volume = os.path.relpath(directory, image_directory).split(os.sep)[0]
+
+            existing = {path: (size, mtime) for path, size, mtime in self.conn.execute(
+                "SELECT image_path, size, mtime_ns FROM image_manifest WHERE directory = ?", (directory,))}
+            subdirectories = set()
+            rows = []
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.add(entry.path)
+                        if full or entry.path not in known:
+                            pending.append(entry.path)
+                        continue
+                    base_name, ext = os.path.splitext(entry.name)
+                    image_format = IMAGE_FORMATS.get(ext.lower())
+                    if image_format is None or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except OSError as e:
+                    print(f"Error reading directory entry {entry.path}: {str(e)}")
+                    continue
+                previous = existing.pop(entry.path, None)
+                if previous == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                stats['updated' if previous else 'added'] += 1
+                rows.append((entry.path, directory, volume, entry.name, base_name, image_format,
+                             stat.st_size, stat.st_mtime_ns))
+            self.conn.executemany('''
+                INSERT OR REPLACE INTO image_manifest
+                    (image_path, directory, volume, filename, base_name, format, size, mtime_ns)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            self.conn.executemany("DELETE FROM image_manifest WHERE image_path = ?", ((path,) for path in existing))
+            stats['removed'] += len(existing)
+
+            # Subdirectories from the last scan that are gone now
+            for path in known:
+                if os.path.dirname(path) == directory and path not in subdirectories:
+                    stats['removed'] += self._remove_image_directory(path)
+            self.conn.execute("INSERT OR REPLACE INTO image_directories (path, mtime_ns) VALUES (?, ?)",
+                              (directory, mtime_ns))
+
+        if full:
+            # Volumes that are no longer there, unless only some volumes were refreshed
+            for path in set(known) - visited:
+                if volumes is None or any(path == root or path.startswith(root + os.sep) for root in roots):
+                    stats['removed'] += self._remove_image_directory(path)
+        self.conn.commit()
+        return stats
+
+    def _refresh_image_archives(self, image_directory: str, volumes: List[str], stats: dict):
+        """
+        Re-read the member list of new and changed zip archives in image_directory.
+        Members outside a numbered directory get the volume number in the
+        archive's name, or else the archive's position in name order.
+        """
+        try:
+            with os.scandir(image_directory) as it:
+                archives = sorted((entry.path, entry.stat()) for entry in it
+                                  if entry.name.lower().endswith('.zip') and entry.is_file())
+        except OSError as e:
+            print(f"Error scanning directory {image_directory}: {str(e)}")
+            return
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in
+                 self.conn.execute("SELECT path, size, mtime_ns FROM image_archives")}
+        for ordinal, (path, stat) in enumerate(archives, 1):
+            if known.pop(path, None) == (stat.st_size, stat.st_mtime_ns):
+                continue
+            numbers = re.findall(r'\d+', os.path.basename(path))
+            default_volume = f"{int(numbers[-1]) if numbers else ordinal:03d}"
+            stats['removed'] += self.conn.execute("DELETE FROM archive_members WHERE archive = ?", (path,)).rowcount
+            try:
+                rows = [(path,) + member for member in _archive_members(path, default_volume)
+                        if volumes is None or member[1] in volumes]
+            except (OSError, zipfile.BadZipFile) as e:
+                print(f"Error reading archive {path}: {str(e)}")
+                continue
+            self.conn.executemany('''
+                INSERT OR REPLACE INTO archive_members
+                    (archive, member, volume, filename, base_name, format, data_offset,
+                     compressed_size, file_size, compress_type, crc)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            self.conn.execute("INSERT OR REPLACE INTO image_archives (path, size, mtime_ns) VALUES (?, ?, ?)",
+                              (path, stat.st_size, stat.st_mtime_ns))
+            stats['archives'] += 1
+            stats['added'] += len(rows)
+        # Archives that are gone
+        for path in known:
+            self.conn.execute("DELETE FROM image_archives WHERE path = ?", (path,))
+            stats['removed'] += self.conn.execute("DELETE FROM archive_members WHERE archive = ?", (path,)).rowcount
+
+    def _remove_image_directory(self, directory: str) -> int:
+        """Drop a directory and everything below it from the image manifest; returns the number of scans removed."""
+        below = directory + os.sep
+        self.conn.execute("DELETE FROM image_directories WHERE path = ? OR substr(path, 1, ?) = ?",
+                          (directory, len(below), below))
+        return self.conn.execute("DELETE FROM image_manifest WHERE directory = ? OR substr(directory, 1, ?) = ?",
+                                 (directory, len(below), below)).rowcount
+
+    def watch_image_manifest(self, image_directory: str, interval: float = 10, volumes: List[str] = None):
+        """
+        Refresh the image manifest every interval seconds until interrupted.
+        The database is switched to WAL mode so the web UI keeps reading it
+        while changes are written.
+        """
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        print(f"Watching {image_directory} every {interval:g}s (Ctrl-C to stop)")
+        try:
+            while True:
+                stats = self.refresh_image_manifest(image_directory, volumes, full=False)
+                if stats['added'] or stats['updated'] or stats['removed']:
+                    print(f"Images: {stats['added']} added, {stats['updated']} updated, {stats['removed']} removed")
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print("\nStopped watching.")
+
+    def table_sizes(self) -> dict:
+        """Return {table or index name: bytes on disk}, or {} if SQLite was built without dbstat."""
+        try:
+            cursor = self.conn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name")
+        except sqlite3.OperationalError:
+            return {}
+        return dict(cursor.fetchall())
+
+    def index_sizes(self) -> dict:
+        """Bytes used by the sample-based, passage and trigram indexes (with their FTS tables) and the content store."""
+        sizes = self.table_sizes()
+        return {
+            'sample': sum(size for name, size in sizes.items() if name.startswith('text_files')),
+            'passages': sum(size for name, size in sizes.items()
+                            if name.startswith('passages') and not name.startswith('passages_trigram')),
+            'trigram': sum(size for name, size in sizes.items() if name.startswith('passages_trigram')),
+            'content': sum(size for name, size in sizes.items() if name.startswith('document_content')),
+        }
+
+    def print_index_report(self, stats: dict = None):
+        """Print index sizes (and write times from an indexing run) for both indexes and the content store."""
+        sizes = self.index_sizes()
+        if not sizes['sample'] and not sizes['passages']:
+            print("Index sizes unavailable (SQLite built without dbstat)")
+            return
+        print(f"{'Index':<18}{'Size (MB)':>12}{'Write time (s)':>16}")
+        for label, key in (('Sample (10 KB)', 'sample'), ('Passages', 'passages'), ('Trigram', 'trigram'),
+                           ('Content store', 'content')):
+            if key == 'trigram' and not sizes[key]:
+                continue
+            # The trigram index is written by the passage triggers, so its time is part of the passages column
+            seconds = f"{stats[key + '_seconds']:.1f}" if stats and key + '_seconds' in stats else "-"
+            print(f"{label:<18}{sizes[key] / 1048576:>12.1f}{seconds:>16}")
+
+    def print_content_store_report(self, sample_count: int = 200):
+        """
+        Compare the content store with the files on disk: total size, and the
+        time to load a random sample of documents from the database versus
+        reading them from their filepath.
+        """
+        stored, compressed, characters = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0), COALESCE(SUM(length), 0) FROM document_content"
+        ).fetchone()
+        if not stored:
+            print("Content store is empty; files are loaded from disk.")
+            return
+        on_disk = self.conn.execute(
+            "SELECT COALESCE(SUM(m.size), 0) FROM file_manifest AS m JOIN document_content AS c ON c.file_id = m.file_id"
+        ).fetchone()[0]
+        print(f"Content store: {stored} documents, {compressed / 1048576:.1f} MB compressed, "
+              f"{on_disk / 1048576:.1f} MB of text files on disk ({characters} characters), "
+              f"ratio {on_disk / max(compressed, 1):.1f}x")
 
-        # Use FTS to search in filename only
-        # For phrase search (multi-word queries), wrap in quotes
-        if ' ' in query:
-            escaped_query = query.replace('"', '""')  # Escape double quotes
-            quoted_query = f'"{escaped_query}"'
+        sample = self.conn.execute(
+            "SELECT m.file_id, m.filepath FROM file_manifest AS m JOIN document_content AS c ON c.file_id = m.file_id "
+            "ORDER BY RANDOM() LIMIT ?", (sample_count,)
+        ).fetchall()
+        start_time = time.perf_counter()
+        for file_id, _ in sample:
+            load_document(self.conn, file_id)
+        db_seconds = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        readable = 0
+        for _, filepath in sample:
+            try:
+                with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
+                    f.read()
+                readable += 1
+            except OSError:
+                pass
+        disk_seconds = time.perf_counter() - start_time
+        print(f"Loading {len(sample)} documents: {db_seconds * 1000 / len(sample):.3f} ms each from the database", end="")
+        if readable:
+            print(f", {disk_seconds * 1000 / readable:.3f} ms each from disk")
         else:
-            quoted_query = query
-            
-        cursor.execute(
-            '''
-            SELECT
-                tf.filename,
-                tf.filepath,
-                tf.content,
-                text_files_fts.rank
-            FROM text_files_fts
-            JOIN text_files AS tf ON text_files_fts.rowid = tf.id
-            WHERE text_files_fts MATCH ?
-            ORDER BY text_files_fts.rank
-            LIMIT ?
-            ''',
-            (f"filename:{quoted_query}", limit)
-        )
+            print(", files not available on disk")
+
+    def print_fts_structure(self, fts_tables=FTS_TABLES):
+        """Print the segment count per level and the merge settings of each FTS table."""
+        for fts_table in fts_tables:
+            levels = fts_segment_levels(self.conn, fts_table)
+            config = dict(self.conn.execute(f"SELECT k, v FROM {fts_table}_config").fetchall())
+            total = sum(count for count, _ in levels)
+            print(f"{fts_table}: {total} segment{'s' if total != 1 else ''} in {len(levels)} level{'s' if len(levels) != 1 else ''} "
+                  f"(automerge={config.get('automerge', 4)}, crisismerge={config.get('crisismerge', 16)})")
+            for level, (count, pages) in enumerate(levels):
+                if count:
+                    print(f"  level {level}: {count} segment{'s' if count != 1 else ''}, {pages} page{'s' if pages != 1 else ''}")
+
+    def maintain_fts_index(self, fts_tables=FTS_TABLES, merge_seconds: float = 0, merge_pages: int = 500,
+                           automerge: int = None, crisismerge: int = None, optimize: bool = False):
+        """
+        Maintain the FTS5 segment b-trees without taking the database offline.
+
+        The database is switched to WAL mode and every step is its own short
+        transaction, so readers such as the web UI keep serving queries from
+        the same file while this runs.
+        """
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        for fts_table in fts_tables:
+            if automerge is not None:
+                self.conn.execute(f"INSERT INTO {fts_table}({fts_table}, rank) VALUES('automerge', ?)", (automerge,))
+                self.conn.commit()
+                print(f"{fts_table}: automerge set to {automerge}")
+            if crisismerge is not None:
+                self.conn.execute(f"INSERT INTO {fts_table}({fts_table}, rank) VALUES('crisismerge', ?)", (crisismerge,))
+                self.conn.commit()
+                print(f"{fts_table}: crisismerge set to {crisismerge}")
+
+        if merge_seconds > 0:
+            deadline = time.monotonic() + merge_seconds
+            for fts_table in fts_tables:
+                steps = 0
+                while time.monotonic() < deadline:
+                    changes_before = self.conn.total_changes
+                    self.conn.execute(f"INSERT INTO {fts_table}({fts_table}, rank) VALUES('merge', ?)", (merge_pages,))
+                    self.conn.commit()
+                    steps += 1
+                    # Fewer than two changed rows means there was nothing left to merge
+                    if self.conn.total_changes - changes_before < 2:
+                        break
+                print(f"{fts_table}: ran {steps} merge step{'s' if steps != 1 else ''} of up to {merge_pages} pages")
+
+        if optimize:
+            for fts_table in fts_tables:
+                start_time = time.perf_counter()
+                self.conn.execute(f"INSERT INTO {fts_table}({fts_table}) VALUES('optimize')")
+                self.conn.commit()
+                print(f"{fts_table}: optimized in {time.perf_counter() - start_time:.1f}s")
+
+    def has_passages(self) -> bool:
+        """Check whether the full-document passage index has been built."""
+        return has_passage_index(self.conn)
+
+    def load_full_content(self, filepath: str) -> str:
+        """Load the full content of a file on demand, from the content store when it is there."""
+        text = load_document_by_path(self.conn, filepath)
+        if text is not None:
+            return text
+        try:
+            with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
+                return f.read()
+        except Exception as e:
+            print(f"Error loading file {filepath}: {str(e)}")
+            return ""
+
+    def search(self, query: str, limit: int = 10000) -> List[Tuple[str, str, str, int, float]]:
+        """Search the content and filenames of the documents; see search_content_only for the rows returned."""
+        return [row[1:] for row in query_index(self.conn, query, "all", limit)]
+
+    def search_content_only(self, query: str, limit: int = 10000) -> List[Tuple[str, str, str, int, float]]:
+        """
+        Search only in the content of documents.
+        Returns (filename, filepath, text, offset, rank) rows ordered by rank:
+        text is the best matching passage and offset its start in the
+        document, or the 10 KB sample and None without a passage index.
+        """
+        return [row[1:] for row in query_index(self.conn, query, "content", limit)]
 
-        results = cursor.fetchall()
-        
-        # Replace the sample content with full content for display
-        full_results = []
-        for filename, filepath, sample_content, rank in results:
-            full_content = self.load_full_content(filepath)
-            full_results.append((filename, filepath, full_content, rank))
-        
-        return full_results
+    def search_filename_only(self, query: str, limit: int = 10000) -> List[Tuple[str, str, str, int, float]]:
+        """Search only in the filenames. Bates numbers, prefixes and ranges are looked up by number."""
+        return [row[1:] for row in query_index(self.conn, query, "filename", limit)]
 
     def count_files(self) -> int:
         """Get the total number of indexed files."""
@@ -257,35 +3628,303 @@ class TextSearchDatabase:
             self.conn.close()
 
 
+def parse_date_filters(text: str) -> Tuple[str, str, str]:
+    """
+    Split 'from:' and 'to:' date filters off an interactive search, returning
+    (query, date_from, date_to) with the dates normalized by date_bound.
+    """
+    date_from = date_to = None
+    words = []
+    for word in text.split(' '):
+        if word.lower().startswith('from:'):
+            date_from = date_bound(word[5:])
+        elif word.lower().startswith('to:'):
+            date_to = date_bound(word[3:], end=True)
+        else:
+            words.append(word)
+    return ' '.join(words).strip(), date_from, date_to
+
+
+def _print_result(number: int, filename: str, filepath: str, content: str, offset: int, rank: float,
+                  similar: int = 0):
+    """Print one search result in the interactive search mode."""
+    # Show a preview of the content around the search term
+    content_preview = content[:500]  # First 500 chars
+    if len(content) > 500:
+        content_preview += "..."
+
+    print(f"\n{number}. File: {filename}" + (f" ({similar} similar)" if similar else ""))
+    print(f"   Path: {filepath}")
+    if offset is not None:
+        print(f"   Offset: {offset}")
+    print(f"   Preview: {content_preview}")
+    print(f"   Rank: {rank}")
+    print("-" * 80)
+
+
 def main():
-    db = TextSearchDatabase()
+    parser = argparse.ArgumentParser(description="Build or search the text search database.")
+    parser.add_argument("--db", default="text_search.db",
+                        help="Database file (default: %(default)s)")
+    parser.add_argument("--shards", action="store_true",
+                        help="Search the per-volume shard databases next to --db instead of --db itself")
+    parser.add_argument("--collapse-duplicates", action="store_true",
+                        help="Show one result per group of near-duplicate documents")
+    subparsers = parser.add_subparsers(dest="command")
+
+    index_parser = subparsers.add_parser("index", help="Index all text files in a directory")
+    index_parser.add_argument("text_dir", nargs="?", default=DEFAULT_TEXT_DIR,
+                              help="Directory containing the text files (default: %(default)s)")
+    index_parser.add_argument("--workers", type=int, default=1,
+                              help="Number of worker processes reading files (default: 1)")
+    index_parser.add_argument("--bulk", action="store_true",
+                              help="Bulk-load mode: disable FTS triggers and rebuild the index once at the end")
+    index_parser.add_argument("--incremental", action="store_true",
+                              help="Only index new or changed files and remove deleted ones")
+    index_parser.add_argument("--resume", action="store_true",
+                              help="Continue an interrupted build after its last committed batch")
+    index_parser.add_argument("--no-passages", action="store_true",
+                              help="Only build the 10 KB sample index, not the full-document passage index")
+    index_parser.add_argument("--entities", action="store_true",
+                              help="Extract emails, phone numbers, dollar amounts and person names into entity tables")
+    index_parser.add_argument("--dates", action="store_true",
+                              help="Extract the dates mentioned in each document for from:/to: filters")
+    index_parser.add_argument("--dedupe", action="store_true",
+                              help="Compute MinHash signatures and group near-duplicate documents")
+    index_parser.add_argument("--trigram", action="store_true",
+                              help="Also build the trigram index used by substring searches")
+    index_parser.add_argument("--no-content-store", action="store_true",
+                              help="Don't store compressed full text in the database; load files from disk")
+    index_parser.add_argument("--contentless", action="store_true",
+                              help="For a new database, keep passage text only in the content store "
+                                   "(contentless passage index)")
+    index_parser.add_argument("--shards", action="store_true", dest="build_shards",
+                              help="Build one shard database per volume directory (001-012) instead of one database")
+    index_parser.add_argument("--volume", action="append",
+                              help="With --shards, only rebuild this volume (can be repeated)")
 
-    if len(sys.argv) > 1 and sys.argv[1] == "index":
-        # Index all text files
-        text_dir = "/home/jon/Documents/Epstein dump nov 12/TEXT"
-        if len(sys.argv) > 2:
-            text_dir = sys.argv[2]
+    subparsers.add_parser("stats", help="Report index sizes and content store load times")
 
+    images_parser = subparsers.add_parser("images", help="Build or refresh the text-to-image manifest")
+    images_parser.add_argument("image_dir", nargs="?", default=DEFAULT_IMAGE_DIR,
+                               help="Directory containing the image volume directories 001-012 (default: %(default)s)")
+    images_parser.add_argument("--changed", action="store_true",
+                               help="Only list directories whose modification time changed since the last refresh")
+    images_parser.add_argument("--watch", type=float, metavar="SECONDS",
+                               help="Keep refreshing changed directories every SECONDS until interrupted")
+    images_parser.add_argument("--shards", action="store_true", dest="build_shards",
+                               help="Write each volume's images into its shard database")
+    images_parser.add_argument("--volume", action="append",
+                               help="Only refresh this volume (can be repeated)")
+
+    thumbnails_parser = subparsers.add_parser("thumbnails",
+                                              help="Render the scaled copies of every scan in the image manifest")
+    thumbnails_parser.add_argument("--cache-dir", default="image_cache",
+                                   help="Derivative cache directory (default: %(default)s)")
+    thumbnails_parser.add_argument("--size", choices=list(DERIVATIVE_SIZES), action="append",
+                                   help="Size to render (default: all)")
+    thumbnails_parser.add_argument("--format", choices=list(DERIVATIVE_FORMATS), default="jpeg",
+                                   help="Image format of the copies (default: %(default)s)")
+    thumbnails_parser.add_argument("--max-mb", type=int, default=DERIVATIVE_CACHE_BYTES // 1048576,
+                                   help="Cache size limit in MB (default: %(default)s)")
+    thumbnails_parser.add_argument("--workers", type=int, default=None,
+                                   help="Number of worker processes rendering images (default: one per CPU)")
+
+    similar_parser = subparsers.add_parser("similar", help="Find the documents most similar to a document")
+    similar_parser.add_argument("document", nargs="?",
+                                help="Document id or filename (e.g. HOUSE_OVERSIGHT_010477.txt)")
+    similar_parser.add_argument("--build", action="store_true",
+                                help="Build the TF-IDF similarity matrix from the indexed text first")
+    similar_parser.add_argument("-k", type=int, default=SIMILARITY_TOP_K,
+                                help="Number of similar documents to show (default: %(default)s)")
+
+    maintain_parser = subparsers.add_parser("maintain", help="Report and merge FTS5 index segments")
+    maintain_parser.add_argument("--table", choices=FTS_TABLES, action="append",
+                                 help="FTS table to maintain (default: all)")
+    maintain_parser.add_argument("--merge", type=float, default=0, metavar="SECONDS",
+                                 help="Run incremental merge steps for up to this many seconds")
+    maintain_parser.add_argument("--merge-pages", type=int, default=500,
+                                 help="Pages written per merge step (default: 500)")
+    maintain_parser.add_argument("--automerge", type=int, help="Set the FTS5 automerge option")
+    maintain_parser.add_argument("--crisismerge", type=int, help="Set the FTS5 crisismerge option")
+    maintain_parser.add_argument("--optimize", action="store_true",
+                                 help="Merge each index into a single segment")
+
+    args = parser.parse_args()
+
+    if args.command == "index":
+        text_dir = args.text_dir
         if not os.path.exists(text_dir):
             print(f"Error: Directory {text_dir} does not exist!")
             sys.exit(1)
 
-        db.index_text_files(text_dir)
+        index_options = dict(workers=args.workers, bulk=args.bulk, incremental=args.incremental,
+                             passages=not args.no_passages, resume=args.resume, dedupe=args.dedupe, entities=args.entities, dates=args.dates,
+                             store_content=not args.no_content_store, trigram=args.trigram)
+        if args.build_shards:
+            try:
+                build_shards(text_dir, args.db, args.volume, contentless=args.contentless, **index_options)
+            except ValueError as e:
+                print(f"Error: {e}")
+                sys.exit(1)
+            print(f"Shards available: {len(find_shards(args.db))}")
+            return
+
+        db = TextSearchDatabase(args.db, contentless=args.contentless)
+        try:
+            db.index_text_files(text_dir, **index_options)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
         print(f"Database created with {db.count_files()} files indexed.")
+    elif args.command == "stats":
+        db = TextSearchDatabase(args.db)
+        print(f"Database contains {db.count_files()} indexed files.")
+        db.print_index_report()
+        db.print_content_store_report()
+    elif args.command == "images":
+        if not os.path.isdir(args.image_dir):
+            print(f"Error: Directory {args.image_dir} does not exist!")
+            sys.exit(1)
+        if args.build_shards:
+            targets = [(shard, [volume]) for shard in find_shards(args.db)
+                       for volume in [re.search(r"\.(\d{3})\.\w+$", shard).group(1)]
+                       if not args.volume or volume in args.volume]
+            if not targets:
+                print(f"Error: No shard databases found next to {args.db}")
+                sys.exit(1)
+        else:
+            targets = [(args.db, args.volume)]
+        for path, volumes in targets:
+            db = TextSearchDatabase(path)
+            start_time = time.perf_counter()
+            stats = db.refresh_image_manifest(args.image_dir, volumes, full=not args.changed)
+            images = db.conn.execute("SELECT COUNT(*) FROM image_manifest").fetchone()[0]
+            images += db.conn.execute("SELECT COUNT(*) FROM archive_members").fetchone()[0]
+            print(f"{path}: {images} images; listed {stats['directories']} directories and {stats['archives']} archives, "
+                  f"{stats['added']} added, {stats['updated']} updated, {stats['removed']} removed "
+                  f"in {time.perf_counter() - start_time:.2f}s")
+            if args.watch is None:
+                db.close()
+                db = None
+        if args.watch is not None:
+            if len(targets) > 1:
+                print("Error: --watch needs a single database; run one watcher per shard with --db and --volume")
+                sys.exit(1)
+            db.watch_image_manifest(args.image_dir, args.watch, targets[0][1])
+    elif args.command == "thumbnails":
+        db = None
+        if Image is None:
+            print("Error: Rendering thumbnails needs Pillow (pip install Pillow)")
+            sys.exit(1)
+        image_paths = []
+        for path in (find_shards(args.db) if args.shards else [args.db]):
+            if not os.path.exists(path):
+                continue
+            conn = sqlite3.connect(path)
+            if has_image_manifest(conn):
+                image_paths.extend(row[0] for row in conn.execute("SELECT image_path FROM image_manifest"))
+                # Scans in the archives, unless they were unzipped as well
+                image_paths.extend(ArchiveScan(*row) for row in conn.execute(f'''
+                    SELECT {_ARCHIVE_SCAN_COLUMNS} FROM archive_members
+                    WHERE NOT EXISTS (SELECT 1 FROM image_manifest AS im
+                                      WHERE im.volume = archive_members.volume
+                                        AND im.filename = archive_members.filename)
+                '''))
+            conn.close()
+        if not image_paths:
+            print("Error: No image manifest found; build it with the images command first")
+            sys.exit(1)
+        cache = DerivativeCache(args.cache_dir, args.max_mb * 1048576, args.format)
+        stats = cache.generate(image_paths, args.size, args.workers)
+        print(f"Rendered {stats['rendered']} copies of {len(image_paths)} images in {stats['seconds']:.1f}s "
+              f"({stats['cached']} already cached, {stats['failed']} failed); "
+              f"cache uses {cache.usage() / 1048576:.1f} MB")
+    elif args.command == "similar":
+        db = None
+        if sparse is None:
+            print("Error: Document similarity needs NumPy and SciPy (pip install numpy scipy)")
+            sys.exit(1)
+        if args.build:
+            build_similarity_index(args.db)
+        if args.document is None:
+            if not args.build:
+                print("Error: Give a document id or filename, or --build")
+                sys.exit(1)
+            return
+        try:
+            index = SimilarityIndex(args.db)
+        except FileNotFoundError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        conn = connect_read_only(args.db)
+        row = conn.execute("SELECT id, filename FROM text_files WHERE id = ? OR filename = ? LIMIT 1",
+                           (int(args.document) if args.document.isdigit() else None, args.document)).fetchone()
+        if row is None:
+            print(f"Error: No document {args.document}")
+            sys.exit(1)
+        start_time = time.perf_counter()
+        try:
+            neighbours = index.similar(row[0], args.k)
+        except KeyError:
+            print(f"Error: {row[1]} was indexed after the similarity matrix was built; rebuild it with --build")
+            sys.exit(1)
+        elapsed = (time.perf_counter() - start_time) * 1000
+        print(f"Documents most similar to {row[1]} (id {row[0]}), found in {elapsed:.1f} ms:")
+        number = 0
+        for file_id, score in neighbours:
+            row = conn.execute("SELECT filename, filepath FROM text_files WHERE id = ?", (file_id,)).fetchone()
+            if row is None:
+                continue  # Deleted since the matrix was built
+            number += 1
+            print(f"{number:3}. {score:.3f}  {row[0]} (id {file_id})  {row[1]}")
+        conn.close()
+    elif args.command == "maintain":
+        db = TextSearchDatabase(args.db)
+        fts_tables = args.table or db.fts_tables()
+        db.print_fts_structure(fts_tables)
+        if args.merge or args.optimize or args.automerge is not None or args.crisismerge is not None:
+            db.maintain_fts_index(fts_tables, merge_seconds=args.merge, merge_pages=args.merge_pages,
+                                  automerge=args.automerge, crisismerge=args.crisismerge,
+                                  optimize=args.optimize)
+            db.print_fts_structure(fts_tables)
     else:
         # Interactive search mode
+        db = None
+        sharded = None
         print("Text Search Database")
         print("====================")
-        print(f"Database contains {db.count_files()} indexed files.")
+        if args.shards:
+            shards = find_shards(args.db)
+            if not shards:
+                print(f"Error: No shard databases found next to {args.db}")
+                sys.exit(1)
+            sharded = ShardedTextSearch(shards)
+            print(f"Searching {len(shards)} shard databases with {sharded.workers} worker processes.")
+        else:
+            db = TextSearchDatabase(args.db)
+            print(f"Database contains {db.count_files()} indexed files.")
+            if db.has_passages():
+                print("Content searches use the full-document passage index.")
         print("\nCommands:")
         print("  'search <query>' - Search in content only (default)")
         print("  'all <query>' - Search in content and filename")
         print("  'content <query>' - Search in content only")
         print("  'filename <query>' - Search in filename only")
+        print("  'substring <text>' - Search document text for text anywhere inside words (* and ? are wildcards)")
+        print("  'regex <pattern>' - Search with a regular expression, printing matches as they are found")
+        print("  'email|phone|amount|person <value>' - Documents mentioning an extracted entity")
+        print("  Queries support AND, OR, NOT or -word, \"phrases\", prefix*, NEAR(a b, n) and content:/filename: filters")
+        print("  Add 'from:YYYY[-MM[-DD]]' and/or 'to:YYYY[-MM[-DD]]' to any search to filter by mentioned dates")
         print("  'quit' or 'exit' - Exit the program")
         print("\nExample: search Epstein")
         print("Example: all Clinton")
+        print('Example: search "flight log" OR NEAR(Clinton island, 5) -draft')
         print("Example: filename 010477")
+        print("Example: substring pstei")
+        print(r"Example: regex \(\d{3}\) \d{3}-\d{4}")
+        print("Example: phone (212) 555-0100")
+        print("Example: search Clinton from:2002 to:2005")
 
         while True:
             try:
@@ -303,20 +3942,43 @@ def main():
                     continue
 
                 command = parts[0].lower()
-                query = parts[1]
-
-                if command == 'search':
-                    results = db.search_content_only(query)  # Default to content search
-                elif command == 'content':
-                    results = db.search_content_only(query)
-                elif command == 'filename':
-                    results = db.search_filename_only(query)
-                elif command == 'all':
-                    results = db.search(query)  # Search both content and filename
-                else:
-                    print(f"Unknown command: {command}. Use 'search' (content only, default), 'all' (content and filename), 'content', or 'filename'.")
+                query, date_from, date_to = parse_date_filters(parts[1])
+                if not query:
+                    print("Please provide a search query as well as the date range.")
+                    continue
+
+                if command not in ('search', 'content', 'filename', 'all', 'substring', 'regex') + ENTITY_KINDS:
+                    print(f"Unknown command: {command}. Use 'search' (content only, default), 'all' (content and filename), 'content', 'filename', 'substring', 'regex', or an entity kind ({', '.join(ENTITY_KINDS)}).")
+                    continue
+                search_type = 'content' if command == 'search' else command  # Default to content search
+
+                if search_type == 'regex' and sharded is None:
+                    # Print each match as soon as a worker confirms it
+                    found = 0
+                    for found, (_, filename, filepath, content, offset, rank) in enumerate(
+                            iter_regex_search(args.db, query, date_from=date_from, date_to=date_to), 1):
+                        _print_result(found, filename, filepath, content, offset, rank)
+                    print(f"\nFound {found} results for '{query}'." if found else "No results found.")
                     continue
 
+                # Passage hits carry their offset and sample hits start at the top of the file,
+                # so no file has to be read for the preview
+                if sharded is not None:
+                    rows = [row[1:] for row in sharded.search(query, search_type,
+                                                              collapse_duplicates=args.collapse_duplicates,
+                                                              date_from=date_from, date_to=date_to)]
+                else:
+                    rows = query_index(db.conn, query, search_type, collapse_duplicates=args.collapse_duplicates,
+                                       date_from=date_from, date_to=date_to)
+                results = [(filename, filepath, text, offset, rank, similar[0] if similar else 0)
+                           for _, filename, filepath, text, offset, rank, *similar in rows]
+
+                if len(results) < SPELL_SUGGEST_BELOW and search_type in ('content', 'all'):
+                    corrections = (sharded.spelling_corrections(query) if sharded is not None
+                                   else spelling_corrections(db.conn, query))
+                    if corrections:
+                        print("Did you mean: " + ", ".join(corrected for corrected, _, _ in corrections) + "?")
+
                 if not results:
                     print("No results found.")
                     continue
@@ -324,17 +3986,8 @@ def main():
                 print(f"\nFound {len(results)} results for '{query}':")
                 print("-" * 80)
 
-                for i, (filename, filepath, content, rank) in enumerate(results, 1):
-                    # Show a preview of the content around the search term
-                    content_preview = content[:500]  # First 500 chars
-                    if len(content) > 500:
-                        content_preview += "..."
-
-                    print(f"\n{i}. File: {filename}")
-                    print(f"   Path: {filepath}")
-                    print(f"   Preview: {content_preview}")
-                    print(f"   Rank: {rank}")
-                    print("-" * 80)
+                for i, (filename, filepath, content, offset, rank, similar) in enumerate(results, 1):
+                    _print_result(i, filename, filepath, content, offset, rank, similar)
 
             except KeyboardInterrupt:
                 print("\nExiting...")
@@ -342,7 +3995,11 @@ def main():
             except Exception as e:
                 print(f"Error: {str(e)}")
 
-    db.close()
+        if sharded is not None:
+            sharded.close()
+
+    if db is not None:
+        db.close()
 
 
 if __name__ == "__main__":
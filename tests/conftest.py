@@ -0,0 +1,50 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from searchable_text_db_efficient import TextSearchDatabase
+
+
+def write_texts(directory, texts):
+    """Write {relative path: text} under directory, creating subdirectories; returns directory."""
+    for name, text in texts.items():
+        path = directory / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+    return directory
+
+
+@pytest.fixture(name="write_texts")
+def write_texts_fixture():
+    """write_texts, for tests that build several directories."""
+    return write_texts
+
+
+@pytest.fixture
+def text_dir(tmp_path):
+    """A TEXT directory to fill with write_texts."""
+    directory = tmp_path / "TEXT"
+    directory.mkdir()
+    return directory
+
+
+@pytest.fixture
+def indexed(tmp_path):
+    """
+    Factory for a TextSearchDatabase in tmp_path with a directory indexed
+    into it: indexed(text_dir, **index_options). Closed after the test.
+    """
+    databases = []
+
+    def index(directory, db_name="test.db", contentless=False, **options):
+        db = TextSearchDatabase(str(tmp_path / db_name), contentless=contentless)
+        databases.append(db)
+        db.index_text_files(str(directory), **options)
+        return db
+
+    yield index
+    for db in databases:
+        db.close()
@@ -0,0 +1,46 @@
+import pytest
+
+from searchable_text_db_efficient import parse_bates, parse_bates_query, query_index
+
+
+@pytest.mark.parametrize("filename, parsed", [
+    ("HOUSE_OVERSIGHT_010477.txt", ("HOUSE_OVERSIGHT", 10477, "010477")),
+    ("HOUSE-OVERSIGHT 010477.txt", ("HOUSE_OVERSIGHT", 10477, "010477")),
+    ("DOJ-OGR-00012345.txt", ("DOJ_OGR", 12345, "00012345")),
+    ("010477.txt", (None, 10477, "010477")),
+    ("notes.txt", (None, None, None)),
+])
+def test_parse_bates(filename, parsed):
+    assert parse_bates(filename) == parsed
+
+
+@pytest.mark.parametrize("query, parsed", [
+    ("010477", ("exact", None, 10477, 10477)),
+    ("HOUSE_OVERSIGHT_010477", ("exact", "HOUSE_OVERSIGHT", 10477, 10477)),
+    ("0104*", ("prefix", None, "0104", "0104")),
+    ("010400-010500", ("range", None, 10400, 10500)),
+    ("010400 – 010500", ("range", None, 10400, 10500)),
+    ("10400..10500", ("range", None, 10400, 10500)),
+    ("10400 to 10500", ("range", None, 10400, 10500)),
+    ("house oversight 010400-010500", ("range", "HOUSE_OVERSIGHT", 10400, 10500)),
+    ("HOUSE_OVERSIGHT_010400-HOUSE_OVERSIGHT_010500", ("range", "HOUSE_OVERSIGHT", 10400, 10500)),
+    ("clinton", None),
+    ("010477 island", None),
+])
+def test_parse_bates_query(query, parsed):
+    assert parse_bates_query(query) == parsed
+
+
+def test_filename_search_by_bates_number(text_dir, write_texts, indexed):
+    texts = {f"HOUSE_OVERSIGHT_{number:06d}.txt": f"page {number}" for number in (10399, 10400, 10450, 10500, 10501)}
+    texts["DOJ_OGR_010450.txt"] = "another production"
+    db = indexed(write_texts(text_dir, texts))
+
+    def filenames(query):
+        return [row[1] for row in query_index(db.conn, query, "filename")]
+
+    # Ranges are inclusive and come back in number order
+    assert filenames("HOUSE_OVERSIGHT_010400-010500") == [
+        "HOUSE_OVERSIGHT_010400.txt", "HOUSE_OVERSIGHT_010450.txt", "HOUSE_OVERSIGHT_010500.txt"]
+    assert sorted(filenames("010450")) == ["DOJ_OGR_010450.txt", "HOUSE_OVERSIGHT_010450.txt"]
+    assert filenames("HOUSE_OVERSIGHT_01050*") == ["HOUSE_OVERSIGHT_010500.txt", "HOUSE_OVERSIGHT_010501.txt"]
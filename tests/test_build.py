@@ -0,0 +1,41 @@
+import pytest
+
+from searchable_text_db_efficient import iter_text_files
+
+
+def snapshot(db):
+    """Indexed rows and search results that must not depend on how the index was built."""
+    conn = db.conn
+    return (
+        conn.execute("SELECT filename, filepath, content FROM text_files ORDER BY filepath").fetchall(),
+        conn.execute("SELECT tf.filepath, p.start_offset, p.end_offset FROM passages AS p "
+                     "JOIN text_files AS tf ON tf.id = p.file_id ORDER BY tf.filepath, p.start_offset").fetchall(),
+        sorted(row[1] for row in db.search_content_only("common")),
+        sorted(row[1] for row in db.search_content_only("rare7")),
+        conn.execute("SELECT term, documents FROM vocabulary ORDER BY term").fetchall(),
+    )
+
+
+@pytest.mark.parametrize("options", [dict(bulk=True), dict(workers=2), dict(workers=2, bulk=True)])
+def test_builds_are_equivalent(tmp_path, text_dir, write_texts, indexed, options):
+    write_texts(text_dir, {f"{i % 3:03d}/DOC_{i:06d}.txt": f"common text rare{i} " + "filler " * (i * 40)
+                           for i in range(30)})
+    expected = snapshot(indexed(text_dir, "serial.db", batch_size=7))
+    db = indexed(text_dir, "other.db", batch_size=7, **options)
+    assert snapshot(db) == expected
+    # Bulk-load mode restores the FTS sync triggers and rebuilds the indexes at the end
+    assert db.conn.execute("PRAGMA integrity_check").fetchone() == ("ok",)
+    assert db.conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger'").fetchone()[0] > 0
+    db.conn.execute("INSERT INTO text_files_fts(text_files_fts) VALUES ('integrity-check')")
+    db.conn.execute("INSERT INTO passages_fts(passages_fts) VALUES ('integrity-check')")
+
+
+
+def test_file_discovery_walks_files_then_sorted_subdirectories(text_dir, write_texts):
+    write_texts(text_dir, {"z.txt": "", "b/2.txt": "", "a/1.txt": "", "a/sub/3.txt": "", "a/4.txt": "",
+                           "notes.pdf": "", "a/.hidden.txt": "", ".cache/5.txt": ""})
+    paths = [path[len(str(text_dir)) + 1:] for path, _, _ in iter_text_files(str(text_dir))]
+    assert paths == ["z.txt", "a/1.txt", "a/4.txt", "a/sub/3.txt", "b/2.txt"]
+    # Resuming skips everything up to and including the last committed path
+    resumed = iter_text_files(str(text_dir), start_after=str(text_dir / "a" / "4.txt"))
+    assert [path[len(str(text_dir)) + 1:] for path, _, _ in resumed] == ["a/sub/3.txt", "b/2.txt"]
@@ -0,0 +1,52 @@
+import pytest
+
+from searchable_text_db_efficient import date_bound, extract_dates, parse_date_filters, query_index
+
+
+def test_extract_dates_normalizes_every_format():
+    text = ("Flight on 2004-08-17, again 8/18/2004 and 8/19/04. Signed August 20, 2004; "
+            "filed 21st Aug 2004. Not dates: 13/45/2004, 1850-01-01, 2004-02-30.")
+    assert extract_dates(text) == ["2004-08-17", "2004-08-18", "2004-08-19", "2004-08-20", "2004-08-21"]
+
+
+def test_two_digit_years():
+    assert extract_dates("1/2/99 and 1/2/05") == ["1999-01-02", "2005-01-02"]
+
+
+@pytest.mark.parametrize("text, start, end", [
+    ("2004", "2004-01-01", "2004-12-31"),
+    ("2004-2", "2004-02-01", "2004-02-29"),
+    ("2003-02", "2003-02-01", "2003-02-28"),
+    ("2004-12", "2004-12-01", "2004-12-31"),
+    ("2004-08-17", "2004-08-17", "2004-08-17"),
+])
+def test_date_bound(text, start, end):
+    assert date_bound(text) == start
+    assert date_bound(text, end=True) == end
+
+
+@pytest.mark.parametrize("text", ["2004-13", "2004-02-30", "2004-00", "04", "August 2004", ""])
+def test_date_bound_rejects_invalid_dates(text):
+    with pytest.raises(ValueError, match=r"^Invalid date: .*\(use YYYY, YYYY-MM or YYYY-MM-DD\)"):
+        date_bound(text)
+
+
+def test_parse_date_filters():
+    assert parse_date_filters("flight logs from:2002 to:2005-06") == ("flight logs", "2002-01-01", "2005-06-30")
+    assert parse_date_filters("flight logs") == ("flight logs", None, None)
+
+
+def test_date_range_filters_search_results(text_dir, write_texts, indexed):
+    db = indexed(write_texts(text_dir, {
+        "DOC_000001.txt": "memo written on March 3, 2002",
+        "DOC_000002.txt": "memo written on 2005-07-01",
+        "DOC_000003.txt": "memo without a date",
+    }), dates=True)
+
+    def filenames(date_from, date_to):
+        return sorted(row[1] for row in query_index(db.conn, "memo", date_from=date_from, date_to=date_to))
+
+    assert filenames("2002-01-01", "2002-12-31") == ["DOC_000001.txt"]
+    assert filenames("2003-01-01", None) == ["DOC_000002.txt"]
+    assert filenames(None, "2005-07-01") == ["DOC_000001.txt", "DOC_000002.txt"]
+    assert filenames(None, None) == ["DOC_000001.txt", "DOC_000002.txt", "DOC_000003.txt"]
@@ -0,0 +1,18 @@
+import os
+
+from searchable_text_db_efficient import DerivativeCache
+
+
+def test_eviction_leaves_copies_being_written_alone(tmp_path):
+    cache = DerivativeCache(str(tmp_path / "cache"), max_bytes=2500)
+    directory = tmp_path / "cache" / "thumb" / "ab"
+    directory.mkdir(parents=True)
+    for age, name in enumerate(["old.jpg", "newer.jpg", "newest.jpg"]):
+        (directory / name).write_bytes(b"x" * 1000)
+        os.utime(directory / name, ns=(age * 10 ** 9, age * 10 ** 9))
+    (directory / "abc123.tmp").write_bytes(b"x" * 5000)
+    assert cache.usage() == 3000
+    cache._added(0)
+    # Evicted down to 90% of the limit, least recently used first
+    assert sorted(os.listdir(directory)) == ["abc123.tmp", "newer.jpg", "newest.jpg"]
+    assert cache.total_bytes == 2000
@@ -0,0 +1,33 @@
+from searchable_text_db_efficient import extract_entities, normalize_entity
+
+
+def test_email_extraction():
+    entities = extract_entities("Mail j.doe+x@mail.example.com or JDOE@Example.org, not foo@bar")
+    emails = sorted(value for kind, value, _, _ in entities if kind == 'email')
+    assert emails == ['j.doe+x@mail.example.com', 'jdoe@example.org']
+
+
+def test_phone_amount_and_person_extraction():
+    text = ("Call (212) 555-0100 or 212.555.0100, paid $2.5 million and $1,200.50 "
+            "to John Smith and Jane Q. Doe in New York")
+    assert extract_entities(text) == [
+        ('phone', '212-555-0100', 5, 2),
+        ('amount', '2500000.00', 42, 1),
+        ('amount', '1200.50', 59, 1),
+        ('person', 'John Smith', 72, 1),
+        ('person', 'Jane Q Doe', 87, 1),
+    ]
+
+
+def test_queries_normalize_like_the_documents():
+    assert normalize_entity('phone', '+1 212 555 0100') == '212-555-0100'
+    assert normalize_entity('amount', '$2,500,000') == '2500000.00'
+    assert normalize_entity('person', 'john  smith') == 'John Smith'
+
+
+def test_long_runs_without_at_sign_have_no_matches():
+    # These took seconds when the email pattern could start inside a run;
+    # the inputs are sized so a regression is slow without timing the test
+    for text in ('_' * 4000, '.' * 4000, 'a' * 8000, 'x@' + 'b' * 8000):
+        assert [kind for kind, _, _, _ in extract_entities(text) if kind == 'email'] == [], \
+            f"{len(text)} x {text[-1]!r}"
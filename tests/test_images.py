@@ -0,0 +1,89 @@
+import os
+import struct
+import zipfile
+import zlib
+
+import pytest
+
+from searchable_text_db_efficient import (TextSearchDatabase, has_image_manifest, lookup_archive_member, lookup_image,
+                                          lookup_image_file, read_archive_member)
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = TextSearchDatabase(str(tmp_path / "test.db"))
+    yield db
+    db.close()
+
+
+def write_scans(directory, names):
+    for name in names:
+        path = directory / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"scan " + name.encode())
+    return directory
+
+
+def test_manifest_lookup_prefers_the_documents_volume(tmp_path, db):
+    images = write_scans(tmp_path / "IMAGES", ["001/DOC_1.png", "001/DOC_1.jpg", "002/DOC_1.jpg",
+                                               "002/sub/DOC_2.tif", "002/notes.txt"])
+    assert not has_image_manifest(db.conn)
+    stats = db.refresh_image_manifest(str(images))
+    assert (stats['added'], stats['removed']) == (4, 0)
+    assert has_image_manifest(db.conn)
+
+    image_path, volume, filename, image_format = lookup_image(db.conn, "/data/TEXT/002/DOC_1.txt")
+    assert (image_path, volume, filename, image_format) == (str(images / "002" / "DOC_1.jpg"), "002", "DOC_1.jpg",
+                                                            "jpeg")
+    # Otherwise the lowest volume, and JPEG over PNG
+    assert lookup_image(db.conn, "/data/TEXT/005/DOC_1.txt")[0] == str(images / "001" / "DOC_1.jpg")
+    assert lookup_image(db.conn, "/data/TEXT/001/DOC_2.txt")[0] == str(images / "002" / "sub" / "DOC_2.tif")
+    assert lookup_image(db.conn, "/data/TEXT/001/DOC_3.txt") is None
+    assert lookup_image_file(db.conn, "002", "DOC_2.tif") == str(images / "002" / "sub" / "DOC_2.tif")
+
+
+def test_changed_only_refresh_follows_added_and_removed_scans(tmp_path, db):
+    images = write_scans(tmp_path / "IMAGES", ["001/DOC_1.jpg", "001/sub/DOC_2.jpg"])
+    db.refresh_image_manifest(str(images))
+    write_scans(images, ["001/sub/DOC_3.jpg"])
+    os.remove(images / "001" / "DOC_1.jpg")
+    stats = db.refresh_image_manifest(str(images), full=False)
+    assert (stats['added'], stats['removed']) == (1, 1)
+    assert lookup_image(db.conn, "/data/TEXT/001/DOC_1.txt") is None
+    assert lookup_image(db.conn, "/data/TEXT/001/DOC_3.txt")[0] == str(images / "001" / "sub" / "DOC_3.jpg")
+
+
+def write_stored_zip(path, name, data):
+    """
+    A zip archive with one stored member whose local header has an extra
+    field that its central directory entry doesn't, as some zip tools write.
+    """
+    name, extra, crc = name.encode(), struct.pack('<HH4s', 0xcafe, 4, b'pad!'), zlib.crc32(data)
+    local = struct.pack('<4sHHHHHIIIHH', b'PK\x03\x04', 20, 0, 0, 0, 0x21, crc, len(data), len(data),
+                        len(name), len(extra)) + name + extra + data
+    central = struct.pack('<4sHHHHHHIIIHHHHHII', b'PK\x01\x02', 20, 20, 0, 0, 0, 0x21, crc, len(data), len(data),
+                          len(name), 0, 0, 0, 0, 0, 0) + name
+    end = struct.pack('<4sHHHHIIH', b'PK\x05\x06', 0, 0, 1, 1, len(central), len(local), 0)
+    path.write_bytes(local + central + end)
+
+
+def test_scans_are_read_straight_from_release_archives(tmp_path, db):
+    images = write_scans(tmp_path / "IMAGES", ["001/DOC_1.jpg"])
+    write_stored_zip(images / "VOL00001.zip", "IMAGES/001/DOC_1.jpg", b"archived scan 1")
+    data = b"deflated scan 2 " * 100
+    with zipfile.ZipFile(images / "VOL00002.zip", "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("DOC_2.png", data)
+    db.refresh_image_manifest(str(images))
+
+    # A scan outside the archives wins over its archived copy
+    assert lookup_image(db.conn, "/data/TEXT/001/DOC_1.txt")[0] == str(images / "001" / "DOC_1.jpg")
+    assert read_archive_member(lookup_archive_member(db.conn, "001", "DOC_1.jpg")) == b"archived scan 1"
+    # Members outside a numbered directory get the volume in the archive's name
+    assert lookup_image(db.conn, "/data/TEXT/002/DOC_2.txt") == (None, "002", "DOC_2.png", "png")
+    scan = lookup_archive_member(db.conn, "002", "DOC_2.png")
+    assert read_archive_member(scan) == data
+
+    # An archive rewritten after the manifest was refreshed fails its CRC check
+    write_stored_zip(images / "VOL00001.zip", "IMAGES/001/DOC_1.jpg", b"replaced scan 1")
+    with pytest.raises(ValueError, match="changed since the image manifest was refreshed"):
+        read_archive_member(lookup_archive_member(db.conn, "001", "DOC_1.jpg"))
@@ -0,0 +1,85 @@
+import os
+import sqlite3
+
+import pytest
+
+from searchable_text_db_efficient import TextSearchDatabase, query_index
+
+
+def documents(count):
+    return {f"DOC_{i:06d}.txt": f"document number {i} about subject{i % 7}" for i in range(count)}
+
+
+def reindex(db, text_dir, **options):
+    return db.index_text_files(str(text_dir), batch_size=25, **options)
+
+
+def test_incremental_skips_unchanged_and_updates_changed_files(text_dir, write_texts, indexed):
+    db = indexed(write_texts(text_dir, documents(60)), batch_size=25)
+    (text_dir / "DOC_000003.txt").write_text("rewritten with replacementword")
+    os.remove(text_dir / "DOC_000004.txt")
+    (text_dir / "DOC_000100.txt").write_text("a new file")
+    stats = reindex(db, text_dir, incremental=True)
+    assert (stats['new'], stats['changed'], stats['unchanged'], stats['deleted']) == (1, 1, 58, 1)
+    assert db.count_files() == 60
+    assert [row[0] for row in db.search_content_only("replacementword")] == ["DOC_000003.txt"]
+
+
+def test_incremental_on_a_database_without_manifest(text_dir, write_texts, indexed):
+    db = indexed(write_texts(text_dir, documents(120)), batch_size=25)
+    # A database built before the manifest existed
+    db.conn.execute("DELETE FROM file_manifest")
+    db.conn.commit()
+    stats = reindex(db, text_dir, incremental=True)
+    assert stats['new'] == 0
+    assert db.count_files() == 120
+    # The seeded manifest was refreshed, so the next run skips every file
+    stats = reindex(db, text_dir, incremental=True)
+    assert stats['unchanged'] == 120
+
+
+def test_failed_batch_stops_the_build_and_resume_retries_it(tmp_path, text_dir, write_texts):
+    write_texts(text_dir, documents(60))
+    db = TextSearchDatabase(str(tmp_path / "test.db"))
+    try:
+        db.conn.execute(
+            "CREATE TEMP TRIGGER fail_write BEFORE INSERT ON text_files WHEN NEW.filename = 'DOC_000030.txt' "
+            "BEGIN SELECT RAISE(ABORT, 'simulated write failure'); END"
+        )
+        with pytest.raises(sqlite3.IntegrityError):
+            reindex(db, text_dir)
+        # The checkpoint stays at the last committed batch, before the failed one
+        checkpoint = db.get_checkpoint()
+        assert (checkpoint['batch_ordinal'], checkpoint['files_done']) == (1, 25)
+        assert checkpoint['last_path'].endswith("DOC_000024.txt")
+        assert db.count_files() == 25
+
+        db.conn.execute("DROP TRIGGER temp.fail_write")
+        stats = reindex(db, text_dir, resume=True)
+        assert stats['new'] == 35
+        assert db.count_files() == 60
+        assert db.get_checkpoint() is None
+    finally:
+        db.close()
+
+
+def test_later_builds_keep_dedupe(text_dir, write_texts, indexed):
+    db = indexed(write_texts(text_dir, documents(10)), dedupe=True)
+    (text_dir / "DOC_000003.txt").write_text("rewritten document number 3")
+    reindex(db, text_dir, incremental=True)
+    assert db.conn.execute("SELECT COUNT(*) FROM document_minhash").fetchone()[0] == 10
+
+
+def test_later_builds_keep_entities(text_dir, write_texts, indexed):
+    db = indexed(write_texts(text_dir, documents(10)), entities=True)
+    (text_dir / "DOC_000003.txt").write_text("write to jane@example.com")
+    reindex(db, text_dir, incremental=True)
+    assert [row[1] for row in query_index(db.conn, "jane@example.com", "email")] == ["DOC_000003.txt"]
+
+
+def test_later_builds_keep_dates(text_dir, write_texts, indexed):
+    db = indexed(write_texts(text_dir, documents(10)), dates=True)
+    (text_dir / "DOC_000003.txt").write_text("document number 3 dated August 17, 2004")
+    reindex(db, text_dir, incremental=True)
+    rows = query_index(db.conn, "document", date_from="2004-01-01", date_to="2004-12-31")
+    assert [row[1] for row in rows] == ["DOC_000003.txt"]
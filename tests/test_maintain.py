@@ -0,0 +1,45 @@
+import pytest
+
+from searchable_text_db_efficient import TextSearchDatabase, fts_segment_levels
+
+TABLES = ['text_files_fts', 'passages_fts']
+
+
+@pytest.fixture
+def fragmented(tmp_path, text_dir, write_texts):
+    """A database indexed in small batches with automerge off, so each batch leaves its own segments."""
+    write_texts(text_dir, {f"DOC_{i:06d}.txt": f"word{i} common" for i in range(40)})
+    db = TextSearchDatabase(str(tmp_path / "test.db"))
+    db.maintain_fts_index(TABLES, automerge=0)
+    db.index_text_files(str(text_dir), batch_size=5)
+    yield db
+    db.close()
+
+
+def segments(db, fts_table):
+    return sum(count for count, _ in fts_segment_levels(db.conn, fts_table))
+
+
+def test_segment_levels_count_the_segments_each_batch_wrote(fragmented):
+    for fts_table in TABLES:
+        levels = fts_segment_levels(fragmented.conn, fts_table)
+        assert levels[0][0] >= 8 and levels[0][1] >= levels[0][0]
+        automerge = fragmented.conn.execute(f"SELECT v FROM {fts_table}_config WHERE k = 'automerge'").fetchone()
+        assert automerge == (0,)
+
+
+def test_merge_and_optimize_reduce_the_segments(fragmented):
+    before = segments(fragmented, 'passages_fts')
+    fragmented.maintain_fts_index(TABLES, merge_seconds=5, merge_pages=1)
+    assert segments(fragmented, 'passages_fts') < before
+    fragmented.maintain_fts_index(TABLES, optimize=True)
+    assert [segments(fragmented, fts_table) for fts_table in TABLES] == [1, 1]
+    assert [row[0] for row in fragmented.search_content_only("word7")] == ["DOC_000007.txt"]
+
+
+def test_empty_table_has_no_levels(tmp_path):
+    db = TextSearchDatabase(str(tmp_path / "test.db"))
+    try:
+        assert segments(db, 'text_files_fts') == 0
+    finally:
+        db.close()
@@ -0,0 +1,37 @@
+from searchable_text_db_efficient import load_document_by_path, read_document_window, split_passages
+
+
+def test_passages_cover_the_document_with_offsets():
+    text = " ".join(f"word{i}" for i in range(3000))
+    passages = split_passages(text, passage_size=2000, overlap=200)
+    assert passages[0][0] == 0 and passages[-1][1] == len(text)
+    for (start, end, passage), (next_start, _, _) in zip(passages, passages[1:]):
+        assert passage == text[start:end]
+        # Consecutive passages overlap and start at the beginning of a word
+        assert start < next_start < end
+        assert text[next_start - 1] == " "
+
+
+def test_content_search_returns_the_matching_passage(text_dir, write_texts, indexed):
+    db = indexed(write_texts(text_dir, {"DOC_000001.txt": "filler " * 3000 + "needleword and more text"}))
+    (filename, filepath, passage, offset, rank), = db.search_content_only("needleword")
+    assert filename == "DOC_000001.txt"
+    # The match is past the 10 KB sample, in a passage that starts at offset
+    assert offset > 10240
+    assert "needleword" in passage
+    assert (text_dir / "DOC_000001.txt").read_text()[offset:offset + len(passage)] == passage
+
+
+def test_contentless_passages_are_filled_from_the_content_store(text_dir, write_texts, indexed):
+    text = "filler " * 3000 + "needleword and more text"
+    db = indexed(write_texts(text_dir, {"DOC_000001.txt": text}), contentless=True)
+    filepath = str(text_dir / "DOC_000001.txt")
+    # Searches and reads never go back to the text files
+    (text_dir / "DOC_000001.txt").unlink()
+    assert db.conn.execute("SELECT COUNT(*) FROM passages WHERE content IS NOT NULL").fetchone()[0] == 0
+    (filename, _, passage, offset, _), = db.search_content_only("needleword")
+    assert filename == "DOC_000001.txt"
+    assert "needleword" in passage and text[offset:offset + len(passage)] == passage
+    assert load_document_by_path(db.conn, filepath) == text
+    file_id, = db.conn.execute("SELECT id FROM text_files").fetchone()
+    assert read_document_window(db.conn, file_id, offset, offset + 10) == text[offset:offset + 10]
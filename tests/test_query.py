@@ -0,0 +1,104 @@
+import pytest
+
+from conftest import write_texts
+import searchable_text_db_efficient
+from searchable_text_db_efficient import QuerySyntaxError, TextSearchDatabase, compile_query, query_documents, query_index
+
+
+@pytest.fixture(scope="module")
+def conn(tmp_path_factory):
+    """A database where 'alphaword' and 'omegaword' are in different passages of SPLIT_000001."""
+    root = tmp_path_factory.mktemp("query")
+    write_texts(root / "TEXT", {
+        "SPLIT_000001.txt": "alphaword " + "filler " * 1000 + "omegaword",
+        "ALPHA_000002.txt": "alphaword on its own",
+        "BOTH_000003.txt": "alphaword omegaword in one sentence",
+    })
+    db = TextSearchDatabase(str(root / "test.db"))
+    db.index_text_files(str(root / "TEXT"))
+    yield db.conn
+    db.close()
+
+
+def filenames(conn, query, search_type="content"):
+    return sorted(row[1] for row in query_index(conn, query, search_type))
+
+
+def test_and_matches_terms_in_different_passages(conn):
+    assert filenames(conn, "alphaword omegaword") == ["BOTH_000003.txt", "SPLIT_000001.txt"]
+
+
+def test_not_excludes_terms_in_other_passages(conn):
+    assert filenames(conn, "alphaword -omegaword") == ["ALPHA_000002.txt"]
+    assert filenames(conn, "alphaword NOT omegaword") == ["ALPHA_000002.txt"]
+
+
+def test_near_counts_tokens_across_passages(conn):
+    assert filenames(conn, "NEAR(alphaword omegaword, 2000)") == ["BOTH_000003.txt", "SPLIT_000001.txt"]
+    assert filenames(conn, "NEAR(alphaword omegaword, 999)") == ["BOTH_000003.txt"]
+    assert filenames(conn, "NEAR(alphaword omegaword, 1000)") == ["BOTH_000003.txt", "SPLIT_000001.txt"]
+
+
+def test_near_checks_of_the_full_text_are_capped(conn, monkeypatch):
+    monkeypatch.setattr(searchable_text_db_efficient, "NEAR_MAX_FULL_TEXT_CHECKS", 0)
+    assert filenames(conn, "NEAR(alphaword omegaword, 2000)") == ["BOTH_000003.txt"]
+
+
+def test_or_queries_match_passages_and_filenames(conn):
+    assert filenames(conn, "omegaword") == ["BOTH_000003.txt", "SPLIT_000001.txt"]
+    assert filenames(conn, "omegaword OR filename:ALPHA_000002", "all") == \
+        ["ALPHA_000002.txt", "BOTH_000003.txt", "SPLIT_000001.txt"]
+    assert filenames(conn, "(omegaword OR missingword) -filename:BOTH_000003", "all") == ["SPLIT_000001.txt"]
+
+
+def test_query_documents(conn):
+    ids = {filename: file_id for file_id, filename in conn.execute("SELECT id, filename FROM text_files")}
+    assert query_documents(conn, "alphaword -omegaword") == {ids["ALPHA_000002.txt"]}
+    assert query_documents(conn, "NEAR(alphaword omegaword, 2000) OR filename:ALPHA_000002", "all") == set(ids.values())
+
+
+def test_hits_point_at_the_best_passage(conn):
+    rows = {row[1]: row for row in query_index(conn, "alphaword omegaword")}
+    _, _, _, passage, offset, _ = rows["SPLIT_000001.txt"]
+    assert offset > 0 and "omegaword" in passage
+
+
+def test_content_and_filename_terms_combine_per_document(conn):
+    assert filenames(conn, "omegaword filename:SPLIT_000001") == ["SPLIT_000001.txt"]
+    assert filenames(conn, "alphaword -filename:SPLIT_000001") == ["ALPHA_000002.txt", "BOTH_000003.txt"]
+    assert filenames(conn, "filename:BOTH_000003 -alphaword", "all") == []
+
+
+def test_operator_precedence():
+    # NOT binds tightest, then AND (also implied), then OR
+    assert compile_query("a b OR c").expression == '(content : "a" AND content : "b") OR content : "c"'
+    assert compile_query("a OR b NOT c").expression == 'content : "a" OR (content : "b" NOT content : "c")'
+    assert compile_query("a -b c").expression == '(content : "a" AND content : "c") NOT content : "b"'
+    assert compile_query("(a OR b) c").expression == '(content : "a" OR content : "b") AND content : "c"'
+
+
+def test_near():
+    assert compile_query("NEAR(clinton island, 5)").expression == 'content : NEAR("clinton" "island", 5)'
+    assert compile_query("filename:NEAR(a b)", "all").expression == 'filename : NEAR("a" "b", 10)'
+
+
+@pytest.mark.parametrize("query, message, position", [
+    ("a AND", "AND needs a term after it", 2),
+    ("a OR", "OR needs a term after it", 2),
+    ("a NOT", "NOT needs a term after it", 2),
+    ("a AND AND b", "AND needs a term after it", 2),
+    ("-", "'-' needs a term after it", 0),
+    ("a -", "'-' needs a term after it", 2),
+    ("AND a", "AND needs a term before it", 0),
+    ("(a b", "Missing ')'", 3),
+    ('"a b', "Unterminated quoted phrase", 0),
+    ("NEAR(a, 5)", "NEAR needs at least two terms", 0),
+    ("NEAR(a b, x)", "The NEAR distance must be a whole number", 10),
+    ("-a", "A query needs a term that is not excluded", 0),
+])
+def test_syntax_errors(query, message, position):
+    with pytest.raises(QuerySyntaxError) as error:
+        compile_query(query)
+    assert str(error.value).startswith(message)
+    assert error.value.position == position
+    assert position < len(query)
@@ -0,0 +1,69 @@
+import multiprocessing
+
+import pytest
+
+from conftest import write_texts
+from searchable_text_db_efficient import TextSearchDatabase, iter_regex_search, regex_candidates, regex_literals
+
+
+@pytest.mark.parametrize("pattern, literals", [
+    ("abc", [["abc"]]),
+    (r"abc\d+def", [["abc"], ["def"]]),
+    ("(foo|bar)baz", [["foo", "bar"], ["baz"]]),
+    ("x?abc", [["abc"]]),
+    ("(abc)*def", [["def"]]),
+    ("(abc)+", [["abc"]]),
+    ("[Ee]pstein", [["pstein"]]),
+    # No literal of three characters that every match must contain
+    ("foo|ba", []),
+    (r"\d{3}-\d{4}", []),
+    ("a.b.c", []),
+])
+def test_regex_literals(pattern, literals):
+    assert regex_literals(pattern) == literals
+
+
+@pytest.fixture(scope="module")
+def db_path(tmp_path_factory):
+    root = tmp_path_factory.mktemp("regex")
+    write_texts(root / "TEXT", {f"DOC_{i:06d}.txt": f"page {i}: " + (f"call 212-555-{i:04d} today" if i % 2
+                                                                    else "no number here")
+                                for i in range(20)})
+    db = TextSearchDatabase(str(root / "test.db"))
+    db.index_text_files(str(root / "TEXT"), trigram=True)
+    db.close()
+    return str(root / "test.db")
+
+
+def test_candidates_come_from_the_trigram_index(db_path):
+    db = TextSearchDatabase(db_path)
+    try:
+        assert len(regex_candidates(db.conn, r"555-\d{4}")) == 10
+        assert len(regex_candidates(db.conn, r"\d{3}-\d{4}")) == 20
+    finally:
+        db.close()
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_regex_search(db_path, workers):
+    rows = list(iter_regex_search(db_path, r"555-00\d[13]", workers=workers))
+    assert sorted(row[1] for row in rows) == ["DOC_000001.txt", "DOC_000003.txt", "DOC_000011.txt",
+                                              "DOC_000013.txt"]
+    for file_id, filename, filepath, text, offset, rank in rows:
+        assert text.startswith("555-00") and rank == -1
+        assert open(filepath).read()[offset:].startswith(text)
+
+
+def test_regex_search_limits(db_path):
+    assert len(list(iter_regex_search(db_path, r"555-\d{4}", limit=3, workers=1))) == 3
+    rows = list(iter_regex_search(db_path, r"555-\d{4}", workers=1, max_candidates=4))
+    assert sorted(row[1] for row in rows) == ["DOC_000001.txt", "DOC_000003.txt", "DOC_000005.txt",
+                                              "DOC_000007.txt"]
+    with pytest.raises(TimeoutError):
+        list(iter_regex_search(db_path, r"555-\d{4}", workers=1, timeout=0))
+
+
+def test_regex_search_in_a_shared_pool(db_path):
+    with multiprocessing.Pool(2) as pool:
+        for pattern, matches in ((r"555-\d{4}", 10), (r"page 1\d", 10), (r"no number", 10)):
+            assert len(list(iter_regex_search(db_path, pattern, pool=pool))) == matches
@@ -0,0 +1,45 @@
+import sqlite3
+import threading
+
+from searchable_text_db_efficient import (SPELL_MIN_DOCUMENTS, ShardedTextSearch, build_shards, find_shards,
+                                          has_trigram_index)
+
+
+def test_in_process_shard_search_from_several_threads(tmp_path, text_dir, write_texts):
+    write_texts(text_dir, {f"{volume}/DOC_{volume}{i}.txt": f"page {i} of volume {volume} with flight logs"
+                           for volume in ("001", "002") for i in range(SPELL_MIN_DOCUMENTS)})
+    db_path = str(tmp_path / "text_search.db")
+    build_shards(str(text_dir), db_path)
+    sharded = ShardedTextSearch(find_shards(db_path), workers=1)
+    results, errors = [], []
+
+    def search():
+        try:
+            results.append((len(sharded.search("flight")), sharded.spelling_corrections("fligt")[0][0]))
+        except Exception as e:
+            errors.append(e)
+
+    # The first search opens this thread's connections; the others open their own
+    search()
+    threads = [threading.Thread(target=search) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert results == [(2 * SPELL_MIN_DOCUMENTS, "flight")] * 5
+
+
+def test_rebuilding_a_shard_keeps_its_build_options(tmp_path, text_dir, write_texts):
+    write_texts(text_dir, {f"{volume}/DOC_{volume}{i}.txt": f"write to person{i}@example.com"
+                           for volume in ("001", "002") for i in range(3)})
+    db_path = str(tmp_path / "text_search.db")
+    build_shards(str(text_dir), db_path, trigram=True, entities=True)
+    build_shards(str(text_dir), db_path, volumes=["002"])
+    for shard in find_shards(db_path):
+        conn = sqlite3.connect(shard)
+        try:
+            assert has_trigram_index(conn)
+            assert conn.execute("SELECT COUNT(*) FROM document_entities").fetchone()[0] == 3
+        finally:
+            conn.close()
@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("scipy")
+
+from searchable_text_db_efficient import SimilarityIndex, build_similarity_index
+
+TEXTS = {
+    "DOC_000001.txt": "flight logs for the island trip",
+    "DOC_000002.txt": "flight logs from the island visit",
+    "DOC_000003.txt": "bank wire transfer of the payment",
+    "DOC_000004.txt": "wire transfer from the bank account",
+    "DOC_000005.txt": "dinner guest list and seating",
+    "DOC_000006.txt": "guest list for the dinner party",
+}
+
+
+def file_ids(db):
+    return {filename: file_id for file_id, filename in db.conn.execute("SELECT id, filename FROM text_files")}
+
+
+def test_neighbours_share_terms(text_dir, write_texts, indexed):
+    db = indexed(write_texts(text_dir, TEXTS))
+    build_similarity_index(db.db_path)
+    ids = file_ids(db)
+    neighbours = SimilarityIndex(db.db_path).similar(ids["DOC_000003.txt"], 5)
+    assert neighbours[0][0] == ids["DOC_000004.txt"]
+    assert all(file_id != ids["DOC_000003.txt"] and score > 0 for file_id, score in neighbours)
+    with pytest.raises(KeyError):
+        SimilarityIndex(db.db_path).similar(max(ids.values()) + 1)
+
+
+def test_neighbours_deleted_since_the_build_are_skipped(text_dir, write_texts, indexed, monkeypatch):
+    webui = pytest.importorskip("text_search_webui")
+    db = indexed(write_texts(text_dir, TEXTS))
+    build_similarity_index(db.db_path)
+    ids = file_ids(db)
+    os.remove(text_dir / "DOC_000004.txt")
+    db.index_text_files(str(text_dir), incremental=True)
+    monkeypatch.setattr(webui, "DB_PATH", db.db_path)
+    monkeypatch.setattr(webui, "SHARD_PATHS", [])
+    monkeypatch.setattr(webui, "_similarity_index", None)
+    monkeypatch.setattr(webui, "_connection_pool", None)
+
+    response = webui.app.test_client().get(f"/similar/{ids['DOC_000003.txt']}")
+    assert response.status_code == 200
+    results = [result['file_name'] for result in response.json['results']]
+    assert results and "DOC_000004.txt" not in results
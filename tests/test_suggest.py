@@ -0,0 +1,42 @@
+import pytest
+
+from searchable_text_db_efficient import SUGGEST_LIMIT, query_index, suggest_terms
+
+TEXTS = {
+    "DOC_000001.txt": "Epstein flight logs",
+    "DOC_000002.txt": "epstein island visit",
+    "DOC_000003.txt": "EPSTEIN estate and epsilon",
+    "DOC_000004.txt": "estate records",
+}
+
+
+def test_suggestions_are_ranked_by_document_count(text_dir, write_texts, indexed):
+    db = indexed(write_texts(text_dir, TEXTS))
+    assert suggest_terms(db.conn, "e") == [("epstein", 3), ("estate", 2), ("epsilon", 1)]
+    # Precomputed short prefixes and the vocabulary range scan agree
+    for prefix in ("ep", "eps", "Eps "):
+        assert suggest_terms(db.conn, prefix) == suggest_terms(db.conn, prefix, SUGGEST_LIMIT + 1)
+        assert suggest_terms(db.conn, prefix) == [("epstein", 3), ("epsilon", 1)]
+    assert suggest_terms(db.conn, "epst") == [("epstein", 3)]
+    assert suggest_terms(db.conn, "x") == [] and suggest_terms(db.conn, "") == []
+
+
+def test_prefix_queries(text_dir, write_texts, indexed):
+    db = indexed(write_texts(text_dir, TEXTS))
+    assert sorted(row[1] for row in query_index(db.conn, "eps*")) == ["DOC_000001.txt", "DOC_000002.txt",
+                                                                     "DOC_000003.txt"]
+
+
+def test_suggest_endpoint(text_dir, write_texts, indexed, monkeypatch):
+    webui = pytest.importorskip("text_search_webui")
+    db = indexed(write_texts(text_dir, TEXTS))
+    monkeypatch.setattr(webui, "DB_PATH", db.db_path)
+    monkeypatch.setattr(webui, "SHARD_PATHS", [])
+    monkeypatch.setattr(webui, "_connection_pool", None)
+    client = webui.app.test_client()
+
+    response = client.get("/suggest?q=Ep&limit=1")
+    assert response.json == {'prefix': 'Ep', 'suggestions': [{'term': 'epstein', 'documents': 3}]}
+    # Out of range limits are clamped instead of failing
+    assert len(client.get("/suggest?q=e&limit=0").json['suggestions']) == 1
+    assert len(client.get("/suggest?q=e&limit=1000").json['suggestions']) == 3
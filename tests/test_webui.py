@@ -0,0 +1,182 @@
+import os
+import sqlite3
+import zipfile
+
+import pytest
+
+pytest.importorskip("flask")
+
+import text_search_webui as webui
+from searchable_text_db_efficient import SPELL_MIN_DOCUMENTS, build_shards, find_shards
+
+
+@pytest.fixture
+def shards(tmp_path, text_dir, write_texts, monkeypatch):
+    """Two trigram-indexed shards served by the web UI, with its regex pool shut down afterwards."""
+    write_texts(text_dir, {f"{volume}/DOC_{volume}{i:03d}.txt": f"call 212-555-{i:04d} from volume {volume}"
+                           for volume in ("001", "002") for i in range(20)})
+    db_path = str(tmp_path / "text_search.db")
+    build_shards(str(text_dir), db_path, trigram=True)
+    monkeypatch.setattr(webui, "SHARD_PATHS", find_shards(db_path))
+    monkeypatch.setattr(webui, "REGEX_WORKERS", 2)
+    monkeypatch.setattr(webui, "_regex_pool", None)
+    monkeypatch.setattr(webui, "_shard_pools", {})
+    monkeypatch.setattr(webui, "_sharded_search", None)
+    yield webui.SHARD_PATHS
+    if webui._regex_pool is not None:
+        webui._regex_pool.terminate()
+
+
+def test_sharded_regex_search_is_bounded(shards, monkeypatch):
+    assert len(webui.search_shards(r"555-\d{4}", search_type="regex")) == 40
+    monkeypatch.setattr(webui, "REGEX_MAX_RESULTS", 5)
+    assert len(webui.search_shards(r"555-\d{4}", search_type="regex")) == 5
+    monkeypatch.setattr(webui, "REGEX_MAX_RESULTS", 1000)
+    monkeypatch.setattr(webui, "REGEX_MAX_CANDIDATES", 6)
+    # Split between the two shards
+    assert len(webui.search_shards(r"555-\d{4}", search_type="regex")) == 6
+
+
+def test_regex_search_past_its_deadline_replaces_the_pool(shards, monkeypatch):
+    pool = webui.regex_pool()
+    monkeypatch.setattr(webui, "REGEX_TIMEOUT_SECONDS", 0)
+    assert webui.search_shards(r"555-\d{4}", search_type="regex") == []
+    assert webui.regex_pool() is not pool
+
+
+def test_immutable_sharded_regex_opens_the_shards_immutable(shards, monkeypatch):
+    import searchable_text_db_efficient as module
+
+    opened = []
+    connect_read_only = module.connect_read_only
+    monkeypatch.setattr(module, "connect_read_only",
+                        lambda path, immutable=False: opened.append(immutable) or connect_read_only(path, immutable))
+    sharded = module.ShardedTextSearch(shards, workers=1, immutable=True)
+    assert len(sharded.search(r"555-000\d", search_type="regex")) == 20
+    assert opened and all(opened)
+
+
+def test_startup_check_refuses_databases_being_written(shards, monkeypatch):
+    monkeypatch.setattr(webui, "IMMUTABLE_SETTLE_SECONDS", 0)
+    webui.check_not_modified(shards)
+
+    writer = sqlite3.connect(shards[0])
+    writer.execute("BEGIN IMMEDIATE")
+    try:
+        with pytest.raises(RuntimeError, match="locked by a writer"):
+            webui.check_not_modified(shards)
+    finally:
+        writer.rollback()
+        writer.close()
+
+    with open(shards[1] + "-journal", "wb") as journal:
+        journal.write(b"\0" * 512)
+    with pytest.raises(RuntimeError, match="is not empty"):
+        webui.check_not_modified(shards)
+
+
+def test_substring_search_needs_the_trigram_index_in_every_shard(tmp_path, text_dir, write_texts, monkeypatch):
+    write_texts(text_dir, {f"{volume}/DOC_{volume}.txt": "flight logs" for volume in ("001", "002")})
+    db_path = str(tmp_path / "text_search.db")
+    build_shards(str(text_dir), db_path, volumes=["001"], trigram=True)
+    build_shards(str(text_dir), db_path, volumes=["002"])
+    monkeypatch.setattr(webui, "SHARD_PATHS", find_shards(db_path))
+    monkeypatch.setattr(webui, "_shard_pools", {})
+    monkeypatch.setattr(webui, "_sharded_search", None)
+    client = webui.app.test_client()
+
+    response = client.post('/search', json={'query': 'ligh', 'search_type': 'substring'})
+    assert response.status_code == 400
+    assert "needs the trigram index" in response.json['error']
+    assert os.path.basename(webui.SHARD_PATHS[1]) in response.json['error']
+
+    build_shards(str(text_dir), db_path, volumes=["002"], trigram=True)
+    response = client.post('/search', json={'query': 'ligh', 'search_type': 'substring'})
+    assert response.status_code == 200
+    assert response.json['count'] == 2
+
+
+def test_pool_reconnects_when_the_database_is_replaced(tmp_path, write_texts, indexed, monkeypatch):
+    first = indexed(write_texts(tmp_path / "FIRST", {"DOC_000001.txt": "flight logs"}), "first.db")
+    first.close()
+    second = indexed(write_texts(tmp_path / "SECOND", {f"DOC_{i:06d}.txt": "flight logs" for i in range(3)}),
+                     "second.db")
+    second.close()
+    monkeypatch.setattr(webui, "DB_PATH", first.db_path)
+    monkeypatch.setattr(webui, "_connection_pool", None)
+    with webui.database_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM text_files").fetchone()[0] == 1
+    pool = webui._connection_pool
+
+    os.replace(second.db_path, first.db_path)
+    with webui.database_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM text_files").fetchone()[0] == 3
+    assert webui._connection_pool is not pool
+
+
+def test_shard_spelling_corrections_follow_rebuilt_shards(tmp_path, text_dir, write_texts, monkeypatch):
+    write_texts(text_dir, {f"{volume}/DOC_{volume}{i}.txt": f"{word} logs" for volume, word in
+                           (("001", "flight"), ("002", "island")) for i in range(SPELL_MIN_DOCUMENTS)})
+    db_path = str(tmp_path / "text_search.db")
+    build_shards(str(text_dir), db_path)
+    monkeypatch.setattr(webui, "SHARD_PATHS", find_shards(db_path))
+    monkeypatch.setattr(webui, "_shard_pools", {})
+    monkeypatch.setattr(webui, "_sharded_search", None)
+    assert webui.correct_spelling("islnd")[0][0] == "island"
+    assert set(webui._shard_pools) == set(webui.SHARD_PATHS)
+
+    write_texts(text_dir, {f"002/DOC_002{i}.txt": "harbor logs" for i in range(SPELL_MIN_DOCUMENTS)})
+    build_shards(str(text_dir), db_path, volumes=["002"])
+    assert webui.correct_spelling("harbr")[0][0] == "harbor"
+
+
+@pytest.fixture
+def served(tmp_path, text_dir, write_texts, indexed, monkeypatch):
+    """An indexed volume with its page scans, one of them inside a release archive, served by the web UI."""
+    db = indexed(write_texts(text_dir, {"001/DOC_1.txt": "first page", "001/DOC_2.txt": "second page"}))
+    images = tmp_path / "IMAGES"
+    (images / "001").mkdir(parents=True)
+    (images / "001" / "DOC_1.jpg").write_bytes(bytes(range(256)) * 4)
+    with zipfile.ZipFile(images / "VOL00001.zip", "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("IMAGES/001/DOC_2.png", bytes(range(256)) * 8)
+    db.refresh_image_manifest(str(images))
+    monkeypatch.setattr(webui, "DB_PATH", db.db_path)
+    monkeypatch.setattr(webui, "IMAGE_DIR", str(images))
+    monkeypatch.setattr(webui, "SHARD_PATHS", [])
+    monkeypatch.setattr(webui, "_connection_pool", None)
+    monkeypatch.setattr(webui, "render_template", lambda name, **context: f"{context['content']} {context['image_url']}")
+    return db
+
+
+def test_view_file_answers_conditional_requests(served, text_dir):
+    client = webui.app.test_client()
+    url = f"/view_file{text_dir / '001' / 'DOC_1.txt'}"
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == "first page /view_image/001/DOC_1.jpg"
+    etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+    assert client.get(url, headers={'If-Modified-Since': last_modified}).status_code == 304
+
+    (text_dir / "001" / "DOC_1.txt").write_text("first page, corrected")
+    served.index_text_files(str(text_dir), incremental=True)
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+
+
+@pytest.mark.parametrize("filename, data", [("DOC_1.jpg", bytes(range(256)) * 4), ("DOC_2.png", bytes(range(256)) * 8)])
+def test_view_image_answers_range_and_conditional_requests(served, filename, data):
+    client = webui.app.test_client()
+    url = f"/view_image/001/{filename}?size=original"
+    response = client.get(url)
+    assert response.status_code == 200 and response.data == data
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    etag = response.headers['ETag']
+
+    response = client.get(url, headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206 and response.data == data[100:200]
+    assert response.headers['Content-Range'] == f"bytes 100-199/{len(data)}"
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+    # A Range with a stale If-Range gets the whole scan
+    response = client.get(url, headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+    assert response.status_code == 200 and response.data == data
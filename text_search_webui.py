@@ -6,190 +6,535 @@ This tool allows you to search through the TEXT directory using the SQLite datab
 and view results with configurable snippet length around the matching text.
 """
 
+import io
 import os
 import re
+import hashlib
 import sqlite3
-from flask import Flask, render_template, request, jsonify
+import time
+import argparse
+import multiprocessing
+import queue
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from flask import Flask, render_template, request, jsonify, make_response
 import sys
 from pathlib import Path
 
+from searchable_text_db_efficient import (
+    read_document_window, document_length, load_document, load_document_by_path,
+    connect_read_only, query_index, date_bound, substring_regex, ENTITY_KINDS, normalize_entity, entity_regex, suggest_terms, spelling_corrections, SPELL_SUGGEST_BELOW, iter_regex_search, collapse_duplicate_rows, ShardedTextSearch, find_shards, has_trigram_index,
+    has_image_manifest, lookup_image, lookup_image_file, lookup_archive_member, read_archive_member, scan_identity, document_version,
+    DEFAULT_IMAGE_DIR, DerivativeCache, DERIVATIVE_SIZES,
+    DERIVATIVE_CACHE_BYTES, Image, SimilarityIndex, SIMILARITY_TOP_K, compile_query, QuerySyntaxError
+)
+
 app = Flask(__name__)
 
 # Database path
 DB_PATH = "text_search.db"
 
-def search_database(query, snippet_length=1000, search_type="content"):
+# Directory with the unzipped image volumes 001-012
+IMAGE_DIR = DEFAULT_IMAGE_DIR
+
+# Scaled copies of the scans served by /view_image instead of the originals (needs Pillow)
+DERIVATIVE_CACHE_DIR = "image_cache"
+DERIVATIVE_FORMAT = "jpeg"  # or "webp"
+DERIVATIVE_CACHE_MB = DERIVATIVE_CACHE_BYTES // 1048576
+_derivative_cache = None
+
+# Seconds browsers and proxies may reuse /view_file and /view_image responses
+# without revalidating; with 0 they revalidate each time and get a 304 if unchanged
+CACHE_MAX_AGE = 0
+
+# TF-IDF matrix for /similar, memory-mapped on first use
+_similarity_index = None
+
+# Per-volume shard databases, used instead of DB_PATH when it is not present
+SHARD_PATHS = []
+_sharded_search = None
+_sharded_search_lock = threading.Lock()
+_shard_pools = {}  # one ConnectionPool per shard, like _connection_pool for DB_PATH
+_shard_pools_lock = threading.Lock()
+
+# Long-lived read connections to DB_PATH, at most one per request being served
+POOL_SIZE = 8
+POOL_CACHE_MB = 64  # SQLite page cache of each pooled connection
+POOL_MMAP_MB = 1024  # memory-mapped window, shared with other connections through the OS page cache
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+# Serve the database as immutable (file:...?mode=ro&immutable=1, or --immutable):
+# SQLite takes no locks and reads pages straight from the OS page cache through
+# mmap, shared by every worker process. Only for a database that nothing
+# writes to while it is being served.
+IMMUTABLE = False
+IMMUTABLE_MMAP_MB = 65536  # SQLite caps this at its compile-time limit, 2 GB by default
+IMMUTABLE_SETTLE_SECONDS = 1.0  # how long startup watches the file for changes
+
+# Results of recent searches, keyed by search_cache_key
+SEARCH_CACHE_SIZE = 64
+_search_cache = OrderedDict()
+_search_cache_lock = threading.Lock()  # Flask serves requests from several threads
+
+# Regex searches verify their candidates in one pool of worker processes shared
+# by all requests. The server listens on every interface, so each search is
+# bounded: it stops after REGEX_TIMEOUT_SECONDS, verifies at most
+# REGEX_MAX_CANDIDATES files and returns at most REGEX_MAX_RESULTS matches
+REGEX_WORKERS = os.cpu_count() or 1
+REGEX_TIMEOUT_SECONDS = 30
+REGEX_MAX_CANDIDATES = 50000
+REGEX_MAX_RESULTS = 1000
+_regex_pool = None
+_regex_pool_lock = threading.Lock()
+
+# Search types whose queries go through the query language of compile_query
+QUERY_LANGUAGE_TYPES = ('content', 'filename', 'all')
+
+
+def passage_result(conn, file_id, filepath, filename, passage, offset, rank, query_regex, snippet_length):
+    """
+    Build a search result from a passage hit.
+    The hit carries its passage offset, so the snippet is cut from the
+    content store (or assembled from the stored passages) instead of reading
+    the file from disk.
+    """
+
+    # Locate the match inside the passage and translate it to a document offset
+    match = re.search(query_regex, passage, flags=re.IGNORECASE)
+    if match:
+        match_start, match_end = offset + match.start(), offset + match.end()
+    else:
+        match_start = match_end = offset
+
+    # Decompress the stored document once for both the snippet and the preview
+    document = load_document(conn, file_id)
+    if document is not None:
+        length = len(document)
+        window = lambda window_start, window_end: document[window_start:window_end]
+    else:
+        length = document_length(conn, file_id)
+        window = lambda window_start, window_end: read_document_window(conn, file_id, window_start, window_end)
+    start = max(0, match_start - snippet_length)
+    end = min(length, match_end + snippet_length)
+    snippet = window(start, end)
+
+    # Add ellipsis if we truncated
+    if start > 0:
+        snippet = "..." + snippet
+    if end < length:
+        snippet = snippet + "..."
+
+    # Highlight the query in the snippet for display
+    highlighted_snippet = re.sub(
+        query_regex,
+        r'<span class="highlight">\g<0></span>',
+        snippet,
+        flags=re.IGNORECASE
+    )
+
+    return {
+        'file_path': filepath,
+        'file_name': filename,
+        'snippet': highlighted_snippet,
+        'rank': rank,
+        'offset': match_start,
+        'content_preview': window(0, 1000) + ("..." if length > 1000 else "")
+    }
+
+
+def file_result(conn, file_id, filepath, filename, db_content, rank, query_regex, snippet_length):
+    """Build a search result from a sample-index hit by loading the full document for the snippet."""
+    # For display, we'll use the full content from the content store, or from the file for older databases
+    full_content = load_document(conn, file_id)
+    if full_content is None:
+        try:
+            with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
+                full_content = f.read()
+        except Exception as e:
+            print(f"Error reading full content of {filepath}: {e}", file=sys.stderr)
+            full_content = db_content  # Fallback to DB content if file can't be read
+
+    # Find matches in full content and create snippets
+    pattern = re.compile(query_regex, re.IGNORECASE)
+    match = pattern.search(full_content)
+
+    if match:
+        # Use the first match to create a snippet
+        start = max(0, match.start() - snippet_length)
+        end = min(len(full_content), match.end() + snippet_length)
+        snippet = full_content[start:end]
+
+        # Add ellipsis if we truncated
+        if start > 0:
+            snippet = "..." + snippet
+        if end < len(full_content):
+            snippet = snippet + "..."
+    else:
+        # If no match found in full content (e.g., match was in filename), create a simple snippet from full content
+        snippet = full_content[:snippet_length*2]
+        if len(full_content) > snippet_length*2:
+            snippet = snippet + "..."
+
+    # Highlight the query in the snippet for display
+    highlighted_snippet = re.sub(
+        query_regex,
+        r'<span class="highlight">\g<0></span>',
+        snippet,
+        flags=re.IGNORECASE
+    )
+
+    return {
+        'file_path': filepath,
+        'file_name': filename,
+        'snippet': highlighted_snippet,
+        'rank': rank,
+        'content_preview': full_content[:1000] + ("..." if len(full_content) > 1000 else "")  # Preview for display
+    }
+
+
+def query_pattern(query, search_type):
+    """Regular expression that locates and highlights the query in a document for the given search type."""
+    if search_type == "substring":
+        return substring_regex(query)
+    if search_type == "regex":
+        return query
+    if search_type in ENTITY_KINDS:
+        value = normalize_entity(search_type, query)
+        if value is not None:
+            return entity_regex(search_type, value)
+    if search_type in QUERY_LANGUAGE_TYPES:
+        try:
+            return compile_query(query, search_type).highlight
+        except QuerySyntaxError:
+            pass
+    return re.escape(query)
+
+
+def build_result(conn, row, query_regex, snippet_length):
+    """Turn a query_index row into a result, taking the snippet from the passage index when possible."""
+    file_id, filename, filepath, text, offset, rank, *similar = row
+    if offset is None:
+        result = file_result(conn, file_id, filepath, filename, text, rank, query_regex, snippet_length)
+    else:
+        result = passage_result(conn, file_id, filepath, filename, text, offset, rank, query_regex, snippet_length)
+    result['doc_id'] = file_id
+    if similar:
+        result['similar'] = similar[0]
+    return result
+
+
+def open_read_connection(path):
+    """
+    Read-only connection for serving searches, with a large page cache,
+    memory-mapped reads and writes refused; opened immutable with IMMUTABLE.
+    """
+    conn = connect_read_only(path, IMMUTABLE)
+    conn.execute(f"PRAGMA cache_size = -{POOL_CACHE_MB * 1024}")
+    conn.execute(f"PRAGMA mmap_size = {(IMMUTABLE_MMAP_MB if IMMUTABLE else POOL_MMAP_MB) * 1048576}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+class ConnectionPool:
+    """
+    A bounded pool of long-lived read connections to one database file.
+
+    Connections keep their page cache, prepared statements and parsed schema
+    from one request to the next. Up to size connections are opened as
+    concurrent requests need them; beyond that, requests wait for one to be
+    handed back.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.identity = self.file_identity()
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def file_identity(self):
+        """Device and inode of the database file, which change when it is rebuilt and replaced."""
+        stat = os.stat(self.path)
+        return stat.st_dev, stat.st_ino
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a with block."""
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_open = self.opened < self.size
+                if can_open:
+                    self.opened += 1
+            if can_open:
+                try:
+                    conn = open_read_connection(self.path)
+                except Exception:
+                    with self.lock:
+                        self.opened -= 1
+                    raise
+            else:
+                conn = self.idle.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self.idle.put(conn)
+
+    def close(self):
+        """Close the idle connections; borrowed ones are closed when they are garbage collected."""
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def check_not_modified(paths):
+    """
+    Make sure nothing is writing to the databases before serving them
+    immutable, where SQLite would not notice changes and could return
+    garbage. Raises RuntimeError if a database has a rollback journal or
+    an un-checkpointed WAL, if another connection holds its write lock, or
+    if its size or modification time changes within IMMUTABLE_SETTLE_SECONDS.
+    """
+    before = {}
+    for path in paths:
+        for suffix in ('-journal', '-wal'):
+            if os.path.exists(path + suffix) and os.path.getsize(path + suffix) > 0:
+                raise RuntimeError(f"{path + suffix} is not empty: the database is being written to, "
+                                   f"or its WAL needs a checkpoint (PRAGMA wal_checkpoint(TRUNCATE))")
+        if os.access(path, os.W_OK):
+            # Readers don't block this, but a connection in a write transaction does
+            conn = sqlite3.connect(path, timeout=0)
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.rollback()
+            except sqlite3.OperationalError as e:
+                raise RuntimeError(f"{path} is locked by a writer: {e}")
+            finally:
+                conn.close()
+        stat = os.stat(path)
+        before[path] = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    time.sleep(IMMUTABLE_SETTLE_SECONDS)
+    for path, identity in before.items():
+        stat = os.stat(path)
+        if (stat.st_ino, stat.st_size, stat.st_mtime_ns) != identity:
+            raise RuntimeError(f"{path} changed during startup; it is being modified")
+
+
+def database_connection():
+    """
+    A pooled connection to DB_PATH, for use in a with block. The pool is
+    replaced when DB_PATH points to a different file than it was opened on.
+    """
+    global _connection_pool
+    with _connection_pool_lock:
+        pool = _connection_pool
+        if pool is None or pool.path != DB_PATH or pool.identity != pool.file_identity():
+            if pool is not None:
+                pool.close()
+            pool = _connection_pool = ConnectionPool(DB_PATH, POOL_SIZE)
+    return pool.connection()
+
+
+def shard_connection(shard):
+    """
+    A pooled connection to a shard database, for use in a with block. Each
+    shard has its own pool, replaced when the shard file is replaced.
+    """
+    with _shard_pools_lock:
+        pool = _shard_pools.get(shard)
+        if pool is None or pool.identity != pool.file_identity():
+            if pool is not None:
+                pool.close()
+            pool = _shard_pools[shard] = ConnectionPool(shard, POOL_SIZE)
+    return pool.connection()
+
+
+def sharded_search():
+    """The ShardedTextSearch over SHARD_PATHS, created once and shared by all requests."""
+    global _sharded_search
+    with _sharded_search_lock:
+        if _sharded_search is None:
+            _sharded_search = ShardedTextSearch(SHARD_PATHS, immutable=IMMUTABLE)
+    return _sharded_search
+
+
+def search_shards(query, snippet_length=1000, search_type="content", collapse_duplicates=False,
+                  date_from=None, date_to=None):
+    """Search the per-volume shard databases in parallel and build results from the merged hits."""
+    if search_type == "regex":
+        # Verified in the shared regex pool, under the same bounds as a single database
+        hits = search_regex(query, date_from, date_to, SHARD_PATHS)
+        if collapse_duplicates:
+            # Near-duplicate groups are per shard
+            by_shard = {}
+            for shard, *row in hits:
+                by_shard.setdefault(shard, []).append(row)
+            hits = []
+            for shard, rows in by_shard.items():
+                with shard_connection(shard) as conn:
+                    hits.extend((shard,) + row for row in collapse_duplicate_rows(conn, rows))
+            hits.sort(key=lambda hit: hit[6])
+    else:
+        hits = sharded_search().search(query, search_type, collapse_duplicates=collapse_duplicates,
+                                       date_from=date_from, date_to=date_to)
+    query_regex = query_pattern(query, search_type)
+    results = []
+    for shard, *row in hits:
+        with shard_connection(shard) as conn:
+            results.append(build_result(conn, row, query_regex, snippet_length))
+    return results
+
+
+def search_database(query, snippet_length=1000, search_type="content", collapse_duplicates=False,
+                    date_from=None, date_to=None):
     """
     Search for the query in the database.
 
     Args:
-        query (str): The search query
+        query (str): The search query; content, filename and all searches take the
+            query language of compile_query (AND, OR, NOT, "phrases", NEAR, prefix*)
         snippet_length (int): Number of characters before and after the match to include in snippet
-        search_type (str): 'content', 'filename', or 'all'
+        search_type (str): 'content', 'filename', 'all', 'substring', 'regex',
+            or an entity kind: 'email', 'phone', 'amount' or 'person'
+        collapse_duplicates (bool): Return one result per group of near-duplicate documents
+        date_from, date_to (str): Only documents mentioning a date in this range (YYYY-MM-DD)
 
     Returns:
-        list: List of dictionaries with search results
+        list: List of dictionaries with search results, cached until the database changes
     """
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    key = search_cache_key(query, search_type, snippet_length, collapse_duplicates, date_from, date_to)
+    if key is not None:
+        with _search_cache_lock:
+            results = _search_cache.get(key)
+            if results is not None:
+                _search_cache.move_to_end(key)
+                return results
+
+    if SHARD_PATHS:
+        try:
+            results = search_shards(query, snippet_length, search_type, collapse_duplicates, date_from, date_to)
+        except Exception as e:
+            print(f"Error searching shards: {e}", file=sys.stderr)
+            return []
+    else:
+        try:
+            results = search_single_database(query, snippet_length, search_type, collapse_duplicates,
+                                             date_from, date_to)
+        except Exception as e:
+            print(f"Error searching database: {e}", file=sys.stderr)
+            return []
+
+    if key is not None and SEARCH_CACHE_SIZE > 0:
+        with _search_cache_lock:
+            _search_cache[key] = results
+            _search_cache.move_to_end(key)
+            while len(_search_cache) > SEARCH_CACHE_SIZE:
+                _search_cache.popitem(last=False)
+    return results
+
+
+def search_single_database(query, snippet_length=1000, search_type="content", collapse_duplicates=False,
+                           date_from=None, date_to=None):
+    """Search DB_PATH and build the results; see search_database."""
+    with database_connection() as conn:
+        # Content searches go to the passage index when it has been built,
+        # other searches to the 10 KB sample index
+        if search_type == "regex":
+            # Verify the trigram candidates in parallel instead of in this process
+            rows = search_regex(query, date_from, date_to)
+            rows = collapse_duplicate_rows(conn, rows) if collapse_duplicates else rows
+        else:
+            rows = query_index(conn, query, search_type, 10000, collapse_duplicates, date_from, date_to)
+        query_regex = query_pattern(query, search_type)
+        return [build_result(conn, row, query_regex, snippet_length) for row in rows]
+
+
+def regex_pool():
+    """The regex verification pool shared by all requests, started on first use."""
+    global _regex_pool
+    with _regex_pool_lock:
+        if _regex_pool is None:
+            _regex_pool = multiprocessing.Pool(REGEX_WORKERS)
+        return _regex_pool
+
 
+def search_regex(query, date_from=None, date_to=None, shard_paths=None):
+    """
+    Regex hits in DB_PATH, or in each of shard_paths with the shard path
+    prepended to every row, best first, verified in the shared pool. The
+    bounds hold for the whole search: REGEX_MAX_CANDIDATES is split between
+    the shards and REGEX_MAX_RESULTS and REGEX_TIMEOUT_SECONDS are shared.
+    A search that runs past its deadline returns what it found until then
+    and replaces the pool, whose workers may be stuck on a slow pattern.
+    """
+    global _regex_pool
+    pool = regex_pool()
+    paths = shard_paths or [DB_PATH]
+    deadline = time.time() + REGEX_TIMEOUT_SECONDS
+    rows = []
     try:
-        # Prepare FTS query based on search type
-        # For phrase search (multi-word queries), wrap in quotes to match the exact phrase
-        if ' ' in query:
-            # Escape double quotes in the query and wrap in quotes for phrase matching
-            escaped_query = query.replace('"', '""')
-            quoted_query = f'"{escaped_query}"'
-        else:
-            # For single words, use the original query
-            quoted_query = query
-
-        if search_type == "content":
-            fts_query = f"content:{quoted_query}"
-            cursor.execute(
-                '''
-                SELECT
-                    tf.filepath,
-                    tf.filename,
-                    tf.content,
-                    text_files_fts.rank
-                FROM text_files_fts
-                JOIN text_files AS tf ON text_files_fts.rowid = tf.id
-                WHERE text_files_fts MATCH ?
-                ORDER BY text_files_fts.rank
-                LIMIT 10000
-                ''',
-                (fts_query,)
-            )
-        elif search_type == "filename":
-            fts_query = f"filename:{quoted_query}"
-            cursor.execute(
-                '''
-                SELECT
-                    tf.filepath,
-                    tf.filename,
-                    tf.content,
-                    text_files_fts.rank
-                FROM text_files_fts
-                JOIN text_files AS tf ON text_files_fts.rowid = tf.id
-                WHERE text_files_fts MATCH ?
-                ORDER BY text_files_fts.rank
-                LIMIT 10000
-                ''',
-                (fts_query,)
-            )
-        elif search_type == "all":
-            fts_query = f"content:{quoted_query} OR filename:{quoted_query}"
-            cursor.execute(
-                '''
-                SELECT
-                    tf.filepath,
-                    tf.filename,
-                    tf.content,
-                    text_files_fts.rank
-                FROM text_files_fts
-                JOIN text_files AS tf ON text_files_fts.rowid = tf.id
-                WHERE text_files_fts MATCH ?
-                ORDER BY text_files_fts.rank
-                LIMIT 10000
-                ''',
-                (fts_query,)
-            )
-        else:
-            # Default to content search
-            fts_query = f"content:{quoted_query}"
-            cursor.execute(
-                '''
-                SELECT
-                    tf.filepath,
-                    tf.filename,
-                    tf.content,
-                    text_files_fts.rank
-                FROM text_files_fts
-                JOIN text_files AS tf ON text_files_fts.rowid = tf.id
-                WHERE text_files_fts MATCH ?
-                ORDER BY text_files_fts.rank
-                LIMIT 10000
-                ''',
-                (fts_query,)
-            )
-
-        rows = cursor.fetchall()
-        results = []
-
-        # Process each result to create snippets
-        # The content in the database is a sample for FTS, but for display we should load the full content
-        for filepath, filename, db_content, rank in rows:
-            # For display, we'll use the full content from the file, but for search, the DB has already matched
-            try:
-                with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
-                    full_content = f.read()
-            except Exception as e:
-                print(f"Error reading full content of {filepath}: {e}", file=sys.stderr)
-                full_content = db_content  # Fallback to DB content if file can't be read
-
-            # Find matches in full content and create snippets
-            query_regex = re.escape(query)
-            pattern = re.compile(query_regex, re.IGNORECASE)
-            matches = list(pattern.finditer(full_content))
-
-            if matches:
-                # Use the first match to create a snippet
-                match = matches[0]
-                start = max(0, match.start() - snippet_length)
-                end = min(len(full_content), match.end() + snippet_length)
-                snippet = full_content[start:end]
-
-                # Add ellipsis if we truncated
-                if start > 0:
-                    snippet = "..." + snippet
-                if end < len(full_content):
-                    snippet = snippet + "..."
-
-                # Highlight the query in the snippet for display
-                highlighted_snippet = re.sub(
-                    query_regex, 
-                    r'<span class="highlight">\g<0></span>', 
-                    snippet, 
-                    flags=re.IGNORECASE
-                )
-
-                results.append({
-                    'file_path': filepath,
-                    'file_name': filename,
-                    'snippet': highlighted_snippet,
-                    'rank': rank,
-                    'content_preview': full_content[:1000] + ("..." if len(full_content) > 1000 else "")  # Preview for display
-                })
-            else:
-                # If no match found in full content (e.g., match was in filename), create a simple snippet from full content
-                snippet = full_content[:snippet_length*2]
-                if len(full_content) > snippet_length*2:
-                    snippet = snippet + "..."
-
-                # Still apply highlighting in case the query appears elsewhere in the snippet
-                highlighted_snippet = re.sub(
-                    query_regex, 
-                    r'<span class="highlight">\g<0></span>', 
-                    snippet, 
-                    flags=re.IGNORECASE
-                )
-
-                results.append({
-                    'file_path': filepath,
-                    'file_name': filename,
-                    'snippet': highlighted_snippet,
-                    'rank': rank,
-                    'content_preview': full_content[:1000] + ("..." if len(full_content) > 1000 else "")  # Preview for display
-                })
-
-        return results
+        for path in paths:
+            if len(rows) >= REGEX_MAX_RESULTS:
+                break
+            for row in iter_regex_search(path, query, REGEX_MAX_RESULTS - len(rows), date_from=date_from,
+                                         date_to=date_to, immutable=IMMUTABLE, pool=pool,
+                                         timeout=max(deadline - time.time(), 0),
+                                         max_candidates=max(REGEX_MAX_CANDIDATES // len(paths), 1)):
+                rows.append((path,) + row if shard_paths else row)
+    except TimeoutError:
+        print(f"Regex search for {query!r} ran past {REGEX_TIMEOUT_SECONDS} seconds; "
+              f"returning the {len(rows)} results found so far", file=sys.stderr)
+        with _regex_pool_lock:
+            if _regex_pool is pool:
+                _regex_pool = None
+        pool.terminate()
+    return sorted(rows, key=lambda row: row[-1])
+
+
+def without_trigram_index():
+    """
+    The databases searched (DB_PATH or each of SHARD_PATHS) that were built
+    without the trigram index, which substring searches need.
+    """
+    missing = []
+    for path in SHARD_PATHS or [DB_PATH]:
+        with (shard_connection(path) if SHARD_PATHS else database_connection()) as conn:
+            if not has_trigram_index(conn):
+                missing.append(path)
+    return missing
 
-    except Exception as e:
-        print(f"Error searching database: {e}", file=sys.stderr)
-        return []
-    finally:
-        conn.close()
+
+def search_cache_key(query, search_type, *options):
+    """
+    Key under which the results of a search are cached: the normalized query
+    (see compile_query), so "Clinton  island" and "island clinton" share an
+    entry, the search options and the size and modification time of the
+    database files, so entries lapse when the index changes. None for
+    queries that don't compile.
+    """
+    if search_type in QUERY_LANGUAGE_TYPES:
+        try:
+            query = compile_query(query, search_type).cache_key
+        except QuerySyntaxError:
+            return None
+    versions = []
+    for path in SHARD_PATHS or [DB_PATH]:
+        for suffix in ('', '-wal'):
+            try:
+                stat = os.stat(path + suffix)
+                versions.append((stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                versions.append(None)
+    return (query, search_type) + options + tuple(versions)
 
 
 @app.route('/')
@@ -205,107 +550,247 @@ def search():
     query = data.get('query', '')
     snippet_length = int(data.get('snippet_length', 1000))
     search_type = data.get('search_type', 'content')  # Default to content search
+    collapse_duplicates = bool(data.get('collapse_duplicates', False))
 
     if not query:
         return jsonify({'error': 'Query is required'}), 400
+    try:
+        # Years or months stand for their whole range: to=2005 means up to 2005-12-31
+        date_from = date_bound(data['from']) if data.get('from') else None
+        date_to = date_bound(data['to'], end=True) if data.get('to') else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if search_type in QUERY_LANGUAGE_TYPES:
+        try:
+            compile_query(query, search_type)
+        except QuerySyntaxError as e:
+            return jsonify({'error': f'Invalid query: {e}'}), 400
+    if search_type == 'regex':
+        try:
+            re.compile(query)
+        except re.error as e:
+            return jsonify({'error': f'Invalid regular expression: {e}'}), 400
+    if search_type == 'substring':
+        missing = without_trigram_index()
+        if missing:
+            return jsonify({'error': 'Substring search needs the trigram index (index --trigram), '
+                                     f'which {", ".join(map(os.path.basename, missing))} was built without'}), 400
 
     print(f"Searching for: '{query}' in {search_type} with snippet length: {snippet_length}", file=sys.stderr)
-    results = search_database(query, snippet_length, search_type)
+    results = search_database(query, snippet_length, search_type, collapse_duplicates, date_from, date_to)
     print(f"Found {len(results)} results", file=sys.stderr)
 
-    return jsonify({
+    response = {
         'query': query,
         'results': results,
         'count': len(results),
-        'search_type': search_type
+        'search_type': search_type,
+        'from': date_from,
+        'to': date_to
+    }
+    if len(results) < SPELL_SUGGEST_BELOW and search_type in ('content', 'all'):
+        response['did_you_mean'] = [
+            {'query': corrected, 'edits': edits, 'documents': documents}
+            for corrected, edits, documents in correct_spelling(query)
+        ]
+    return jsonify(response)
+
+
+def correct_spelling(query):
+    """Ranked spelling corrections of a query from the database (or shards) vocabulary."""
+    try:
+        if SHARD_PATHS:
+            return sharded_search().spelling_corrections(query, connection=shard_connection)
+        with database_connection() as conn:
+            return spelling_corrections(conn, query)
+    except Exception as e:
+        print(f"Error computing spelling corrections: {e}", file=sys.stderr)
+        return []
+
+
+@app.route('/suggest')
+def suggest():
+    """Completions for the word being typed, most frequent indexed terms first"""
+    prefix = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    if SHARD_PATHS:
+        # Add up the term counts of all volumes and keep the most frequent
+        totals = {}
+        for shard in SHARD_PATHS:
+            with shard_connection(shard) as conn:
+                for term, documents in suggest_terms(conn, prefix, limit):
+                    totals[term] = totals.get(term, 0) + documents
+        ranked = sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:limit]
+    else:
+        with database_connection() as conn:
+            ranked = suggest_terms(conn, prefix, limit)
+    return jsonify({
+        'prefix': prefix,
+        'suggestions': [{'term': term, 'documents': documents} for term, documents in ranked]
     })
 
 
+def stored_file_lookup(lookup, file_path):
+    """Run a content store lookup for an indexed file on the database, or on each shard in turn."""
+    if SHARD_PATHS:
+        for shard in SHARD_PATHS:
+            with shard_connection(shard) as conn:
+                result = lookup(conn, file_path)
+            if result is not None:
+                return result
+        return None
+    if not os.path.exists(DB_PATH):
+        return None
+    with database_connection() as conn:
+        return lookup(conn, file_path)
+
+
+@app.route('/similar/<int:doc_id>')
+def similar(doc_id):
+    """
+    The documents most similar to a document (by text_files id), from the
+    TF-IDF matrix. The matrix is loaded on the first request and kept until
+    the server restarts, so restart it after rebuilding the matrix.
+    Neighbours deleted from the database since the matrix was built are
+    left out.
+    """
+    global _similarity_index
+    if SHARD_PATHS:
+        return jsonify({'error': 'Similar documents are not available for sharded databases'}), 404
+    if _similarity_index is None:
+        try:
+            _similarity_index = SimilarityIndex(DB_PATH)
+        except (RuntimeError, FileNotFoundError) as e:
+            return jsonify({'error': str(e)}), 404
+    limit = min(max(request.args.get('k', SIMILARITY_TOP_K, type=int), 1), 100)
+    try:
+        neighbours = _similarity_index.similar(doc_id, limit)
+    except KeyError:
+        return jsonify({'error': f'Document {doc_id} is not in the similarity matrix'}), 404
+
+    results = []
+    with database_connection() as conn:
+        for file_id, score in neighbours:
+            row = conn.execute("SELECT filename, filepath FROM text_files WHERE id = ?", (file_id,)).fetchone()
+            if row is not None:
+                results.append({'doc_id': file_id, 'file_name': row[0], 'file_path': row[1], 'score': score})
+    return jsonify({'doc_id': doc_id, 'results': results})
+
+
+def load_stored_file(file_path):
+    """Full text of an indexed file from the database content store, or None if it is not stored there."""
+    return stored_file_lookup(load_document_by_path, file_path)
+
+
+def not_modified(etag, mtime_ns):
+    """A 304 response when the request's If-None-Match or If-Modified-Since still matches, else None."""
+    response = validated(make_response(''), etag, mtime_ns)
+    return response if response.status_code == 304 else None
+
+
+def validated(response, etag, mtime_ns):
+    """Add the ETag, Last-Modified and Cache-Control headers to a response and answer conditional requests."""
+    response.set_etag(etag)
+    response.last_modified = mtime_ns // 1000000000
+    if CACHE_MAX_AGE > 0:
+        response.cache_control.public = True
+    else:
+        response.cache_control.no_cache = True
+    response.cache_control.max_age = CACHE_MAX_AGE
+    return response.make_conditional(request)
+
+
+def image_manifest_lookup(lookup, *args):
+    """
+    Run an image manifest lookup on the database, or on each shard in turn.
+    Returns False when no manifest has been built, so the caller can fall
+    back to probing the image directories.
+    """
+    if not SHARD_PATHS:
+        if not os.path.exists(DB_PATH):
+            return False
+        with database_connection() as conn:
+            return lookup(conn, *args) if has_image_manifest(conn) else False
+    found_manifest = False
+    for shard in SHARD_PATHS:
+        with shard_connection(shard) as conn:
+            if not has_image_manifest(conn):
+                continue
+            found_manifest = True
+            result = lookup(conn, *args)
+        if result is not None:
+            return result
+    return None if found_manifest else False
+
+
+def image_url_for(txt_path):
+    """URL of the page image that belongs to a text file, or None."""
+    image = image_manifest_lookup(lookup_image, txt_path)
+    if image is not False:
+        return f"/view_image/{image[1]}/{image[2]}" if image else None
+
+    image_path = find_corresponding_image(txt_path)
+    if not image_path:
+        return None
+    filename = os.path.basename(image_path)
+    # Find which directory number the image is in
+    dirs_with_numbers = [f"00{i}" for i in range(1, 13)]
+    for dir_num in dirs_with_numbers:
+        if f"/{dir_num}/" in image_path:
+            return f"/view_image/{dir_num}/{filename}"
+    # If not found in expected dir structure, try to extract from path
+    match = re.search(r'/(\d{3})/([^/]+)$', image_path)
+    if match:
+        return f"/view_image/{match.group(1)}/{match.group(2)}"
+    return None
+
+
 @app.route('/view_file/<path:file_path>')
 def view_file(file_path):
-    """View the full content of a file"""
-    import os
+    """View the full content of a file, from the database content store when it is there"""
+    import urllib.parse
     # Handle potential missing leading slash from Flask's path converter
     # The file path received might be missing the leading slash
     if not file_path.startswith('/'):
         full_path = '/' + file_path
     else:
         full_path = file_path
-    
-    # First try with full path (with leading slash)
-    if os.path.exists(full_path) and full_path.endswith('.txt'):
+
+    # First try with full path (with leading slash), then with additional URL decoding
+    for candidate in (full_path, urllib.parse.unquote(full_path)):
+        if not candidate.endswith('.txt'):
+            continue
         try:
-            with open(full_path, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()
-            
-            # Look for corresponding image file and generate a URL to serve it
-            image_path = find_corresponding_image(full_path)
-            image_url = None
-            if image_path:
-                filename = os.path.basename(image_path)
-                # Find which directory number the image is in
-                dirs_with_numbers = [f"00{i}" for i in range(1, 13)]
-                for dir_num in dirs_with_numbers:
-                    if f"/{dir_num}/" in image_path:
-                        image_url = f"/view_image/{dir_num}/{filename}"
-                        break
-                # If not found in expected dir structure, try to extract from path
-                if not image_url:
-                    import re
-                    match = re.search(r'/(\d{3})/([^/]+)$', image_path)
-                    if match:
-                        dir_part = match.group(1)
-                        file_part = match.group(2)
-                        image_url = f"/view_image/{dir_part}/{file_part}"
-            
-            return render_template('view_file.html',
-                                 file_path=full_path,
-                                 content=content,
-                                 image_url=image_url)
+            # The stored content hash (or the file's size and mtime) and the image link identify the page,
+            # so a revisit is answered with a 304 before the text is loaded
+            version = stored_file_lookup(document_version, candidate)
+            if version is None:
+                if not os.path.exists(candidate):
+                    continue
+                stat = os.stat(candidate)
+                version = (f"{stat.st_size}-{stat.st_mtime_ns}", stat.st_mtime_ns)
+            image_url = image_url_for(candidate)
+            etag = hashlib.sha1(f"{candidate}\0{version[0]}\0{image_url}".encode('utf-8')).hexdigest()
+            response = not_modified(etag, version[1])
+            if response is not None:
+                return response
+
+            content = load_stored_file(candidate)
+            if content is None:
+                with open(candidate, 'r', encoding='utf-8', errors='ignore') as f:
+                    content = f.read()
+
+            return validated(make_response(render_template('view_file.html',
+                                                           file_path=candidate,
+                                                           content=content,
+                                                           image_url=image_url)), etag, version[1])
         except Exception as e:
             return f"Error reading file: {e}", 500
-    else:
-        # If the full path doesn't work, try with additional URL decoding
-        import urllib.parse
-        decoded_path = urllib.parse.unquote(full_path)
-        
-        if os.path.exists(decoded_path) and decoded_path.endswith('.txt'):
-            try:
-                with open(decoded_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    content = f.read()
-                
-                # Look for corresponding image file and generate a URL to serve it
-                image_path = find_corresponding_image(decoded_path)
-                image_url = None
-                if image_path:
-                    filename = os.path.basename(image_path)
-                    # Find which directory number the image is in
-                    dirs_with_numbers = [f"00{i}" for i in range(1, 13)]
-                    for dir_num in dirs_with_numbers:
-                        if f"/{dir_num}/" in image_path:
-                            image_url = f"/view_image/{dir_num}/{filename}"
-                            break
-                    # If not found in expected dir structure, try to extract from path
-                    if not image_url:
-                        import re
-                        match = re.search(r'/(\d{3})/([^/]+)$', image_path)
-                        if match:
-                            dir_part = match.group(1)
-                            file_part = match.group(2)
-                            image_url = f"/view_image/{dir_part}/{file_part}"
-                
-                return render_template('view_file.html',
-                                     file_path=decoded_path,
-                                     content=content,
-                                     image_url=image_url)
-            except Exception as e:
-                return f"Error reading file: {e}", 500
-        else:
-            return "File not found", 404
+    return "File not found", 404
 
 
 def find_corresponding_image(txt_path):
-    """Find the corresponding image file for a text file"""
+    """Find the corresponding image file for a text file by probing the image directories (without a manifest)"""
     import os
     import re
     
@@ -320,7 +805,7 @@ def find_corresponding_image(txt_path):
     match = re.search(r'/TEXT/(\d{3})/', txt_path)
     if match:
         sub_dir = match.group(1)  # e.g., "001", "002", etc.
-        image_dir = f"/home/jon/Documents/Epstein dump nov 12/{sub_dir}"
+        image_dir = os.path.join(IMAGE_DIR, sub_dir)
         
         for ext in image_extensions:
             image_path = os.path.join(image_dir, f"{base_name}{ext}")
@@ -328,7 +813,7 @@ def find_corresponding_image(txt_path):
                 return image_path
     
     # If not found in the matching directory, search in all numbered directories
-    base_dir = "/home/jon/Documents/Epstein dump nov 12"
+    base_dir = IMAGE_DIR
     for i in range(1, 13):  # 001 to 012
         dir_num = f"{i:03d}"  # Format as 001, 002, ..., 012
         image_dir = os.path.join(base_dir, dir_num)
@@ -341,11 +826,25 @@ def find_corresponding_image(txt_path):
     return None
 
 
+def derivative_cache():
+    """The derivative cache, or None when Pillow is not installed."""
+    global _derivative_cache
+    if Image is None:
+        return None
+    if _derivative_cache is None:
+        _derivative_cache = DerivativeCache(DERIVATIVE_CACHE_DIR, DERIVATIVE_CACHE_MB * 1048576, DERIVATIVE_FORMAT)
+    return _derivative_cache
+
+
 @app.route('/view_image/<dir_num>/<filename>')
 def view_image(dir_num, filename):
-    """Serve image files"""
+    """Serve an image file: a scaled copy (?size=web, the default, or thumb) or the scan itself (?size=original)"""
     import os
     
+    size = request.args.get('size', 'web')
+    if size != 'original' and size not in DERIVATIVE_SIZES:
+        return "Invalid size", 400
+
     # Validate directory number to prevent directory traversal
     if not dir_num.isdigit() or int(dir_num) < 1 or int(dir_num) > 12:
         return "Invalid directory", 400
@@ -354,17 +853,47 @@ def view_image(dir_num, filename):
     if '..' in filename or filename.startswith('/'):
         return "Invalid filename", 400
     
-    # Construct the full path
-    base_path = f"/home/jon/Documents/Epstein dump nov 12/{dir_num}"
-    full_path = os.path.join(base_path, filename)
-    
-    # Check if the file exists and is in the expected location
-    if os.path.exists(full_path) and os.path.isfile(full_path):
-        from flask import send_file
-        return send_file(full_path)
-    else:
+    # One indexed lookup in the image manifest, or the full path in the volume directory without one
+    full_path = image_manifest_lookup(lookup_image_file, dir_num, filename)
+    if full_path is False:
+        full_path = os.path.join(IMAGE_DIR, dir_num, filename)
+    # Scans that were not unzipped are read straight out of their release archive
+    scan = image_manifest_lookup(lookup_archive_member, dir_num, filename) if full_path is None else None
+    if not scan and not (full_path and os.path.isfile(full_path)):
         return "File not found", 404
 
+    from flask import send_file
+    source = scan or full_path
+    # Strong ETags from the scan's identity (and the rendition settings), so revisits cost a 304
+    # and send_file answers Range requests for partial loads
+    identity, mtime_ns = scan_identity(source)
+    cache = derivative_cache()
+    if size != 'original' and cache is not None:
+        # The cache file name with its extension, so switching DERIVATIVE_FORMAT changes the ETag
+        etag = os.path.basename(cache.path_for(source, size, identity))
+        response = not_modified(etag, mtime_ns)
+        if response is not None:
+            return response
+        try:
+            return send_file(cache.get(source, size, identity), mimetype=f"image/{cache.image_format}",
+                             etag=etag, last_modified=mtime_ns // 1000000000, max_age=CACHE_MAX_AGE)
+        except Exception as e:
+            # Formats Pillow can't read are still served as they are
+            app.logger.warning(f"Could not render {filename}: {e}")
+
+    etag = hashlib.sha1(identity.encode('utf-8')).hexdigest()
+    response = not_modified(etag, mtime_ns)
+    if response is not None:
+        return response
+    if scan:
+        try:
+            data = read_archive_member(scan)
+        except (OSError, ValueError) as e:
+            return f"Error reading image: {e}", 500
+        return send_file(io.BytesIO(data), mimetype=f"image/{scan.format}", download_name=filename,
+                         etag=etag, last_modified=mtime_ns // 1000000000, max_age=CACHE_MAX_AGE)
+    return send_file(full_path, etag=etag, last_modified=mtime_ns // 1000000000, max_age=CACHE_MAX_AGE)
+
 def create_templates():
     """Create template files if they don't exist"""
     templates_dir = os.path.join(os.path.dirname(__file__), 'templates')
@@ -484,6 +1013,14 @@ def create_templates():
             font-weight: bold;
         }
 
+        input.date-input {
+            width: 120px;
+            margin-right: 10px;
+        }
+        .did-you-mean {
+            margin-bottom: 15px;
+            font-style: italic;
+        }
         .error-message {
             color: #dc3545;
             font-weight: bold;
@@ -495,6 +1032,22 @@ def create_templates():
             color: #666;
             margin-top: 5px;
         }
+
+        .checkbox-label {
+            display: inline;
+            font-weight: normal;
+        }
+
+        .similar-count {
+            font-size: 12px;
+            color: #666;
+            margin-left: 8px;
+        }
+
+        .more-like-this {
+            font-size: 12px;
+            margin-left: 8px;
+        }
     </style>
 </head>
 <body>
@@ -504,7 +1057,8 @@ def create_templates():
         <form class="search-form" id="searchForm">
             <div class="form-group">
                 <label for="query">Search Query:</label>
-                <input type="text" id="query" name="query" required placeholder="Enter search term (e.g., 'Epstein', 'Jeffrey', 'sex', etc.)">
+                <input type="text" id="query" name="query" required autocomplete="off" list="suggestions" placeholder="Enter search term (e.g., 'Epstein', 'Jeffrey', 'sex', etc.)">
+                <datalist id="suggestions"></datalist>
             </div>
 
             <div class="form-group">
@@ -513,6 +1067,12 @@ def create_templates():
                     <option value="content" selected>Content Only</option>
                     <option value="filename">Filename Only</option>
                     <option value="all">Content and Filename</option>
+                    <option value="substring">Substring (inside words, * and ? wildcards)</option>
+                    <option value="regex">Regular Expression</option>
+                    <option value="email">Email Address</option>
+                    <option value="phone">Phone Number</option>
+                    <option value="amount">Dollar Amount</option>
+                    <option value="person">Person Name</option>
                 </select>
                 <div class="search-type-info">Content Only is recommended for best performance</div>
             </div>
@@ -522,6 +1082,17 @@ def create_templates():
                 <input type="number" id="snippet_length" name="snippet_length" value="1000" min="10" max="2000">
             </div>
 
+            <div class="form-group">
+                <label for="date_from">Mentions a date from / to (YYYY, YYYY-MM or YYYY-MM-DD, optional):</label>
+                <input type="text" id="date_from" name="date_from" class="date-input" placeholder="2002">
+                <input type="text" id="date_to" name="date_to" class="date-input" placeholder="2005">
+            </div>
+
+            <div class="form-group">
+                <input type="checkbox" id="collapse_duplicates" name="collapse_duplicates">
+                <label for="collapse_duplicates" class="checkbox-label">Show one result per group of near-duplicate documents</label>
+            </div>
+
             <button type="submit">Search</button>
         </form>
 
@@ -531,12 +1102,44 @@ def create_templates():
     </div>
 
     <script>
+        // Offer completions for the last word of the query as the user types
+        let suggestTimer = null;
+        document.getElementById('query').addEventListener('input', function() {
+            clearTimeout(suggestTimer);
+            const query = this.value;
+            const words = query.split(' ');
+            const prefix = words[words.length - 1];
+            const searchType = document.getElementById('search_type').value;
+            if (prefix.length < 1 || searchType === 'regex' || searchType === 'filename') {
+                document.getElementById('suggestions').innerHTML = '';
+                return;
+            }
+            suggestTimer = setTimeout(async function() {
+                try {
+                    const response = await fetch('/suggest?q=' + encodeURIComponent(prefix));
+                    const data = await response.json();
+                    const head = words.slice(0, -1).join(' ');
+                    document.getElementById('suggestions').replaceChildren(...data.suggestions.map(function(s) {
+                        const option = document.createElement('option');
+                        option.value = (head ? head + ' ' : '') + s.term;
+                        option.textContent = `${s.documents} passages`;
+                        return option;
+                    }));
+                } catch (error) {
+                    document.getElementById('suggestions').innerHTML = '';
+                }
+            }, 100);
+        });
+
         document.getElementById('searchForm').addEventListener('submit', async function(e) {
             e.preventDefault();
 
             const query = document.getElementById('query').value;
             const snippetLength = document.getElementById('snippet_length').value;
             const searchType = document.getElementById('search_type').value;
+            const collapseDuplicates = document.getElementById('collapse_duplicates').checked;
+            const dateFrom = document.getElementById('date_from').value.trim();
+            const dateTo = document.getElementById('date_to').value.trim();
 
             if (!query.trim()) {
                 alert('Please enter a search query');
@@ -556,7 +1159,10 @@ def create_templates():
                     body: JSON.stringify({
                         query: query,
                         snippet_length: parseInt(snippetLength),
-                        search_type: searchType
+                        search_type: searchType,
+                        collapse_duplicates: collapseDuplicates,
+                        from: dateFrom,
+                        to: dateTo
                     })
                 });
 
@@ -574,15 +1180,28 @@ def create_templates():
             }
         });
 
+        function searchFor(query) {
+            document.getElementById('query').value = query;
+            document.getElementById('searchForm').requestSubmit();
+        }
+
         function displayResults(data) {
             const resultsContainer = document.getElementById('results');
 
+            // Spelling corrections, each a link that searches for it
+            let didYouMean = '';
+            if (data.did_you_mean && data.did_you_mean.length > 0) {
+                didYouMean = '<div class="did-you-mean">Did you mean: ' + data.did_you_mean.map(function(correction) {
+                    return `<a href="#" onclick="searchFor(this.textContent); return false;">${correction.query}</a>`;
+                }).join(', ') + '?</div>';
+            }
+
             if (data.count === 0) {
-                resultsContainer.innerHTML = '<p>No results found. Try another search term.</p>';
+                resultsContainer.innerHTML = didYouMean + '<p>No results found. Try another search term.</p>';
                 return;
             }
 
-            let html = `<div class="result-count">${data.count} result${data.count !== 1 ? 's' : ''} found for "${data.query}" (searched in ${data.search_type})</div>`;
+            let html = didYouMean + `<div class="result-count">${data.count} result${data.count !== 1 ? 's' : ''} found for "${data.query}" (searched in ${data.search_type})</div>`;
 
             data.results.forEach(result => {
                 html += `
@@ -590,13 +1209,35 @@ def create_templates():
                     <a href="/view_file/${encodeURIComponent(result.file_path)}" class="file-link" target="_blank">
                         ${result.file_name}
                     </a>
+                    ${result.similar ? `<span class="similar-count">${result.similar} similar</span>` : ''}
+                    <a href="#" class="more-like-this" onclick="showSimilar(${result.doc_id}, this); return false;">more like this</a>
                     <div class="snippet">${result.snippet}</div>
+                    <div class="similar-documents"></div>
                 </div>
                 `;
             });
 
             resultsContainer.innerHTML = html;
         }
+
+        async function showSimilar(docId, link) {
+            const container = link.parentElement.querySelector('.similar-documents');
+            try {
+                const response = await fetch('/similar/' + docId);
+                const data = await response.json();
+                if (data.error) {
+                    container.innerHTML = `<div class="error-message">${data.error}</div>`;
+                } else if (data.results.length === 0) {
+                    container.innerHTML = '<p>No similar documents.</p>';
+                } else {
+                    container.innerHTML = '<ul>' + data.results.map(function(similar) {
+                        return `<li><a href="/view_file/${encodeURIComponent(similar.file_path)}" target="_blank">${similar.file_name}</a> <span class="similar-count">${similar.score.toFixed(2)}</span></li>`;
+                    }).join('') + '</ul>';
+                }
+            } catch (error) {
+                container.innerHTML = `<div class="error-message">Error: ${error.message}</div>`;
+            }
+        }
     </script>
 </body>
 </html>'''
@@ -661,6 +1302,18 @@ def create_templates():
             text-decoration: none;
         }
 
+        .image-thumb {
+            display: block;
+            margin-top: 10px;
+            max-width: 240px;
+            border: 1px solid #ddd;
+        }
+
+        .original-link {
+            margin-left: 10px;
+            color: #007bff;
+        }
+
         .file-content {
             white-space: pre-wrap;
             line-height: 1.4;
@@ -675,6 +1328,8 @@ def create_templates():
             {% if image_url %}
             <div class="image-link">
                 <a href="{{ image_url }}" target="_blank" class="image-link-button">View Corresponding Image</a>
+                <a href="{{ image_url }}?size=original" target="_blank" class="original-link">original scan</a>
+                <a href="{{ image_url }}" target="_blank"><img src="{{ image_url }}?size=thumb" class="image-thumb" alt="Page scan"></a>
             </div>
             {% endif %}
         </div>
@@ -695,11 +1350,30 @@ def create_templates():
 
 
 if __name__ == '__main__':
-    # Check if database exists
+    parser = argparse.ArgumentParser(description="Web interface for searching the indexed documents")
+    parser.add_argument('--immutable', action='store_true',
+                        help="Open the database read-only and immutable, for a database that is never "
+                             "modified while it is served")
+    args = parser.parse_args()
+    IMMUTABLE = IMMUTABLE or args.immutable
+
+    # Check if database exists, falling back to per-volume shards next to it
     if not os.path.exists(DB_PATH):
-        print(f"Error: Database file '{DB_PATH}' not found.")
-        print("Please make sure the database has been created with the indexing script.")
-        sys.exit(1)
+        SHARD_PATHS = find_shards(DB_PATH)
+        if not SHARD_PATHS:
+            print(f"Error: Database file '{DB_PATH}' not found.")
+            print("Please make sure the database has been created with the indexing script.")
+            sys.exit(1)
+        print(f"Searching {len(SHARD_PATHS)} shard databases")
+        sharded_search()
+
+    if IMMUTABLE:
+        try:
+            check_not_modified(SHARD_PATHS or [DB_PATH])
+        except RuntimeError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        print("Serving the database read-only and immutable")
 
     # Create templates before starting the app
     create_templates()